@@ -1,11 +1,86 @@
 import flask
-from flask import Flask, request, render_template_string, jsonify
+import click
+from flask import Flask, request, render_template_string, jsonify, Response, stream_with_context, g
 import psycopg2
+import psycopg2.pool
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import os
 import datetime
 import requests
 import logging
 import json
+import threading
+import time
+import contextlib
+import collections
+import gzip
+import hashlib
+import hmac
+import base64
+import binascii
+import re
+import random
+import csv
+import io
+import tempfile
+import decimal
+import concurrent.futures
+import zlib
+import zipfile
+import mimetypes
+import shutil
+import select
+import subprocess
+import bisect
+import atexit
+import sys
+import cProfile
+import pstats
+import marshal
+from xml.sax.saxutils import escape as escapar_xml
+import requests.adapters
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+    import brotli  # opcional: sem ele a página sai só em gzip
+except ImportError:
+    brotli = None
+
+try:
+    import openpyxl  # opcional: exportação em XLSX
+except ImportError:
+    openpyxl = None
+
+try:
+    from PIL import Image, ImageOps, ImageDraw, ImageColor  # opcional: sem ele a foto é gravada como chegou
+except ImportError:
+    Image = ImageOps = ImageDraw = ImageColor = None
+
+try:
+    # opcional: PDF da ficha gerado no servidor
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.graphics.shapes import Drawing, PolyLine
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Image as ImagemPDF
+except ImportError:
+    SimpleDocTemplate = None
+
+try:
+    from gevent import monkey as gevent_monkey  # opcional: SERVIDOR_MODO=gevent (gunicorn.conf.py)
+    import gevent.threadpool
+except ImportError:
+    gevent_monkey = None
+
+try:
+    import fcntl  # trava entre workers ao juntar as métricas (não existe no Windows)
+except ImportError:
+    fcntl = None
 
 # --- Configuração de Logs ---
 logging.basicConfig(level=logging.INFO)
@@ -25,106 +100,900 @@ def limpar_texto(texto):
         return texto.replace('\n', ' - ').replace('\r', '')
     return texto
 
+# R$ opcional, sinal, milhar com ponto ("1.200" é mil e duzentos) e decimal com vírgula
+_RE_NUMERO_BR = re.compile(r'(?:R\$\s*)?(-?)(\d{1,3}(?:\.\d{3})+|\d+)(?:,(\d+))?')
+
+def converter_numero_br(texto):
+    """Converte 'R$ 1.234,56' / '360,5' / '1.200' para Decimal. Devolve None se o texto não for só o número:
+    '450m2' ou '12x30' não viram 4502 e 1230."""
+    if texto is None:
+        return None
+    m = _RE_NUMERO_BR.fullmatch(str(texto).strip())
+    if not m:
+        return None
+    sinal, inteiro, decimais = m.groups()
+    return decimal.Decimal(f"{sinal}{inteiro.replace('.', '')}.{decimais or '0'}")
+
 # --- CONFIGURAÇÕES DE PRODUÇÃO (RENDER) ---
 N8N_WEBHOOK_URL = os.environ.get("N8N_WEBHOOK_URL")
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# Rotas com dados de todos os clientes (listagem, exportação...) exigem este token; sem ele, respondem 404
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# Entrega do webhook n8n (outbox)
+N8N_TIMEOUT = float(os.environ.get("N8N_TIMEOUT", "10"))
+N8N_MAX_TENTATIVAS = int(os.environ.get("N8N_MAX_TENTATIVAS", "10"))
+N8N_BACKOFF_BASE = float(os.environ.get("N8N_BACKOFF_BASE", "5"))       # segundos; dobra a cada falha
+N8N_BACKOFF_MAX = float(os.environ.get("N8N_BACKOFF_MAX", "3600"))
+N8N_POLL_INTERVALO = float(os.environ.get("N8N_POLL_INTERVALO", "5"))   # varredura da fila (retentativas) sem NOTIFY
+N8N_LIDER_ESPERA = float(os.environ.get("N8N_LIDER_ESPERA", "30"))      # worker sem a entrega tenta assumi-la a cada N s
+N8N_LOTE_MAX = int(os.environ.get("N8N_LOTE_MAX", "1"))                 # > 1 liga o modo lote
+N8N_LOTE_ESPERA_MS = int(os.environ.get("N8N_LOTE_ESPERA_MS", "2000"))  # espera máxima para juntar um lote
+
+# Pool de conexões (por worker do gunicorn)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))          # segundos esperando conexão livre
+DB_POOL_CHECK_IDLE = float(os.environ.get("DB_POOL_CHECK_IDLE", "30"))    # ociosa há mais que isso -> SELECT 1
+
+# Worker gevent (SERVIDOR_MODO=gevent): socket/threading já foram trocados antes de o app ser carregado
+GEVENT_ATIVO = gevent_monkey is not None and gevent_monkey.is_module_patched('socket')
+if GEVENT_ATIVO:
+    # psycopg2 espera o Postgres com select() (cooperativo sob gevent): uma consulta lenta não trava o worker
+    psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
 
 # --- LISTAS ---
 OPCOES_EMPREENDIMENTOS = ["Jardim dos Ipês", "Jardim Amazônia ET. 3", "Jardim Amazônia ET. 4", "Jardim Amazônia ET. 5", "Jardim Paulista", "Jardim Mato Grosso", "Jardim Florencia", "Benjamim Rossato", "Santa Felicidade", "Amazon Park", "Santa Fé", "Colina Verde", "Res. Terra de Santa Cruz", "Consórcio Gran Ville", "Consórcio Parque Cerrado", "Consórcio Recanto da Mata", "Jardim Vila Rica", "Jardim Amazônia Et. I", "Jardim Amazônia Et. II", "Loteamento Luxemburgo", "Loteamento Jardim Vila Bella", "Morada do Boque III", "Reserva Jardim", "Residencial Cidade Jardim", "Residencial Florais da Mata", "Residencial Jardim Imigrantes", "Residencial Vila Rica", "Residencial Vila Rica SINOP", "Outro / Não Listado"]
 
 OPCOES_CORRETORES = ["4083 - NEURA.T.PAVAN SINIGAGLIA", "2796 - PEDRO LAERTE RABECINI", "57 - Santos e Padilha Ltda - ME", "1376 - VALMIR MARIO TOMASI", "1768 - SEGALA EMPREENDIMENTOS", "2436 - PAULO EDUARDO GONCALVES DIAS", "2447 - GLAUBER BENEDITO FIGUEIREDO DE PINHO", "4476 - Priscila Canhet da Silveira", "1531 - Walmir de Oliveira Queiroz", "4704 - MAYCON JEAN CAMPOS", "4084 - JAIMIR COMPAGNONI", "4096 - THAYANE APARECIDA BORGES", "4160 - SIMONE VALQUIRIA BELLO OLIVEIRA", "4587 - GABRIEL GALVÃO LOURENÇO", "4802 - CESAR AUGUSTO PORTELA DA FONSECA JUNIOR", "4868 - LENE ENGLER DA SILVA", "4087 - JOHNNY MIRANDA OJEDA", "4531 - MG EMPREENDIMENTOS LTDA", "4826 - JEVIELI BELLO OLIVEIRA", "4825 - EVA VITORIA GALVAO LOURENCO", "54 - Ronaldo Padilha dos Santos", "1137 - Moacir Blemer Olivoto", "4872 - WQ CORRETORES LTDA", "720 - Luciane Bocchi ME", "5154 - FELIPE JOSE MOREIRA ALMEIDA", "3063 - SILVANA SEGALA", "2377 - Paulo Eduardo Gonçalves Dias", "Outro / Não Listado"]
 
+# --- MÉTRICAS (PROMETHEUS) ---
+# Cada worker soma contadores e histogramas em memória e grava um retrato em METRICAS_DIR/<pid>.json
+# (no máximo a cada METRICAS_FLUSH segundos). GET /metrics junta os retratos de todos os workers; os de
+# workers que já morreram são somados em acumulado.json, para os contadores nunca voltarem para trás.
+METRICAS_ATIVAS = to_bool_flag(os.environ.get("METRICAS_ATIVAS", "1"))
+METRICAS_DIR = os.environ.get("METRICAS_DIR") or os.path.join(tempfile.gettempdir(), 'ficha_metricas')
+METRICAS_FLUSH = float(os.environ.get("METRICAS_FLUSH", "5"))
+METRICAS_TOKEN = os.environ.get("METRICAS_TOKEN")  # /metrics exige "Authorization: Bearer <token>"; sem ele, 404
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKETS_BYTES = (1024, 10240, 102400, 512000, 1048576, 2097152, 5242880, 10485760, 20971520)
+BUCKETS_DB = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# nome: (tipo, ajuda, buckets)
+METRICAS = {
+    'ficha_http_requisicoes_total': ('counter', 'Requisicoes atendidas por rota, metodo e status.', None),
+    'ficha_http_erros_total': ('counter', 'Respostas 5xx por rota.', None),
+    'ficha_http_duracao_segundos': ('histogram', 'Latencia das requisicoes por rota.', BUCKETS_LATENCIA),
+    'ficha_http_requisicao_bytes': ('histogram', 'Tamanho do corpo recebido por rota.', BUCKETS_BYTES),
+    'ficha_http_resposta_bytes': ('histogram', 'Tamanho do corpo enviado por rota (respostas com tamanho conhecido).', BUCKETS_BYTES),
+    'ficha_db_conexao_segundos': ('histogram', 'Tempo para obter conexao do pool (espera + conexao nova).', BUCKETS_DB),
+    'ficha_db_consulta_segundos': ('histogram', 'Duracao de cada comando SQL, por comando e tabela.', BUCKETS_DB),
+    'ficha_db_erros_total': ('counter', 'Comandos SQL que falharam, por comando e tabela.', None),
+    'ficha_db_pool_em_uso': ('gauge', 'Conexoes emprestadas no momento, por worker.', None),
+    'ficha_db_pool_espera_timeouts_total': ('counter', 'Pedidos de conexao que esgotaram DB_POOL_TIMEOUT.', None),
+}
+
+class Metricas:
+    """Contadores, histogramas e gauges de um worker. Thread-safe; séries = (nome, rótulos)."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.contadores = {}
+        self.histogramas = {}  # contagem por bucket (não cumulativa) + [soma, total]
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._ultimo_flush = 0.0
+        self._primeiro_flush = True
+
+    def contar(self, nome, rotulos=(), valor=1):
+        with self._lock:
+            self.contadores[(nome, rotulos)] = self.contadores.get((nome, rotulos), 0) + valor
+
+    def observar(self, nome, valor, rotulos=()):
+        buckets = METRICAS[nome][2]
+        with self._lock:
+            h = self.histogramas.get((nome, rotulos))
+            if h is None:
+                h = self.histogramas[(nome, rotulos)] = [0] * len(buckets) + [0.0, 0]
+            i = bisect.bisect_left(buckets, valor)
+            if i < len(buckets):
+                h[i] += 1
+            h[-2] += valor
+            h[-1] += 1
+
+    def definir(self, nome, valor, rotulos=()):
+        with self._lock:
+            self.gauges[(nome, rotulos)] = valor
+
+    def retrato(self):
+        with self._lock:
+            if _pool is not None and _pool_pid == self.pid:
+                self.gauges[('ficha_db_pool_em_uso', ())] = _pool.stats['em_uso']
+                self.contadores[('ficha_db_pool_espera_timeouts_total', ())] = _pool.stats['timeouts']
+            return {
+                'contadores': [[n, r, v] for (n, r), v in self.contadores.items()],
+                'histogramas': [[n, r, list(h)] for (n, r), h in self.histogramas.items()],
+                'gauges': [[n, r, v] for (n, r), v in self.gauges.items()],
+            }
+
+    def gravar(self, forcar=False):
+        """Grava o retrato do worker em disco (atômico), respeitando METRICAS_FLUSH."""
+        agora = time.monotonic()
+        if not forcar and agora - self._ultimo_flush < METRICAS_FLUSH:
+            return
+        self._ultimo_flush = agora
+        try:
+            os.makedirs(METRICAS_DIR, exist_ok=True)
+            caminho = os.path.join(METRICAS_DIR, f'{self.pid}.json')
+            if self._primeiro_flush:
+                # PID reaproveitado: o arquivo é de um worker morto, que ainda não foi somado
+                self._primeiro_flush = False
+                with _trava_metricas():
+                    _absorver_retrato(caminho)
+            temporario = f'{caminho}.{threading.get_ident()}.tmp'
+            with open(temporario, 'w') as f:
+                json.dump(self.retrato(), f)
+            os.replace(temporario, caminho)
+        except OSError as e:
+            logger.warning(f"⚠️ Não foi possível gravar métricas: {e}")
+
+_metricas = None
+_metricas_lock = threading.Lock()
+
+def obter_metricas():
+    """Métricas do processo atual (recriadas após o fork, como o pool)."""
+    global _metricas
+    if _metricas is None or _metricas.pid != os.getpid():
+        with _metricas_lock:
+            if _metricas is None or _metricas.pid != os.getpid():
+                _metricas = Metricas()
+    return _metricas
+
+@atexit.register
+def _gravar_metricas_na_saida():
+    if METRICAS_ATIVAS and _metricas is not None and _metricas.pid == os.getpid():
+        _metricas.gravar(forcar=True)
+
+@contextlib.contextmanager
+def _trava_metricas():
+    """Serializa entre workers a leitura/compactação dos retratos."""
+    with open(os.path.join(METRICAS_DIR, '.trava'), 'a') as trava:
+        if fcntl is not None:
+            fcntl.flock(trava, fcntl.LOCK_EX)
+        yield
+
+def _somar_retrato(total, retrato, com_gauges=True, pid=None):
+    for nome, rotulos, valor in retrato['contadores']:
+        chave = (nome, tuple(map(tuple, rotulos)))
+        total['contadores'][chave] = total['contadores'].get(chave, 0) + valor
+    for nome, rotulos, h in retrato['histogramas']:
+        chave = (nome, tuple(map(tuple, rotulos)))
+        atual = total['histogramas'].get(chave)
+        total['histogramas'][chave] = [a + b for a, b in zip(atual, h)] if atual else list(h)
+    if com_gauges:
+        for nome, rotulos, valor in retrato['gauges']:
+            total['gauges'][(nome, tuple(map(tuple, rotulos)) + (('pid', str(pid)),))] = valor
+
+def _ler_json(caminho):
+    try:
+        with open(caminho) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _absorver_retrato(caminho):
+    """Soma o retrato de um worker morto em acumulado.json e apaga o arquivo (chamar com a trava)."""
+    retrato = _ler_json(caminho)
+    if retrato is None:
+        return
+    acumulado = {'contadores': {}, 'histogramas': {}, 'gauges': {}}
+    anterior = _ler_json(os.path.join(METRICAS_DIR, 'acumulado.json'))
+    if anterior:
+        _somar_retrato(acumulado, anterior, com_gauges=False)
+    _somar_retrato(acumulado, retrato, com_gauges=False)
+    temporario = os.path.join(METRICAS_DIR, f'acumulado.json.{os.getpid()}.tmp')
+    with open(temporario, 'w') as f:
+        json.dump({
+            'contadores': [[n, r, v] for (n, r), v in acumulado['contadores'].items()],
+            'histogramas': [[n, r, h] for (n, r), h in acumulado['histogramas'].items()],
+            'gauges': [],
+        }, f)
+    os.replace(temporario, os.path.join(METRICAS_DIR, 'acumulado.json'))
+    os.remove(caminho)
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def coletar_metricas():
+    """Soma os retratos de todos os workers (vivos + acumulado dos que já saíram)."""
+    obter_metricas().gravar(forcar=True)
+    total = {'contadores': {}, 'histogramas': {}, 'gauges': {}}
+    with _trava_metricas():
+        for arquivo in os.listdir(METRICAS_DIR):
+            if not arquivo.endswith('.json') or arquivo == 'acumulado.json':
+                continue
+            if not arquivo[:-5].isdigit():  # só <pid>.json; outro arquivo na pasta não derruba o /metrics
+                continue
+            caminho = os.path.join(METRICAS_DIR, arquivo)
+            pid = int(arquivo[:-5])
+            if not _processo_vivo(pid):
+                _absorver_retrato(caminho)
+                continue
+            retrato = _ler_json(caminho)
+            if retrato is not None:
+                _somar_retrato(total, retrato, pid=pid)
+        acumulado = _ler_json(os.path.join(METRICAS_DIR, 'acumulado.json'))
+        if acumulado:
+            _somar_retrato(total, acumulado, com_gauges=False)
+    return total
+
+def _rotulos_prometheus(rotulos):
+    if not rotulos:
+        return ''
+    def escapar(v):
+        return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escapar(v)}"' for k, v in rotulos) + '}'
+
+def _numero_prometheus(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+def formatar_prometheus(total):
+    """Formato de texto do Prometheus (version 0.0.4)."""
+    linhas = []
+    for nome, (tipo, ajuda, buckets) in METRICAS.items():
+        linhas.append(f'# HELP {nome} {ajuda}')
+        linhas.append(f'# TYPE {nome} {tipo}')
+        if tipo == 'histogram':
+            for (n, rotulos), h in sorted(total['histogramas'].items()):
+                if n != nome:
+                    continue
+                acumulado = 0
+                for limite, quantidade in zip(buckets, h):
+                    acumulado += quantidade
+                    linhas.append(f'{nome}_bucket{_rotulos_prometheus(rotulos + (("le", repr(float(limite))),))} {acumulado}')
+                linhas.append(f'{nome}_bucket{_rotulos_prometheus(rotulos + (("le", "+Inf"),))} {h[-1]}')
+                linhas.append(f'{nome}_sum{_rotulos_prometheus(rotulos)} {_numero_prometheus(h[-2])}')
+                linhas.append(f'{nome}_count{_rotulos_prometheus(rotulos)} {h[-1]}')
+        else:
+            series = total['contadores'] if tipo == 'counter' else total['gauges']
+            for (n, rotulos), valor in sorted(series.items()):
+                if n == nome:
+                    linhas.append(f'{nome}{_rotulos_prometheus(rotulos)} {_numero_prometheus(valor)}')
+    return '\n'.join(linhas) + '\n'
+
+_RE_TABELA_SQL = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][\w.]*)', re.I)
+_rotulos_sql = {}
+
+def rotulo_sql(sql):
+    """'select atendimentos', 'insert lotes_pc'...: rótulo de baixa cardinalidade para um comando SQL."""
+    rotulo = _rotulos_sql.get(sql)
+    if rotulo is not None:
+        return rotulo
+    texto = sql.decode('utf-8', 'replace') if isinstance(sql, bytes) else str(sql)
+    texto = texto.lstrip()
+    verbo = texto.split(None, 1)[0].lower() if texto else ''
+    m = _RE_TABELA_SQL.search(texto[:2000])
+    rotulo = f"{verbo} {m.group(1).lower()}" if m else verbo
+    if len(texto) < 4000:  # execute_values monta o SQL com os valores: não vale guardar
+        if len(_rotulos_sql) > 512:
+            _rotulos_sql.clear()
+        _rotulos_sql[sql] = rotulo
+    return rotulo
+
+# --- POOL DE CONEXÕES ---
+class CursorMedido(psycopg2.extensions.cursor):
+    """Cursor que registra a duração de cada comando em ficha_db_consulta_segundos."""
+
+    rotulo = None  # executar_preparado informa o SQL original (senão o rótulo seria só "execute")
+
+    def execute(self, query, vars=None):
+        if not METRICAS_ATIVAS:
+            return super().execute(query, vars)
+        rotulos = (('comando', self.rotulo or rotulo_sql(query)),)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            obter_metricas().contar('ficha_db_erros_total', rotulos)
+            raise
+        finally:
+            obter_metricas().observar('ficha_db_consulta_segundos', time.perf_counter() - inicio, rotulos)
+
+class ConexaoApp(psycopg2.extensions.connection):
+    """Conexão do pool que lembra quais prepared statements já foram criados na sessão."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparados = collections.OrderedDict()
+        self.cursor_factory = CursorMedido
+        self.ultimo_uso = None  # devolução ao pool (time.monotonic), para o health check
+
+class PoolConexoes:
+    """Pool de conexões com espera limitada, health check e métricas de espera."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, check_idle):
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.maxconn = maxconn
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, connection_factory=ConexaoApp,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+        )
+        # O ThreadedConnectionPool lança PoolError quando esgota; o semáforo faz a requisição esperar.
+        self._vagas = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.stats = {
+            'checkouts': 0,
+            'espera_total_s': 0.0,
+            'espera_max_s': 0.0,
+            'timeouts': 0,
+            'descartadas': 0,
+            'em_uso': 0,
+        }
+
+    def _saudavel(self, conn):
+        if conn.closed:
+            return False
+        if conn.ultimo_uso is None or time.monotonic() - conn.ultimo_uso < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _descartar(self, conn):
+        try:
+            self._pool.putconn(conn, close=True)
+        except Exception:
+            pass
+        with self._lock:
+            self.stats['descartadas'] += 1
+
+    def checkout(self):
+        inicio = time.monotonic()
+        if not self._vagas.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise psycopg2.pool.PoolError(f"Nenhuma conexão livre em {self.timeout}s")
+        espera = time.monotonic() - inicio
+        try:
+            # Conexões quebradas (Postgres reiniciado, idle timeout do Render) são trocadas aqui
+            for _ in range(self.maxconn + 1):
+                conn = self._pool.getconn()
+                if self._saudavel(conn):
+                    break
+                logger.warning("♻️ Conexão do pool inválida, reconectando...")
+                self._descartar(conn)
+            else:
+                raise psycopg2.OperationalError("Não foi possível obter conexão saudável")
+        except Exception:
+            self._vagas.release()
+            raise
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['espera_total_s'] += espera
+            self.stats['espera_max_s'] = max(self.stats['espera_max_s'], espera)
+            self.stats['em_uso'] += 1
+        return conn
+
+    def checkin(self, conn, quebrada=False):
+        try:
+            if quebrada or conn.closed:
+                self._descartar(conn)
+            else:
+                conn.ultimo_uso = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self.stats['em_uso'] -= 1
+            self._vagas.release()
+
+    def snapshot(self):
+        with self._lock:
+            dados = dict(self.stats)
+        dados['espera_media_ms'] = round(1000 * dados['espera_total_s'] / dados['checkouts'], 3) if dados['checkouts'] else 0.0
+        dados['espera_max_ms'] = round(1000 * dados.pop('espera_max_s'), 3)
+        dados['espera_total_s'] = round(dados['espera_total_s'], 3)
+        dados['max'] = self.maxconn
+        return dados
+
+    def fechar(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pools_orfaos = []  # pools herdados do processo pai; nunca fechados no filho
+
+def _resetar_pool_apos_fork():
+    """No worker recém-criado, abandona o pool do master sem fechar os sockets compartilhados."""
+    global _pool, _pool_pid
+    if _pool is not None:
+        _pools_orfaos.append(_pool)
+    _pool, _pool_pid = None, None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_resetar_pool_apos_fork)
+
+def obter_pool():
+    """Retorna o pool do processo atual, criando-o na primeira chamada (lazy, após o fork)."""
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid != os.getpid():
+            _resetar_pool_apos_fork()
+        if _pool is None:
+            _pool = PoolConexoes(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE)
+            _pool_pid = os.getpid()
+            logger.info(f"🔌 Pool de conexões criado (pid {_pool_pid}, {DB_POOL_MIN}-{DB_POOL_MAX})")
+    return _pool
+
+PREPARADOS_MAX = 64  # prepared statements mantidos por conexão (LRU)
+
+def executar_preparado(cur, sql, params):
+    """Executa sql ($1, $2...) como prepared statement, preparando uma única vez por conexão."""
+    conn = cur.connection
+    preparados = getattr(conn, 'preparados', None)
+    if preparados is None:  # conexão avulsa (fora do pool): executa direto
+        cur.execute(re.sub(r'\$\d+', '%s', sql), params)
+        return
+    nome = 'p_' + hashlib.sha1(sql.encode('utf-8')).hexdigest()[:16]
+    if nome in preparados:
+        preparados.move_to_end(nome)
+    else:
+        cur.execute(f"PREPARE {nome} AS {sql}")
+        preparados[nome] = True
+        if len(preparados) > PREPARADOS_MAX:
+            antigo, _ = preparados.popitem(last=False)
+            cur.execute(f"DEALLOCATE {antigo}")
+    if isinstance(cur, CursorMedido):
+        cur.rotulo = rotulo_sql(sql)
+    try:
+        cur.execute(f"EXECUTE {nome} ({', '.join(['%s'] * len(params))})", params)
+    finally:
+        if isinstance(cur, CursorMedido):
+            cur.rotulo = None
+
+@contextlib.contextmanager
+def db_conexao():
+    """Empresta uma conexão do pool: commit no sucesso, rollback no erro, devolve sempre."""
+    pool = obter_pool()
+    inicio = time.perf_counter()
+    conn = pool.checkout()
+    if METRICAS_ATIVAS:
+        obter_metricas().observar('ficha_db_conexao_segundos', time.perf_counter() - inicio)
+    quebrada = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        quebrada = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                quebrada = True
+        raise
+    finally:
+        pool.checkin(conn, quebrada)
+
 # --- BANCO DE DADOS ---
+# Schema original (versão 1): tabela + colunas adicionadas ao longo do tempo
+_SQL_TABELA_ATENDIMENTOS = '''
+CREATE TABLE IF NOT EXISTS atendimentos (
+    id SERIAL PRIMARY KEY,
+    data_hora TIMESTAMPTZ NOT NULL,
+    nome TEXT NOT NULL,
+    telefone TEXT NOT NULL,
+    rede_social TEXT,
+    abordagem_inicial TEXT,
+    esteve_plantao BOOLEAN,
+    foi_atendido BOOLEAN,
+    nome_corretor TEXT,
+    autoriza_transmissao BOOLEAN,
+    foto_cliente TEXT,
+    assinatura TEXT,
+    cidade TEXT,
+    loteamento TEXT
+)
+'''
+# Migrações - Incluindo os campos novos
+_SQL_COLUNAS_ATENDIMENTOS = [
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS comprou_1o_lote TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nivel_interesse TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nota_atendimento INTEGER DEFAULT 0;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empreendimento_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS quadra_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS lote_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS m2_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_m2_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_total_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS venda_realizada_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS forma_pagamento_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS entrada_forma_pagamento_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS numero_parcelas_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_parcelas_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vencimento_parcelas_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nome_proponente_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS rg_proponente_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS orgao_emissor_proponente_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cpf_proponente_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS estado_civil_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS filhos_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cep_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS endereco_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_residencial_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS celular_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS email_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_residencia_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS valor_aluguel_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_financiamento_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS valor_financiamento_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empresa_trabalha_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS profissao_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_empresa_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS renda_mensal_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nome_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS rg_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS orgao_emissor_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cpf_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS email_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empresa_trabalha_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS profissao_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_empresa_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS renda_mensal_conjuge_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS referencias_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS fonte_midia_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS outros_lotes_pc TEXT;",
+    "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_outro_lote TEXT;"
+]
+
+# Migrações versionadas: (versão, descrição, SQL). Só se adiciona no fim; nunca se edita uma versão já publicada.
+MIGRACOES = [
+    (1, 'schema inicial de atendimentos', "\n".join([_SQL_TABELA_ATENDIMENTOS + ";"] + _SQL_COLUNAS_ATENDIMENTOS)),
+    (2, 'foto e assinatura em tabela de mídias endereçada por hash', '''
+        CREATE TABLE midias (
+            hash TEXT PRIMARY KEY,
+            mimetype TEXT NOT NULL,
+            tamanho INTEGER NOT NULL,
+            conteudo BYTEA,
+            criado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        ALTER TABLE atendimentos ADD COLUMN foto_cliente_hash TEXT REFERENCES midias(hash);
+        ALTER TABLE atendimentos ADD COLUMN assinatura_hash TEXT REFERENCES midias(hash);
+
+        -- Migra os data URLs base64 já gravados para a tabela de mídias
+        CREATE TEMP TABLE _midias_legado ON COMMIT DROP AS
+            SELECT id, 'foto' AS tipo, substring(foto_cliente from '^data:([^;,]+);base64,') AS mimetype,
+                   decode(substring(foto_cliente from ',(.*)$'), 'base64') AS conteudo
+              FROM atendimentos WHERE foto_cliente ~ '^data:[^;,]+;base64,'
+            UNION ALL
+            SELECT id, 'assinatura', substring(assinatura from '^data:([^;,]+);base64,'),
+                   decode(substring(assinatura from ',(.*)$'), 'base64')
+              FROM atendimentos WHERE assinatura ~ '^data:[^;,]+;base64,';
+        INSERT INTO midias (hash, mimetype, tamanho, conteudo)
+            SELECT DISTINCT ON (h) h, mimetype, length(conteudo), conteudo
+              FROM (SELECT encode(sha256(conteudo), 'hex') AS h, mimetype, conteudo FROM _midias_legado) m
+            ON CONFLICT (hash) DO NOTHING;
+        UPDATE atendimentos a SET foto_cliente_hash = encode(sha256(l.conteudo), 'hex'), foto_cliente = NULL
+              FROM _midias_legado l WHERE l.id = a.id AND l.tipo = 'foto';
+        UPDATE atendimentos a SET assinatura_hash = encode(sha256(l.conteudo), 'hex'), assinatura = NULL
+              FROM _midias_legado l WHERE l.id = a.id AND l.tipo = 'assinatura';
+    '''),
+]
+MIGRACOES.append((3, 'outbox de eventos para o webhook n8n', '''
+    CREATE TABLE webhook_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        evento TEXT NOT NULL,
+        payload JSONB NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pendente',   -- pendente | enviado | morto
+        tentativas INTEGER NOT NULL DEFAULT 0,
+        proxima_tentativa TIMESTAMPTZ NOT NULL DEFAULT now(),
+        ultimo_erro TEXT,
+        criado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        enviado_em TIMESTAMPTZ
+    );
+    CREATE INDEX webhook_outbox_pendentes_idx ON webhook_outbox (proxima_tentativa) WHERE status = 'pendente';
+'''))
+MIGRACOES.append((4, 'índices para listagem e busca de fichas', '''
+    CREATE INDEX atendimentos_data_hora_id_idx ON atendimentos (data_hora DESC, id DESC);
+    CREATE INDEX atendimentos_corretor_idx ON atendimentos (nome_corretor, data_hora DESC, id DESC);
+    CREATE INDEX atendimentos_loteamento_idx ON atendimentos (loteamento, data_hora DESC, id DESC);
+    CREATE INDEX atendimentos_cidade_idx ON atendimentos (cidade, data_hora DESC, id DESC);
+    CREATE INDEX atendimentos_interesse_idx ON atendimentos (nivel_interesse, data_hora DESC, id DESC);
+    CREATE INDEX atendimentos_venda_idx ON atendimentos (venda_realizada_pc, data_hora DESC, id DESC);
+    -- Busca parcial por nome/telefone (ILIKE '%...%'); sem pg_trgm no servidor a busca só fica sem índice
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX atendimentos_nome_trgm_idx ON atendimentos USING gin (nome gin_trgm_ops);
+            CREATE INDEX atendimentos_telefone_trgm_idx ON atendimentos USING gin (telefone gin_trgm_ops);
+        END IF;
+    END
+    $$;
+'''))
+# Campos do pré-contrato digitados com máscara (texto) -> coluna numérica "sombra" <campo>_num
+CAMPOS_NUMERICOS = {
+    'm2_pc': 'NUMERIC(12,2)',
+    'vl_m2_pc': 'NUMERIC(14,2)',
+    'vl_total_pc': 'NUMERIC(14,2)',
+    'numero_parcelas_pc': 'INTEGER',
+    'vl_parcelas_pc': 'NUMERIC(14,2)',
+    'renda_mensal_pc': 'NUMERIC(14,2)',
+    'renda_mensal_conjuge_pc': 'NUMERIC(14,2)',
+    'valor_aluguel_pc': 'NUMERIC(14,2)',
+    'valor_financiamento_pc': 'NUMERIC(14,2)',
+}
+MIGRACOES.append((5, 'colunas numéricas para valores e áreas do pré-contrato', "\n".join(
+    [f"ALTER TABLE atendimentos ADD COLUMN {campo}_num {tipo};" for campo, tipo in CAMPOS_NUMERICOS.items()] + [
+    "CREATE INDEX atendimentos_vgv_idx ON atendimentos (empreendimento_pc, data_hora) INCLUDE (vl_total_pc_num) WHERE vl_total_pc_num IS NOT NULL;",
+    "CREATE INDEX atendimentos_vgv_loteamento_idx ON atendimentos (loteamento, data_hora) INCLUDE (vl_total_pc_num) WHERE vl_total_pc_num IS NOT NULL;",
+])))
+MIGRACOES.append((6, 'resumo diário para o dashboard, mantido por trigger', '''
+    CREATE TABLE resumo_atendimentos (
+        dia DATE NOT NULL,
+        nome_corretor TEXT NOT NULL,
+        loteamento TEXT NOT NULL,
+        empreendimento_pc TEXT NOT NULL,
+        fichas INTEGER NOT NULL DEFAULT 0,
+        atendidos INTEGER NOT NULL DEFAULT 0,
+        vendas INTEGER NOT NULL DEFAULT 0,
+        vendas_atendidos INTEGER NOT NULL DEFAULT 0,
+        notas_soma INTEGER NOT NULL DEFAULT 0,
+        notas_qtd INTEGER NOT NULL DEFAULT 0,
+        vgv NUMERIC(16,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (dia, nome_corretor, loteamento, empreendimento_pc)
+    );
+
+    -- Contribuição de uma ficha (sinal +1 entra, -1 sai). Dia no fuso de Sorriso/MT.
+    -- Venda = venda_realizada_pc preenchido; nota 0 = não avaliado.
+    CREATE FUNCTION resumo_aplicar(r atendimentos, sinal INTEGER) RETURNS void AS $$
+        INSERT INTO resumo_atendimentos AS t
+            (dia, nome_corretor, loteamento, empreendimento_pc, fichas, atendidos, vendas, vendas_atendidos, notas_soma, notas_qtd, vgv)
+        VALUES (
+            (r.data_hora AT TIME ZONE 'America/Cuiaba')::date,
+            coalesce(r.nome_corretor, ''), coalesce(r.loteamento, ''), coalesce(r.empreendimento_pc, ''),
+            sinal,
+            sinal * (r.foi_atendido IS TRUE)::int,
+            sinal * (coalesce(r.venda_realizada_pc, '') <> '')::int,
+            sinal * (r.foi_atendido IS TRUE AND coalesce(r.venda_realizada_pc, '') <> '')::int,
+            sinal * CASE WHEN r.nota_atendimento > 0 THEN r.nota_atendimento ELSE 0 END,
+            sinal * (coalesce(r.nota_atendimento, 0) > 0)::int,
+            sinal * CASE WHEN coalesce(r.venda_realizada_pc, '') <> '' THEN coalesce(r.vl_total_pc_num, 0) ELSE 0 END
+        )
+        ON CONFLICT (dia, nome_corretor, loteamento, empreendimento_pc) DO UPDATE SET
+            fichas = t.fichas + EXCLUDED.fichas,
+            atendidos = t.atendidos + EXCLUDED.atendidos,
+            vendas = t.vendas + EXCLUDED.vendas,
+            vendas_atendidos = t.vendas_atendidos + EXCLUDED.vendas_atendidos,
+            notas_soma = t.notas_soma + EXCLUDED.notas_soma,
+            notas_qtd = t.notas_qtd + EXCLUDED.notas_qtd,
+            vgv = t.vgv + EXCLUDED.vgv
+    $$ LANGUAGE sql;
+
+    CREATE FUNCTION resumo_trigger() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN PERFORM resumo_aplicar(OLD, -1); END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN PERFORM resumo_aplicar(NEW, 1); END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER atendimentos_resumo_ins_del AFTER INSERT OR DELETE ON atendimentos
+        FOR EACH ROW EXECUTE FUNCTION resumo_trigger();
+    -- Só mexe no resumo quando muda uma coluna que ele usa
+    CREATE TRIGGER atendimentos_resumo_upd
+        AFTER UPDATE OF data_hora, nome_corretor, loteamento, empreendimento_pc, foi_atendido,
+                        venda_realizada_pc, nota_atendimento, vl_total_pc_num ON atendimentos
+        FOR EACH ROW EXECUTE FUNCTION resumo_trigger();
+
+    -- Carga inicial com as fichas existentes
+    SELECT resumo_aplicar(a, 1) FROM atendimentos a;
+'''))
+MIGRACOES.append((7, 'chave de idempotência na criação de fichas', '''
+    ALTER TABLE atendimentos ADD COLUMN chave_idempotencia TEXT;
+    CREATE UNIQUE INDEX atendimentos_chave_idempotencia_idx ON atendimentos (chave_idempotencia) WHERE chave_idempotencia IS NOT NULL;
+'''))
+# Compra de vários lotes: o 1º fica nas colunas da própria ficha, os seguintes em lotes_pc (ordem 2, 3, ...)
+CAMPOS_LOTE = ['quadra_pc', 'lote_pc', 'm2_pc', 'vl_m2_pc', 'vl_total_pc', 'entrada_forma_pagamento_pc', 'vl_parcelas_pc']
+COLUNAS_LOTE = CAMPOS_LOTE + [f"{campo}_num" for campo in CAMPOS_LOTE if campo in CAMPOS_NUMERICOS]
+MIGRACOES.append((8, 'clientes e lotes adicionais do pré-contrato', '''
+    CREATE TABLE clientes (
+        id SERIAL PRIMARY KEY,
+        telefone TEXT NOT NULL UNIQUE,
+        nome TEXT NOT NULL,
+        criado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    INSERT INTO clientes (telefone, nome, criado_em, atualizado_em)
+        SELECT DISTINCT ON (telefone) telefone, nome, min(data_hora) OVER (PARTITION BY telefone), data_hora
+          FROM atendimentos ORDER BY telefone, data_hora;
+    ALTER TABLE atendimentos ADD COLUMN cliente_id INTEGER REFERENCES clientes(id);
+    UPDATE atendimentos a SET cliente_id = c.id FROM clientes c WHERE c.telefone = a.telefone;
+    CREATE INDEX atendimentos_cliente_idx ON atendimentos (cliente_id);
+
+    CREATE TABLE lotes_pc (
+        atendimento_id INTEGER NOT NULL REFERENCES atendimentos(id) ON DELETE CASCADE,
+        ordem SMALLINT NOT NULL,
+''' + "".join(f"        {campo} TEXT,\n" for campo in CAMPOS_LOTE)
+    + "".join(f"        {campo}_num {CAMPOS_NUMERICOS[campo]},\n" for campo in CAMPOS_LOTE if campo in CAMPOS_NUMERICOS) + '''\
+        PRIMARY KEY (atendimento_id, ordem)
+    );
+
+    -- Soma dos lotes adicionais na própria ficha: o resumo do dashboard continua lendo uma linha só
+    ALTER TABLE atendimentos ADD COLUMN vl_total_lotes_num NUMERIC(14,2);
+    CREATE OR REPLACE FUNCTION resumo_aplicar(r atendimentos, sinal INTEGER) RETURNS void AS $$
+        INSERT INTO resumo_atendimentos AS t
+            (dia, nome_corretor, loteamento, empreendimento_pc, fichas, atendidos, vendas, vendas_atendidos, notas_soma, notas_qtd, vgv)
+        VALUES (
+            (r.data_hora AT TIME ZONE 'America/Cuiaba')::date,
+            coalesce(r.nome_corretor, ''), coalesce(r.loteamento, ''), coalesce(r.empreendimento_pc, ''),
+            sinal,
+            sinal * (r.foi_atendido IS TRUE)::int,
+            sinal * (coalesce(r.venda_realizada_pc, '') <> '')::int,
+            sinal * (r.foi_atendido IS TRUE AND coalesce(r.venda_realizada_pc, '') <> '')::int,
+            sinal * CASE WHEN r.nota_atendimento > 0 THEN r.nota_atendimento ELSE 0 END,
+            sinal * (coalesce(r.nota_atendimento, 0) > 0)::int,
+            sinal * CASE WHEN coalesce(r.venda_realizada_pc, '') <> ''
+                         THEN coalesce(r.vl_total_pc_num, 0) + coalesce(r.vl_total_lotes_num, 0) ELSE 0 END
+        )
+        ON CONFLICT (dia, nome_corretor, loteamento, empreendimento_pc) DO UPDATE SET
+            fichas = t.fichas + EXCLUDED.fichas,
+            atendidos = t.atendidos + EXCLUDED.atendidos,
+            vendas = t.vendas + EXCLUDED.vendas,
+            vendas_atendidos = t.vendas_atendidos + EXCLUDED.vendas_atendidos,
+            notas_soma = t.notas_soma + EXCLUDED.notas_soma,
+            notas_qtd = t.notas_qtd + EXCLUDED.notas_qtd,
+            vgv = t.vgv + EXCLUDED.vgv
+    $$ LANGUAGE sql;
+    DROP TRIGGER atendimentos_resumo_upd ON atendimentos;
+    CREATE TRIGGER atendimentos_resumo_upd
+        AFTER UPDATE OF data_hora, nome_corretor, loteamento, empreendimento_pc, foi_atendido,
+                        venda_realizada_pc, nota_atendimento, vl_total_pc_num, vl_total_lotes_num ON atendimentos
+        FOR EACH ROW EXECUTE FUNCTION resumo_trigger();
+'''))
+MIGRACOES.append((9, 'miniatura das fotos', '''
+    ALTER TABLE midias ADD COLUMN miniatura_hash TEXT REFERENCES midias(hash);
+'''))
+MIGRACOES.append((10, 'cache de consultas de CEP', '''
+    CREATE TABLE cep_cache (
+        cep CHAR(8) PRIMARY KEY,
+        dados JSONB NOT NULL,
+        atualizado_em TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+'''))
+SCHEMA_VERSAO = MIGRACOES[-1][0]
+MIGRACOES_LOCK_ID = 73_002_001  # chave do pg_advisory_xact_lock das migrações
+DB_AUTO_MIGRATE = to_bool_flag(os.environ.get("DB_AUTO_MIGRATE", "1"))
+
+def versao_schema(cur):
+    """Versão aplicada no banco (0 se a tabela de controle ainda não existe). Uma única query."""
+    try:
+        cur.execute("SELECT coalesce(max(versao), 0) FROM schema_migrations")
+    except psycopg2.errors.UndefinedTable:
+        return 0
+    return cur.fetchone()[0]
+
+def aplicar_migracoes(conn):
+    """Aplica as migrações pendentes numa única transação, serializada por advisory lock."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRACOES_LOCK_ID,))
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                versao INTEGER PRIMARY KEY,
+                descricao TEXT NOT NULL,
+                aplicada_em TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+        cur.execute("SELECT coalesce(max(versao), 0) FROM schema_migrations")
+        atual = cur.fetchone()[0]
+        pendentes = [m for m in MIGRACOES if m[0] > atual]
+        for versao, descricao, sql in pendentes:
+            logger.info(f"🛠️ Aplicando migração {versao}: {descricao}")
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (versao, descricao) VALUES (%s, %s)", (versao, descricao))
+    conn.commit()
+    return [m[0] for m in pendentes]
+
 def init_db():
+    """Na subida do worker só confere a versão do schema; migra apenas se houver pendência."""
     if not DATABASE_URL:
         logger.warning("⚠️ AVISO: DATABASE_URL não encontrada. O app não salvará dados.")
         return
+    if not DB_AUTO_MIGRATE:
+        return
 
-    create_table_query = '''
-    CREATE TABLE IF NOT EXISTS atendimentos (
-        id SERIAL PRIMARY KEY,
-        data_hora TIMESTAMPTZ NOT NULL,
-        nome TEXT NOT NULL,
-        telefone TEXT NOT NULL,
-        rede_social TEXT,
-        abordagem_inicial TEXT,
-        esteve_plantao BOOLEAN,
-        foi_atendido BOOLEAN,
-        nome_corretor TEXT,
-        autoriza_transmissao BOOLEAN,
-        foto_cliente TEXT,
-        assinatura TEXT,
-        cidade TEXT,
-        loteamento TEXT
-    )
-    '''
-    # Migrações - Incluindo os campos novos
-    migrations = [
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS comprou_1o_lote TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nivel_interesse TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nota_atendimento INTEGER DEFAULT 0;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empreendimento_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS quadra_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS lote_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS m2_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_m2_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_total_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS venda_realizada_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS forma_pagamento_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS entrada_forma_pagamento_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS numero_parcelas_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vl_parcelas_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS vencimento_parcelas_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nome_proponente_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS rg_proponente_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS orgao_emissor_proponente_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cpf_proponente_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS estado_civil_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS filhos_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cep_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS endereco_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_residencial_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS celular_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS email_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_residencia_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS valor_aluguel_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_financiamento_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS valor_financiamento_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empresa_trabalha_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS profissao_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_empresa_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS renda_mensal_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS nome_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS rg_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS orgao_emissor_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS cpf_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS email_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS empresa_trabalha_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS profissao_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS tel_empresa_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS renda_mensal_conjuge_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS referencias_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS fonte_midia_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS outros_lotes_pc TEXT;",
-        "ALTER TABLE atendimentos ADD COLUMN IF NOT EXISTS possui_outro_lote TEXT;"
-    ]
-
+    # Conexão avulsa (fora do pool) para não deixar conexões presas no master do gunicorn
+    conn = None
     try:
         conn = psycopg2.connect(DATABASE_URL)
-        conn.autocommit = True
-        cursor = conn.cursor()
-        cursor.execute(create_table_query)
-        for migration in migrations:
-            try:
-                cursor.execute(migration)
-            except Exception:
-                pass 
-        cursor.close()
-        conn.close()
-        logger.info("✅ Banco de dados atualizado.")
+        with conn.cursor() as cur:
+            atual = versao_schema(cur)
+        conn.rollback()
+        if atual >= SCHEMA_VERSAO:
+            return
+        aplicadas = aplicar_migracoes(conn)
+        logger.info(f"✅ Banco de dados atualizado (versão {SCHEMA_VERSAO}, aplicadas: {aplicadas}).")
     except Exception as e:
         logger.error(f"❌ Erro crítico DB: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+@app.cli.command('migrar')
+def migrar_comando():
+    """Aplica as migrações pendentes (flask --app App_Ficha_Atendimento_n8n_Final migrar)."""
+    conn = psycopg2.connect(DATABASE_URL)
+    try:
+        aplicadas = aplicar_migracoes(conn)
+        print(f"Schema na versão {SCHEMA_VERSAO}. Aplicadas agora: {aplicadas or 'nenhuma'}")
+    finally:
+        conn.close()
+
+def ajustar_ao_tipo(valor, tipo):
+    """Valor no formato da coluna (INTEGER ou NUMERIC(p,e)); None se não couber nela, já que um
+    valor fora da faixa abortaria o INSERT da ficha inteira."""
+    if valor is None:
+        return None
+    if tipo == 'INTEGER':
+        if valor != valor.to_integral_value() or abs(valor) > 2 ** 31 - 1:
+            return None
+        return int(valor)
+    precisao, escala = map(int, re.fullmatch(r'NUMERIC\((\d+),(\d+)\)', tipo).groups())
+    if valor.adjusted() >= precisao - escala:
+        return None
+    valor = valor.quantize(decimal.Decimal(1).scaleb(-escala), rounding=decimal.ROUND_HALF_UP)
+    return valor if abs(valor) < 10 ** (precisao - escala) else None  # 9999,999 arredonda para 10000,00
+
+def campos_numericos(campos):
+    """Valores numéricos (colunas <campo>_num) calculados a partir dos textos com máscara."""
+    return {f"{campo}_num": ajustar_ao_tipo(converter_numero_br(campos.get(campo)), tipo)
+            for campo, tipo in CAMPOS_NUMERICOS.items()}
+
+@app.cli.command('backfill-numericos')
+@click.option('--lote', default=1000, help='Fichas por transação.')
+def backfill_numericos_comando(lote):
+    """Preenche as colunas <campo>_num das fichas antigas, em lotes (pode ser interrompido e rodado de novo)."""
+    conn = psycopg2.connect(DATABASE_URL)
+    ultimo_id, total = 0, 0
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(f"""SELECT id, {', '.join(CAMPOS_NUMERICOS)} FROM atendimentos
+                                WHERE id > %s ORDER BY id LIMIT %s""", (ultimo_id, lote))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                valores = []
+                for row in rows:
+                    numericos = campos_numericos(dict(zip(CAMPOS_NUMERICOS, row[1:])))
+                    valores.append((row[0], *numericos.values()))
+                colunas = [f"{campo}_num" for campo in CAMPOS_NUMERICOS]
+                psycopg2.extras.execute_values(cur, f"""
+                    UPDATE atendimentos a SET {', '.join(f'{c} = v.{c}::{CAMPOS_NUMERICOS[c[:-4]]}' for c in colunas)}
+                      FROM (VALUES %s) AS v (id, {', '.join(colunas)})
+                     WHERE a.id = v.id
+                """, valores, page_size=lote)
+            conn.commit()
+            ultimo_id = rows[-1][0]
+            total += len(rows)
+            print(f"{total} fichas processadas (até id {ultimo_id})")
+    finally:
+        conn.close()
 
 init_db()
 
@@ -136,12 +1005,26 @@ HTML_TEMPLATE = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Araguaia Imóveis - Ficha Digital</title>
-    <script src="https://cdn.tailwindcss.com"></script>
-    <link href="https://fonts.googleapis.com/css2?family=Montserrat:wght@400;600;800&display=swap" rel="stylesheet">
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/html2pdf.js/0.10.1/html2pdf.bundle.min.js"></script>
-    <script src="https://cdn.jsdelivr.net/npm/sweetalert2@11"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/jquery/3.6.0/jquery.min.js"></script>
-    <script src="https://cdnjs.cloudflare.com/ajax/libs/jquery.inputmask/5.0.8/jquery.inputmask.min.js"></script>
+    <link rel="manifest" href="/manifest.webmanifest">
+    <meta name="theme-color" content="#263318">
+    {% if estatico('app.css') %}
+    <link rel="stylesheet" href="{{ estatico('app.css') }}">
+    {% else %}
+    <script src="{{ TAILWIND_CDN }}"></script>
+    {% endif %}
+    {% if estatico('fontes/montserrat-400.woff2') %}
+    <link rel="preload" href="{{ estatico('fontes/montserrat-400.woff2') }}" as="font" type="font/woff2" crossorigin>
+    <style>
+        {% for peso in (400, 600, 800) if estatico('fontes/montserrat-%d.woff2' % peso) %}
+        @font-face { font-family: 'Montserrat'; font-style: normal; font-weight: {{ peso }}; font-display: swap; src: url({{ estatico('fontes/montserrat-%d.woff2' % peso) }}) format('woff2'); }
+        {% endfor %}
+    </style>
+    {% else %}
+    <link href="{{ GOOGLE_FONTS_CSS }}" rel="stylesheet">
+    {% endif %}
+    <script src="{{ biblioteca('vendor/sweetalert2.all.min.js') }}"></script>
+    <script src="{{ biblioteca('vendor/jquery.min.js') }}"></script>
+    <script src="{{ biblioteca('vendor/jquery.inputmask.min.js') }}"></script>
     
     <style>
         :root {
@@ -360,6 +1243,7 @@ HTML_TEMPLATE = """
 
             <form id="preAtendimentoForm" class="grid grid-cols-1 md:grid-cols-2 gap-6 md:gap-8">
                 <input type="hidden" id="ficha_id" name="id" value=""> 
+                <input type="hidden" id="chave_idempotencia" name="chave_idempotencia" value="">
     
                 <div class="flex flex-col gap-5">
                     <div><label class="block text-sm font-semibold mb-2 text-white">Nome do Cliente*</label><input type="text" id="nome" name="nome" class="form-input" required></div>
@@ -464,7 +1348,7 @@ HTML_TEMPLATE = """
                              <label class="flex items-center text-white cursor-pointer hover:text-[#8cc63f] transition bg-black/30 p-2 rounded w-full">
                                  <input type="radio" name="possui_outro_lote" value="Sim" class="accent-[#8cc63f] mr-3 scale-125"> 
                                  <span class="font-bold">SIM</span> 
-                                 <span class="text-xs ml-2 opacity-70">(Habilitar cadastro sequencial)</span>
+                                 <span class="text-xs ml-2 opacity-70">(Informar os outros lotes abaixo)</span>
                              </label>
                              <label class="flex items-center text-white cursor-pointer hover:text-[#8cc63f] transition bg-black/30 p-2 rounded w-full">
                                  <input type="radio" name="possui_outro_lote" value="Não" class="accent-[#8cc63f] mr-3 scale-125" checked> 
@@ -484,6 +1368,11 @@ HTML_TEMPLATE = """
                         <div><label class="block text-xs font-semibold mb-1 text-white">VL. Total</label><input type="text" name="vl_total_pc" class="form-input mask-money" inputmode="numeric"></div>
                         <div class="md:col-span-2"><label class="block text-xs font-semibold mb-1 text-white">Corretor (Opcional)</label><input type="text" id="corretor_pc" class="form-input"></div>
                     </div>
+                    <div id="lotesAdicionais" class="hidden mb-3">
+                        <span class="block text-xs font-semibold mb-1 text-white">Outros lotes desta compra:</span>
+                        <div id="listaLotes" class="space-y-2"></div>
+                        <button type="button" id="btnAdicionarLote" class="btn-acao-secundaria hide-on-pdf mt-2">+ Adicionar lote</button>
+                    </div>
                     <div class="mb-3">
                          <label class="block text-xs font-semibold mb-1 text-white">Observação sobre Outros Lotes (Ex: QD 10 LT 11 e 12):</label>
                          <input type="text" name="outros_lotes_pc" class="form-input" placeholder="Caso queira anotar aqui os outros lotes...">
@@ -672,9 +1561,19 @@ HTML_TEMPLATE = """
             // --- INICIALIZAÇÃO DAS MÁSCARAS ---
             $('.mask-phone').inputmask('(99) 99999-9999', { "placeholder": "_" });
             $('.mask-cpf').inputmask('999.999.999-99', { "placeholder": "_" });
-            $('.mask-money').inputmask('currency', {prefix: 'R$ ', groupSeparator: '.', alias: 'numeric', placeholder: '0', autoGroup: true, digits: 2, digitsOptional: false, rightAlign: false});
+            const OPCOES_MOEDA = {prefix: 'R$ ', groupSeparator: '.', alias: 'numeric', placeholder: '0', autoGroup: true, digits: 2, digitsOptional: false, rightAlign: false};
+            $('.mask-money').inputmask('currency', OPCOES_MOEDA);
             $('.mask-cep').inputmask('99999-999');
 
+            // Executa fn uma única vez, quando o elemento entrar na tela
+            function carregarQuandoVisivel(el, fn) {
+                if(!('IntersectionObserver' in window)) return fn();
+                const obs = new IntersectionObserver((entradas) => {
+                    if(entradas.some(e => e.isIntersecting)) { obs.disconnect(); fn(); }
+                });
+                obs.observe(el);
+            }
+
             // --- LÓGICA DE BUSCA DA FICHA (Backend Integration) ---
             $('#btnBuscar').click(async function(){
                 const idFicha = $('#inputBuscarId').val();
@@ -741,23 +1640,38 @@ HTML_TEMPLATE = """
                         });
                     }
 
-                    if(dados.foto_cliente) {
-                        $('#loadedPhoto').attr('src', dados.foto_cliente).removeClass('hidden');
+                    // Mídias vêm por URL e só são baixadas quando aparecem na tela;
+                    // o campo oculto guarda só o hash (reenviado sem o binário)
+                    if(dados.foto_cliente_url) {
+                        const foto = document.getElementById('loadedPhoto');
+                        $(foto).removeClass('hidden');
                         $('#photoCanvas, #videoPreview').addClass('hidden');
-                        $('#foto_cliente_base64').val(dados.foto_cliente);
+                        $('#foto_cliente_base64').val(dados.foto_cliente_hash);
                         $('#clearPhoto').removeClass('hidden');
                         $('#startWebcam').addClass('hidden');
+                        carregarQuandoVisivel(foto, () => { foto.src = dados.foto_cliente_url; });
                     }
 
-                    if(dados.assinatura) {
-                        const img = new Image();
-                        img.onload = function() { ctx.drawImage(img, 0, 0); };
-                        img.src = dados.assinatura;
-                        $('#assinatura_base64').val(dados.assinatura);
+                    if(dados.assinatura_url) {
+                        $('#assinatura_base64').val(dados.assinatura_hash);
+                        assinaturaAlterada = false;
+                        carregarQuandoVisivel(cv, async () => {
+                            const r = await fetch(`${dados.assinatura_url}?formato=tracos`);
+                            if(!r.ok || assinaturaAlterada) return;
+                            if((r.headers.get('Content-Type') || '').includes('json')) return carregarTracos(await r.json());
+                            // Assinatura antiga, gravada como PNG
+                            const img = new Image();
+                            img.onload = function() { if(!assinaturaAlterada) { ctx.drawImage(img, 0, 0); assinaturaLegada = true; } };
+                            img.src = URL.createObjectURL(await r.blob());
+                        });
                     }
 
+                    $('#listaLotes').empty();
+                    (dados.lotes || []).forEach(l => adicionarLote(l));
+
                     toggleP(); 
                     toggleC(); 
+                    toggleLotes();
                     $('#telefone').trigger('input'); 
 
                     Swal.fire({icon: 'success', title: 'Ficha Carregada!', timer: 1500, showConfirmButton: false});
@@ -775,7 +1689,7 @@ HTML_TEMPLATE = """
                 Swal.fire({title: 'Buscando endereço...', didOpen:()=>{Swal.showLoading()}});
                 
                 try {
-                    const res = await fetch(`https://brasilapi.com.br/api/cep/v1/${cep}`);
+                    const res = await fetch(`/cep/${cep}`);
                     if(!res.ok) throw new Error('CEP não encontrado');
                     const data = await res.json();
                     $('[name="endereco_pc"]').val(`${data.street}, ${data.neighborhood}`);
@@ -844,19 +1758,76 @@ HTML_TEMPLATE = """
             }
             selCompra.addEventListener('change', toggleP); 
 
+            // Outros lotes da mesma compra: uma linha por lote, enviadas junto com a ficha em "lotes"
+            const CAMPOS_LOTE = [['quadra_pc', 'QD'], ['lote_pc', 'LT'], ['m2_pc', 'M²'], ['vl_m2_pc', 'VL. M²', true],
+                                 ['vl_total_pc', 'VL. Total', true], ['entrada_forma_pagamento_pc', 'Entrada'], ['vl_parcelas_pc', 'VL. Parcelas', true]];
+            function adicionarLote(valores = {}) {
+                const linha = $('<div class="lote-adicional grid grid-cols-2 md:grid-cols-8 gap-2 items-end"></div>');
+                CAMPOS_LOTE.forEach(([campo, rotulo, dinheiro]) => {
+                    const input = $('<input type="text" class="form-input">').attr('data-campo', campo).val(valores[campo] || '');
+                    linha.append($('<div></div>').append($('<label class="block text-xs font-semibold mb-1 text-white"></label>').text(rotulo), input));
+                    if(dinheiro) input.attr('inputmode', 'numeric').inputmask('currency', OPCOES_MOEDA);
+                });
+                linha.append($('<button type="button" class="btn-acao-secundaria hide-on-pdf mb-2">Remover</button>').click(() => linha.remove()));
+                $('#listaLotes').append(linha);
+            }
+            function lotesAdicionais() {
+                return $('#listaLotes .lote-adicional').map(function() {
+                    const lote = {};
+                    $(this).find('[data-campo]').each(function() { lote[this.dataset.campo] = $(this).val(); });
+                    return lote;
+                }).get();
+            }
+            function toggleLotes() {
+                const multiplo = $('input[name="possui_outro_lote"]:checked').val() === 'Sim';
+                $('#lotesAdicionais').toggleClass('hidden', !multiplo);
+                if(multiplo && !$('#listaLotes .lote-adicional').length) adicionarLote();
+            }
+            $('input[name="possui_outro_lote"]').change(toggleLotes);
+            $('#btnAdicionarLote').click(() => adicionarLote());
+
             // Canvas Assinatura
+            // A assinatura é guardada como traços ([x0, y0, x1, y1, ...] em pixels do canvas), não como PNG
             const cv = document.getElementById('sigCanvas'); const ctx = cv.getContext('2d');
-            let drawing=false;
-            function fitSig(){ cv.width=cv.offsetWidth; cv.height=cv.offsetHeight; ctx.lineWidth=2; ctx.strokeStyle="#fff"; }
+            let drawing=false; let assinaturaAlterada=false; let assinaturaLegada=false;
+            let tracos=[]; let tracoAtual=null;
+            function desenharTracos(){
+                ctx.clearRect(0,0,cv.width,cv.height);
+                tracos.forEach(t => {
+                    ctx.beginPath(); ctx.moveTo(t[0], t[1]);
+                    for(let i=2;i<t.length;i+=2) ctx.lineTo(t[i], t[i+1]);
+                    if(t.length === 2) ctx.lineTo(t[0], t[1]);
+                    ctx.stroke();
+                });
+            }
+            function fitSig(){
+                const w0=cv.width, h0=cv.height;
+                cv.width=cv.offsetWidth; cv.height=cv.offsetHeight; ctx.lineWidth=2; ctx.strokeStyle="#fff"; ctx.lineCap='round'; ctx.lineJoin='round';
+                if(w0 && h0 && cv.width && cv.height) tracos = tracos.map(t => t.map((v,i) => Math.round(v * (i%2 ? cv.height/h0 : cv.width/w0))));
+                desenharTracos();
+            }
+            // Traços vindos do servidor: {w, h, t: [[x0, y0, dx1, dy1, ...]]}, reescalados para o canvas atual
+            function carregarTracos(a){
+                const sx=cv.width/a.w, sy=cv.height/a.h;
+                tracos = a.t.map(t => { let x=0, y=0; const abs=[]; for(let i=0;i<t.length;i+=2){ x+=t[i]; y+=t[i+1]; abs.push(Math.round(x*sx), Math.round(y*sy)); } return abs; });
+                desenharTracos();
+            }
+            const tracosDelta = () => ({w: cv.width, h: cv.height, t: tracos.map(t => t.map((v,i) => i<2 ? v : v - t[i-2]))});
             window.addEventListener('resize', fitSig); fitSig();
-            const getPos=(e)=>{const r=cv.getBoundingClientRect();const t=e.touches?e.touches[0]:e;return{x:t.clientX-r.left,y:t.clientY-r.top}};
-            cv.addEventListener('mousedown',(e)=>{drawing=true;ctx.beginPath();ctx.moveTo(getPos(e).x,getPos(e).y)});
-            cv.addEventListener('mousemove',(e)=>{if(drawing){ctx.lineTo(getPos(e).x,getPos(e).y);ctx.stroke()}});
+            const getPos=(e)=>{const r=cv.getBoundingClientRect();const t=e.touches?e.touches[0]:e;return{x:Math.round(t.clientX-r.left),y:Math.round(t.clientY-r.top)}};
+            function iniciarTraco(e){ const p=getPos(e); drawing=true; assinaturaAlterada=true; tracoAtual=[p.x,p.y]; tracos.push(tracoAtual); ctx.beginPath(); ctx.moveTo(p.x,p.y); }
+            function continuarTraco(e){
+                const p=getPos(e);
+                if(p.x===tracoAtual[tracoAtual.length-2] && p.y===tracoAtual[tracoAtual.length-1]) return;
+                tracoAtual.push(p.x,p.y); ctx.lineTo(p.x,p.y); ctx.stroke();
+            }
+            cv.addEventListener('mousedown',(e)=>iniciarTraco(e));
+            cv.addEventListener('mousemove',(e)=>{if(drawing) continuarTraco(e)});
             cv.addEventListener('mouseup',()=>drawing=false);
-            cv.addEventListener('touchstart',(e)=>{drawing=true;ctx.beginPath();ctx.moveTo(getPos(e).x,getPos(e).y);e.preventDefault()});
-            cv.addEventListener('touchmove',(e)=>{if(drawing){ctx.lineTo(getPos(e).x,getPos(e).y);ctx.stroke();e.preventDefault()}});
+            cv.addEventListener('touchstart',(e)=>{iniciarTraco(e);e.preventDefault()});
+            cv.addEventListener('touchmove',(e)=>{if(drawing){continuarTraco(e);e.preventDefault()}});
             cv.addEventListener('touchend',()=>drawing=false);
-            $('#clearSignature').click(()=>{ ctx.clearRect(0,0,cv.width,cv.height); $('#assinatura_base64').val(''); });
+            $('#clearSignature').click(()=>{ tracos=[]; assinaturaLegada=false; ctx.clearRect(0,0,cv.width,cv.height); $('#assinatura_base64').val(''); assinaturaAlterada=true; });
 
             // Camera
             const v=document.getElementById('videoPreview'); const p=document.getElementById('photoCanvas'); const pc=p.getContext('2d');
@@ -881,7 +1852,34 @@ HTML_TEMPLATE = """
             });
 
             // PDF
-            $('#btnGerarPDF').click(function() {
+            // html2pdf (~900 KB) só é baixado na primeira vez que uma ficha nova vira PDF no navegador
+            let html2pdfCarregando = null;
+            function carregarHtml2pdf() {
+                if(window.html2pdf) return Promise.resolve();
+                if(!html2pdfCarregando) {
+                    html2pdfCarregando = new Promise((resolve, reject) => {
+                        const s = document.createElement('script');
+                        s.src = '{{ biblioteca("vendor/html2pdf.bundle.min.js") }}';
+                        s.onload = resolve;
+                        s.onerror = () => { html2pdfCarregando = null; reject(new Error('html2pdf indisponível')); };
+                        document.head.appendChild(s);
+                    });
+                }
+                return html2pdfCarregando;
+            }
+
+            $('#btnGerarPDF').click(async function() {
+                // Ficha já gravada: PDF vetorial gerado no servidor (rápido e leve); html2pdf só para ficha nova
+                const idFicha = $('#ficha_id').val();
+                if(idFicha) return window.open(`/ficha/${idFicha}/pdf`, '_blank');
+
+                Swal.fire({title: 'Gerando PDF...', html: 'Aguarde...', allowOutsideClick: false, didOpen: () => { Swal.showLoading() }});
+                try {
+                    await carregarHtml2pdf();
+                } catch(err) {
+                    return Swal.fire('Erro', 'Não foi possível carregar o gerador de PDF. Verifique a conexão.', 'error');
+                }
+
                 const element = document.getElementById('fichaContainer');
                 const uiElements = $('.btn-area, .search-container, #photoContainer button, #clearSignature, #startWebcam, #takePhoto, #clearPhoto, .hide-on-pdf');
                 
@@ -910,8 +1908,6 @@ HTML_TEMPLATE = """
                     pagebreak:    { mode: ['avoid-all', 'css', 'legacy'] } 
                 };
 
-                Swal.fire({title: 'Gerando PDF...', html: 'Aguarde...', allowOutsideClick: false, didOpen: () => { Swal.showLoading() }});
-
                 html2pdf().set(opt).from(element).save().then(function() {
                     $(element).removeClass('pdf-mode');
                     $('#pdfHeader').addClass('hidden');
@@ -946,7 +1942,9 @@ HTML_TEMPLATE = """
                     return;
                 }
 
-                $('#assinatura_base64').val(cv.toDataURL());
+                // Assinatura carregada e não mexida: mantém o hash. Alterada: vai como traços (ou PNG se
+                // foi desenhada por cima de uma assinatura antiga em imagem)
+                if(assinaturaAlterada) $('#assinatura_base64').val(assinaturaLegada ? cv.toDataURL() : '');
                 Swal.fire({title:'Salvando...', allowOutsideClick:false, didOpen:()=>{Swal.showLoading()}});
                 
                 const fd = new FormData(this); const d = {}; fd.forEach((v,k)=>d[k]=v);
@@ -961,49 +1959,147 @@ HTML_TEMPLATE = """
                 d.esteve_plantao = $('input[name="esteve_plantao"]:checked').val() === 'sim' ? 1 : 0;
                 d.foi_atendido = $('input[name="foi_atendido"]:checked').val() === 'sim' ? 1 : 0;
                 d.autoriza_transmissao = $('input[name="autoriza_transmissao"]:checked').val() === 'sim' ? 1 : 0;
+                if(assinaturaAlterada && !assinaturaLegada && tracos.length) d.assinatura_tracos = tracosDelta();
                 
                 // --- LÓGICA DE MÚLTIPLOS LOTES ---
                 const isMultiplo = $('input[name="possui_outro_lote"]:checked').val() === 'Sim';
+                d.lotes = isMultiplo ? lotesAdicionais() : [];
+
+                // Mesma chave em todas as tentativas desta ficha: o servidor não duplica em caso de reenvio
+                if(!d.id && !d.chave_idempotencia) d.chave_idempotencia = novoUuid();
+                $('#chave_idempotencia').val(d.chave_idempotencia || '');
+
+                let res;
+                try {
+                    if(!navigator.onLine) throw new TypeError('offline');
+                    const r = await postarComRetentativa('/', await montarEnvio(d));
+                    res = await r.json();
+                } catch(err) {
+                    // Sem sinal (fetch falhou na rede): guarda a ficha completa no aparelho
+                    if(!(err instanceof TypeError)) return Swal.fire('Erro', err.message, 'error');
+                    try {
+                        await filaAdicionar({...d, uuid: d.chave_idempotencia});
+                        res = {success: true, offline: true};
+                    } catch(e) {
+                        return Swal.fire('Erro', 'Sem conexão e não foi possível guardar a ficha no aparelho.', 'error');
+                    }
+                }
 
                 try {
-                    const r = await fetch('/', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify(d)});
-                    const res = await r.json();
-                    
                     if(res.success){
-                        
-                        // LÓGICA NOVA: Se for múltiplo, oferece limpar apenas o lote
-                        if(isMultiplo) {
-                             Swal.fire({
-                                title: 'Ficha Salva!', 
-                                text: `ID: ${res.ticket_id}. Deseja manter os dados do cliente para cadastrar o PRÓXIMO LOTE?`, 
-                                icon: 'success',
-                                showCancelButton: true,
-                                confirmButtonText: 'Sim, Próximo Lote',
-                                cancelButtonText: 'Não, Finalizar',
-                                confirmButtonColor: '#8cc63f'
-                             }).then((result) => {
-                                if (result.isConfirmed) {
-                                    // Limpa apenas os dados do lote para nova inserção
-                                    $('#ficha_id').val(''); // Garante novo ID
-                                    $('[name="quadra_pc"], [name="lote_pc"], [name="m2_pc"], [name="vl_m2_pc"], [name="vl_total_pc"]').val('');
-                                    $('[name="entrada_forma_pagamento_pc"], [name="vl_parcelas_pc"]').val('');
-                                    // Rola a tela até a parte do imóvel
-                                    document.getElementById('preContratoSection').scrollIntoView({ behavior: 'smooth' });
-                                } else {
-                                    window.location.reload();
-                                }
-                             });
-                        } else {
-                             Swal.fire('Sucesso!', `Ficha Salva! ID: ${res.ticket_id}`, 'success').then(()=>{
-                                window.location.reload();
-                            });
-                        }
+                        $('#chave_idempotencia').val(''); // próxima ficha ganha chave nova
+                        const rotulo = res.offline ? 'Sem sinal: a ficha ficou guardada no aparelho e será enviada automaticamente.' : `ID: ${res.ticket_id}.`;
+                        // Todos os lotes vão na mesma ficha (um único envio)
+                        const qtdLotes = isMultiplo ? ` (${d.lotes.length + 1} lotes)` : '';
+                        Swal.fire('Sucesso!', `Ficha Salva${qtdLotes}! ${rotulo}`, 'success').then(()=>{
+                            window.location.reload();
+                        });
 
                     } else throw new Error(res.message);
                 } catch(err) {
                     Swal.fire('Erro', err.message, 'error');
                 }
             });
+
+            // --- MODO OFFLINE (fila no IndexedDB + sincronização em lote) ---
+            function filaAbrir() {
+                return new Promise((ok, falha) => {
+                    const req = indexedDB.open('araguaia_fichas', 1);
+                    req.onupgradeneeded = () => req.result.createObjectStore('fila', {keyPath: 'uuid'});
+                    req.onsuccess = () => ok(req.result);
+                    req.onerror = () => falha(req.error);
+                });
+            }
+            async function filaOperacao(modo, fn) {
+                const db = await filaAbrir();
+                return new Promise((ok, falha) => {
+                    const tx = db.transaction('fila', modo);
+                    const req = fn(tx.objectStore('fila'));
+                    tx.oncomplete = () => ok(req && req.result);
+                    tx.onerror = () => falha(tx.error);
+                });
+            }
+            function novoUuid() {
+                if(window.crypto && crypto.randomUUID) return crypto.randomUUID();
+                return `${Date.now()}-${Math.random().toString(16).slice(2)}`;
+            }
+            const filaAdicionar = (d) => filaOperacao('readwrite', st => st.put({...d, uuid: d.uuid || novoUuid(), capturado_em: new Date().toISOString()}));
+            const filaListar = () => filaOperacao('readonly', st => st.getAll());
+            const filaRemover = (uuid) => filaOperacao('readwrite', st => st.delete(uuid));
+
+            // Foto/assinatura novas vão como arquivo (multipart), sem base64: envio ~25% menor e o servidor
+            // não precisa ler a mídia para a memória. Sem mídia nova, continua JSON.
+            async function montarEnvio(d) {
+                const partes = {foto_cliente: 'foto_cliente_base64', assinatura: 'assinatura_base64'};
+                const novas = Object.keys(partes).filter(p => String(d[partes[p]] || '').startsWith('data:'));
+                if(!novas.length || !window.FormData) return d;
+                const dados = {...d};
+                novas.forEach(p => delete dados[partes[p]]);
+                const form = new FormData();
+                form.append('dados', JSON.stringify(dados));
+                for(const p of novas) {
+                    const blob = await (await fetch(d[partes[p]])).blob();
+                    form.append(p, blob, `${p}.${blob.type.split('/')[1] || 'bin'}`);
+                }
+                return form;
+            }
+
+            // POST com tempo limite e novas tentativas (1s, 2s, 4s) em falha de rede.
+            // Seguro porque a ficha nova leva chave de idempotência.
+            async function postarComRetentativa(url, corpo, tentativas = 4, limiteMs = 20000) {
+                // FormData: o navegador monta o Content-Type com o boundary do multipart
+                const envio = corpo instanceof FormData ? {body: corpo} : {headers: {'Content-Type': 'application/json'}, body: JSON.stringify(corpo)};
+                for(let i = 0; ; i++) {
+                    const ctrl = new AbortController();
+                    const timer = setTimeout(() => ctrl.abort(), limiteMs);
+                    try {
+                        return await fetch(url, {method:'POST', ...envio, signal: ctrl.signal});
+                    } catch(err) {
+                        if(i + 1 >= tentativas) throw new TypeError('Falha de rede');
+                        await new Promise(r => setTimeout(r, 1000 * 2 ** i));
+                    } finally {
+                        clearTimeout(timer);
+                    }
+                }
+            }
+
+            let sincronizando = false;
+            async function sincronizarFila() {
+                if(sincronizando || !navigator.onLine || !window.indexedDB) return;
+                sincronizando = true;
+                try {
+                    const pendentes = await filaListar();
+                    let enviadas = 0, recusadas = 0;
+                    // Lotes pequenos (até 10 fichas e metade do JSON_MAX_BYTES): cada ficha pode carregar foto e assinatura
+                    const lotes = [];
+                    let lote = [], tamanho = 0;
+                    for(const ficha of pendentes) {
+                        const t = JSON.stringify(ficha).length;
+                        if(lote.length && (lote.length >= 10 || tamanho + t > {{ json_max_bytes // 2 }})) { lotes.push(lote); lote = []; tamanho = 0; }
+                        lote.push(ficha);
+                        tamanho += t;
+                    }
+                    if(lote.length) lotes.push(lote);
+                    for(const fichas of lotes) {
+                        const r = await fetch('/sincronizar', {method:'POST', headers:{'Content-Type':'application/json'}, body:JSON.stringify({fichas})});
+                        if(!r.ok) break;
+                        const res = await r.json();
+                        for(const item of res.resultados) {
+                            if(item.success) { await filaRemover(item.uuid); enviadas++; } else recusadas++;
+                        }
+                    }
+                    if(enviadas) Swal.fire({toast: true, position: 'top-end', icon: 'success', title: `${enviadas} ficha(s) guardada(s) no aparelho foram enviadas.`, timer: 4000, showConfirmButton: false});
+                    if(recusadas) console.warn(`${recusadas} ficha(s) da fila foram recusadas pelo servidor e continuam no aparelho.`);
+                } catch(e) {
+                    console.warn('Sincronização adiada:', e);
+                } finally {
+                    sincronizando = false;
+                }
+            }
+            window.addEventListener('online', sincronizarFila);
+            sincronizarFila();
+
+            if('serviceWorker' in navigator) navigator.serviceWorker.register('/sw.js').catch(e => console.warn('Service worker:', e));
         });
     </script>
 </body>
@@ -1020,6 +2116,1165 @@ def formatar_telefone_n8n(telefone_bruto):
     except:
         return None
 
+class CacheTTL:
+    """Cache LRU em memória com expiração por item. Thread-safe."""
+
+    def __init__(self, ttl, max_itens=128):
+        self.ttl = ttl
+        self.max_itens = max_itens
+        self._itens = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira < time.monotonic():
+                del self._itens[chave]
+                return None
+            self._itens.move_to_end(chave)
+            return valor
+
+    def set(self, chave, valor):
+        with self._lock:
+            self._itens[chave] = (time.monotonic() + self.ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+
+# --- MÍDIAS (FOTO / ASSINATURA) ---
+# Os data URLs base64 do front são decodificados uma vez e gravados por hash (sha256) na tabela midias;
+# a ficha guarda só a referência. MIDIA_DIR opcional move os bytes para disco.
+MIDIA_DIR = os.environ.get("MIDIA_DIR")
+_RE_DATA_URL = re.compile(r'^data:([\w.+-]+/[\w.+-]+);base64,')
+_RE_HASH = re.compile(r'^[0-9a-f]{64}$')
+# Só PNG/JPEG (o que o canvas do front gera), e os primeiros bytes têm de ser do tipo declarado: a mídia é
+# servida de volta com esse mimetype, então um "data:text/html" gravado viraria página no domínio do app.
+MIDIA_TIPOS = {'image/png': b'\x89PNG\r\n\x1a\n', 'image/jpeg': b'\xff\xd8\xff'}
+
+class MidiaStoreBanco:
+    """Guarda o binário na coluna bytea da própria tabela midias."""
+
+    def salvar(self, cur, hash_midia, mimetype, dados, miniatura_hash=None):
+        cur.execute(
+            "INSERT INTO midias (hash, mimetype, tamanho, conteudo, miniatura_hash) VALUES (%s, %s, %s, %s, %s) "
+            "ON CONFLICT (hash) DO NOTHING",
+            (hash_midia, mimetype, len(dados), psycopg2.Binary(dados), miniatura_hash))
+
+    def salvar_arquivo(self, cur, hash_midia, mimetype, arquivo, miniatura_hash=None):
+        # o bytea precisa do conteúdo inteiro: só aqui o arquivo é lido para a memória
+        cur.execute("SELECT 1 FROM midias WHERE hash = %s", (hash_midia,))
+        if cur.fetchone() is None:
+            self.salvar(cur, hash_midia, mimetype, arquivo.read(), miniatura_hash)
+
+    def carregar(self, cur, hash_midia):
+        cur.execute("SELECT mimetype, conteudo FROM midias WHERE hash = %s", (hash_midia,))
+        row = cur.fetchone()
+        if not row or row[1] is None:
+            return None
+        return row[0], bytes(row[1])
+
+class MidiaStoreArquivos:
+    """Guarda o binário em disco (MIDIA_DIR/ab/abcdef...); o banco mantém só os metadados."""
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+
+    def _caminho(self, hash_midia):
+        return os.path.join(self.raiz, hash_midia[:2], hash_midia)
+
+    def salvar(self, cur, hash_midia, mimetype, dados, miniatura_hash=None):
+        caminho = self._caminho(hash_midia)
+        if not os.path.exists(caminho):
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            tmp = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(dados)
+            os.replace(tmp, caminho)
+        cur.execute(
+            "INSERT INTO midias (hash, mimetype, tamanho, miniatura_hash) VALUES (%s, %s, %s, %s) ON CONFLICT (hash) DO NOTHING",
+            (hash_midia, mimetype, len(dados), miniatura_hash))
+
+    def salvar_arquivo(self, cur, hash_midia, mimetype, arquivo, miniatura_hash=None):
+        """Como salvar, mas copiando de um arquivo aberto em pedaços (upload multipart)."""
+        caminho = self._caminho(hash_midia)
+        if not os.path.exists(caminho):
+            os.makedirs(os.path.dirname(caminho), exist_ok=True)
+            tmp = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                shutil.copyfileobj(arquivo, f)
+            os.replace(tmp, caminho)
+        arquivo.seek(0, os.SEEK_END)
+        cur.execute(
+            "INSERT INTO midias (hash, mimetype, tamanho, miniatura_hash) VALUES (%s, %s, %s, %s) ON CONFLICT (hash) DO NOTHING",
+            (hash_midia, mimetype, arquivo.tell(), miniatura_hash))
+
+    def carregar(self, cur, hash_midia):
+        cur.execute("SELECT mimetype, conteudo FROM midias WHERE hash = %s", (hash_midia,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        if row[1] is not None:  # mídia gravada antes de trocar para disco
+            return row[0], bytes(row[1])
+        try:
+            with open(self._caminho(hash_midia), 'rb') as f:
+                return row[0], f.read()
+        except FileNotFoundError:
+            return None
+
+MIDIA_STORE = MidiaStoreArquivos(MIDIA_DIR) if MIDIA_DIR else MidiaStoreBanco()
+
+def conferir_tipo_midia(mimetype, inicio):
+    """Levanta ValueError se o tipo não for aceito ou se os bytes iniciais não forem desse formato."""
+    assinatura = MIDIA_TIPOS.get(mimetype)
+    if assinatura is None or not inicio.startswith(assinatura):
+        raise ValueError("Mídia em formato inválido.")
+
+def decodificar_data_url(valor):
+    """'data:image/png;base64,....' -> (mimetype, bytes). Levanta ValueError se não for um data URL válido."""
+    m = _RE_DATA_URL.match(valor)
+    if not m:
+        raise ValueError("Mídia em formato inválido.")
+    try:
+        dados = base64.b64decode(valor[m.end():], validate=True)
+    except binascii.Error:
+        raise ValueError("Mídia em base64 inválido.")
+    mimetype = m.group(1).lower()
+    conferir_tipo_midia(mimetype, dados)
+    return mimetype, dados
+
+MIDIA_MAX_BYTES = int(os.environ.get("MIDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+# Limite do corpo inteiro, aplicado pelo werkzeug enquanto lê: o multipart não chega a gravar no temporário
+# mais do que isso (foto e assinatura de até MIDIA_MAX_BYTES cada).
+REQUISICAO_MAX_BYTES = int(os.environ.get("REQUISICAO_MAX_BYTES", str(64 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = REQUISICAO_MAX_BYTES
+# O JSON (integrações, /sincronizar) é lido inteiro na memória antes do parse: limite próprio, menor.
+# A página monta os envios do /sincronizar para caberem nele.
+JSON_MAX_BYTES = int(os.environ.get("JSON_MAX_BYTES", str(16 * 1024 * 1024)))
+
+@app.errorhandler(RequestEntityTooLarge)
+def envio_grande_demais(e):
+    return jsonify({'success': False, 'message': 'Envio grande demais.'}), 413
+
+def validar_arquivo_midia(arquivo):
+    """Parte de arquivo do multipart -> (mimetype, stream no início). Levanta ValueError se não for PNG/JPEG."""
+    mimetype = (arquivo.mimetype or '').lower()
+    stream = arquivo.stream
+    conferir_tipo_midia(mimetype, stream.read(16))
+    stream.seek(0, os.SEEK_END)
+    tamanho = stream.tell()
+    stream.seek(0)
+    if tamanho > MIDIA_MAX_BYTES:
+        raise ValueError("Mídia muito grande.")
+    return mimetype, stream
+
+def hash_arquivo(stream):
+    """sha256 de um arquivo aberto, lido em pedaços; volta o cursor para o início."""
+    h = hashlib.sha256()
+    for pedaco in iter(lambda: stream.read(1 << 16), b''):
+        h.update(pedaco)
+    stream.seek(0)
+    return h.hexdigest()
+
+# Ingestão da foto: a câmera do tablet manda o quadro inteiro (até 4K) em JPEG com EXIF.
+# A foto é reduzida para FOTO_LADO_MAX, regravada sem metadados e ganha uma miniatura para listagens.
+FOTO_LADO_MAX = int(os.environ.get("FOTO_LADO_MAX", "1600"))
+FOTO_MINIATURA_LADO = int(os.environ.get("FOTO_MINIATURA_LADO", "320"))
+FOTO_QUALIDADE = int(os.environ.get("FOTO_QUALIDADE", "80"))
+# jpeg | webp. O WebP sai ~25% menor, mas custa o dobro de CPU ao salvar (310 ms contra 140 ms numa foto
+# 1920x1080): num servidor de 1 vCPU é o que limita o POST /.
+FOTO_FORMATO = os.environ.get("FOTO_FORMATO", "jpeg").lower()
+IMAGEM_WORKERS = int(os.environ.get("IMAGEM_WORKERS", "2"))
+IMAGEM_TIMEOUT = float(os.environ.get("IMAGEM_TIMEOUT", "30"))
+
+if Image is None:
+    logger.warning("⚠️ Pillow não instalado: fotos serão gravadas sem redução nem miniatura.")
+
+def _codificar_imagem(img, qualidade):
+    buffer = io.BytesIO()
+    if FOTO_FORMATO == 'webp':
+        img.save(buffer, 'WEBP', quality=qualidade, method=4)
+    else:
+        img.save(buffer, 'JPEG', quality=qualidade, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+def normalizar_foto(dados):
+    """Decodifica, corrige a orientação, reduz e regrava (sem EXIF). Devolve (mimetype, foto, miniatura).
+
+    dados pode ser bytes ou um arquivo aberto (upload multipart: o Pillow lê direto do temporário).
+    """
+    with Image.open(dados if hasattr(dados, 'read') else io.BytesIO(dados)) as original:
+        # JPEG: decodifica direto numa escala reduzida (bem mais barato que abrir o 4K inteiro)
+        original.draft('RGB', (FOTO_LADO_MAX, FOTO_LADO_MAX))
+        img = ImageOps.exif_transpose(original)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((FOTO_LADO_MAX, FOTO_LADO_MAX), Image.LANCZOS)
+        foto = _codificar_imagem(img, FOTO_QUALIDADE)
+        img.thumbnail((FOTO_MINIATURA_LADO, FOTO_MINIATURA_LADO), Image.LANCZOS)
+        miniatura = _codificar_imagem(img, min(FOTO_QUALIDADE, 70))
+    return f"image/{FOTO_FORMATO}", foto, miniatura
+
+_executor_imagens = None
+_executor_imagens_pid = None
+_executor_imagens_lock = threading.Lock()
+
+def obter_executor_imagens():
+    """Pool do processo atual para o trabalho de imagem (o Pillow libera o GIL ao decodificar/redimensionar)."""
+    global _executor_imagens, _executor_imagens_pid
+    if _executor_imagens is not None and _executor_imagens_pid == os.getpid():
+        return _executor_imagens
+    with _executor_imagens_lock:
+        if _executor_imagens is None or _executor_imagens_pid != os.getpid():
+            if GEVENT_ATIVO:
+                # threads de verdade: sob gevent as de threading viram greenlets e o Pillow pararia o worker
+                _executor_imagens = gevent.threadpool.ThreadPoolExecutor(max_workers=IMAGEM_WORKERS)
+            else:
+                _executor_imagens = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGEM_WORKERS, thread_name_prefix='imagens')
+            _executor_imagens_pid = os.getpid()
+    return _executor_imagens
+
+def processar_foto(dados):
+    """Roda normalizar_foto no pool, limitando quantas fotos são processadas ao mesmo tempo por worker."""
+    futuro = obter_executor_imagens().submit(normalizar_foto, dados)
+    try:
+        return futuro.result(timeout=IMAGEM_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        raise ValueError("Tempo esgotado ao processar a foto.")
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValueError("Foto em formato não reconhecido.")
+
+MidiaPreparada = collections.namedtuple('MidiaPreparada', 'mimetype dados miniatura')
+
+# campo do dict da ficha -> passa pela ingestão de foto
+CAMPOS_MIDIA = {'foto_cliente_base64': True, 'assinatura_base64': False}
+
+def preparar_midia(valor, foto=False):
+    """Decodifica e valida a mídia vinda do front e, com foto=True (e Pillow instalado), passa a imagem pela
+    ingestão: reduzida, sem EXIF e com miniatura. Vazio, hash existente e mídia já preparada passam direto."""
+    if not valor or isinstance(valor, MidiaPreparada):
+        return valor
+    if isinstance(valor, FileStorage):  # parte de arquivo do multipart: já está num temporário
+        mimetype, dados = validar_arquivo_midia(valor)
+    elif not isinstance(valor, str):
+        raise ValueError("Mídia em formato inválido.")
+    elif _RE_HASH.match(valor):
+        return valor
+    else:
+        mimetype, dados = decodificar_data_url(valor)
+    miniatura = None
+    if foto and Image is not None:
+        mimetype, dados, miniatura = processar_foto(dados)
+    return MidiaPreparada(mimetype, dados, miniatura)
+
+def preparar_midias(data):
+    """Prepara as mídias do dict da ficha antes de pegar a conexão: o Pillow pode levar até IMAGEM_TIMEOUT,
+    e nesse tempo a conexão do pool e a transação ficariam presas esperando."""
+    for campo, foto in CAMPOS_MIDIA.items():
+        if campo == 'assinatura_base64' and data.get('assinatura_tracos'):
+            continue  # salvar_ficha usa os traços e ignora o PNG
+        if data.get(campo):
+            data[campo] = preparar_midia(data[campo], foto)
+
+def resolver_midia(cur, valor, foto=False):
+    """Converte o valor vindo do front em hash: mídia nova é gravada; hash existente é mantido.
+    O ideal é chegar aqui já preparada (preparar_midias), fora da transação."""
+    if not valor:
+        return None
+    if isinstance(valor, str) and _RE_HASH.match(valor):
+        # ficha reenviada sem trocar a mídia; um hash que não existe viraria erro de FK no INSERT
+        cur.execute("SELECT 1 FROM midias WHERE hash = %s", (valor,))
+        if cur.fetchone() is None:
+            raise ValueError("Mídia não encontrada.")
+        return valor
+    mimetype, dados, miniatura = preparar_midia(valor, foto)
+    miniatura_hash = None
+    if miniatura is not None:
+        miniatura_hash = hashlib.sha256(miniatura).hexdigest()
+        MIDIA_STORE.salvar(cur, miniatura_hash, mimetype, miniatura)
+    if isinstance(dados, bytes):
+        hash_midia = hashlib.sha256(dados).hexdigest()
+        MIDIA_STORE.salvar(cur, hash_midia, mimetype, dados, miniatura_hash)
+    else:
+        hash_midia = hash_arquivo(dados)
+        MIDIA_STORE.salvar_arquivo(cur, hash_midia, mimetype, dados, miniatura_hash)
+    return hash_midia
+
+# --- ASSINATURA VETORIAL ---
+# A assinatura chega como traços ({w, h, t: [[x0, y0, dx1, dy1, ...], ...]}, coordenadas com delta) e é
+# gravada na tabela midias como zlib(versão, w, h, nº de traços, por traço: nº de pontos e as coordenadas),
+# inteiros em varint zigzag. SVG/PNG são desenhados sob demanda e guardados em cache.
+MIMETYPE_TRACOS = 'application/x-assinatura-tracos'
+TRACOS_MAX_LADO = 2000  # o canvas do front tem ~700x200; folga para telas grandes
+TRACOS_MAX_PONTOS = 20000
+ASSINATURA_PNG_MAX_PIXELS = 4_000_000  # w*h*escala² do PNG (RGBA: 16 MB de imagem em memória)
+_RE_COR = re.compile(r'^[0-9a-fA-F]{3}([0-9a-fA-F]{3})?$')
+_cache_assinaturas = CacheTTL(3600, max_itens=256)  # chave inclui o hash: o conteúdo nunca muda
+
+def _zigzag(n):
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+def _dezigzag(n):
+    return n // 2 if n % 2 == 0 else -(n + 1) // 2
+
+def _escrever_varint(saida, n):
+    while n >= 0x80:
+        saida.append((n & 0x7F) | 0x80)
+        n >>= 7
+    saida.append(n)
+
+def _ler_varints(dados):
+    n, deslocamento = 0, 0
+    for byte in dados:
+        n |= (byte & 0x7F) << deslocamento
+        if byte & 0x80:
+            deslocamento += 7
+        else:
+            yield n
+            n, deslocamento = 0, 0
+
+def _inteiro(v):
+    return isinstance(v, int) and not isinstance(v, bool) and abs(v) <= TRACOS_MAX_LADO
+
+def codificar_tracos(assinatura):
+    """Valida os traços enviados pelo front e devolve o binário compacto. Levanta ValueError se inválidos."""
+    w, h, tracos = (assinatura.get(k) for k in ('w', 'h', 't')) if isinstance(assinatura, dict) else (None, None, None)
+    if not (_inteiro(w) and _inteiro(h) and w > 0 and h > 0 and isinstance(tracos, list)
+            and all(isinstance(t, list) and len(t) >= 2 and len(t) % 2 == 0 and all(map(_inteiro, t)) for t in tracos)
+            and sum(len(t) for t in tracos) <= 2 * TRACOS_MAX_PONTOS):
+        raise ValueError('Assinatura em formato inválido.')
+    saida = bytearray([1])
+    for n in (w, h, len(tracos)):
+        _escrever_varint(saida, n)
+    for traco in tracos:
+        _escrever_varint(saida, len(traco) // 2)
+        for v in traco:
+            _escrever_varint(saida, _zigzag(v))
+    return zlib.compress(bytes(saida), 9)
+
+def decodificar_tracos(dados):
+    """Binário gravado -> (w, h, traços com delta), no mesmo formato que o front envia."""
+    bruto = zlib.decompress(dados)
+    if bruto[:1] != b'\x01':
+        raise ValueError('Versão de assinatura desconhecida.')
+    numeros = _ler_varints(bruto[1:])
+    w, h, qtd = next(numeros), next(numeros), next(numeros)
+    tracos = []
+    for _ in range(qtd):
+        pontos = next(numeros)
+        tracos.append([_dezigzag(next(numeros)) for _ in range(2 * pontos)])
+    return w, h, tracos
+
+def pontos_absolutos(traco):
+    x = y = 0
+    pontos = []
+    for i in range(0, len(traco), 2):
+        x += traco[i]
+        y += traco[i + 1]
+        pontos.append((x, y))
+    return pontos
+
+def assinatura_svg(w, h, tracos, cor):
+    # "l" relativo do SVG usa os deltas direto; toque sem arraste vira um ponto (l0 0 com ponta redonda)
+    caminho = ' '.join(f"M{t[0]} {t[1]}l{' '.join(map(str, t[2:])) or '0 0'}" for t in tracos)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {w} {h}" width="{w}" height="{h}">'
+            f'<path d="{caminho}" fill="none" stroke="#{cor}" stroke-width="2" stroke-linecap="round" '
+            f'stroke-linejoin="round"/></svg>').encode('utf-8')
+
+def assinatura_png(w, h, tracos, cor, escala):
+    if w * h * escala * escala > ASSINATURA_PNG_MAX_PIXELS:
+        raise ValueError('Assinatura grande demais para essa escala.')
+    img = Image.new('RGBA', (w * escala, h * escala), (0, 0, 0, 0))
+    desenho = ImageDraw.Draw(img)
+    rgb, raio = ImageColor.getrgb(f"#{cor}"), escala
+    for traco in tracos:
+        pontos = [(x * escala, y * escala) for x, y in pontos_absolutos(traco)]
+        if len(pontos) > 1:
+            desenho.line(pontos, fill=rgb, width=2 * escala, joint='curve')
+        for x, y in (pontos[0], pontos[-1]):  # pontas redondas, como no canvas
+            desenho.ellipse((x - raio, y - raio, x + raio, y + raio), fill=rgb)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+def variante_assinatura(args):
+    """(formato, cor, escala) pedidos na query string: ?formato=svg|png|tracos&cor=000&escala=1..4."""
+    formato = args.get('formato', 'svg')
+    cor = args.get('cor', '000')
+    try:
+        escala = int(args.get('escala', 1))
+    except ValueError:
+        escala = 0
+    if formato not in ('svg', 'png', 'tracos') or not _RE_COR.match(cor) or not 1 <= escala <= 4:
+        raise ValueError('Parâmetros de assinatura inválidos.')
+    if formato == 'png' and Image is None:
+        raise ValueError('Assinatura em PNG indisponível (Pillow não instalado).')
+    return formato, cor.lower(), escala
+
+def renderizar_assinatura(hash_midia, dados, variante):
+    """(mimetype, bytes) da assinatura vetorial no formato pedido, com cache por (hash, variante)."""
+    chave = (hash_midia,) + variante
+    pronto = _cache_assinaturas.get(chave)
+    if pronto is None:
+        formato, cor, escala = variante
+        w, h, tracos = decodificar_tracos(dados)
+        if formato == 'tracos':
+            pronto = ('application/json', json.dumps({'w': w, 'h': h, 't': tracos}, separators=(',', ':')).encode('utf-8'))
+        elif formato == 'png':
+            pronto = ('image/png', assinatura_png(w, h, tracos, cor, escala))
+        else:
+            pronto = ('image/svg+xml', assinatura_svg(w, h, tracos, cor))
+        _cache_assinaturas.set(chave, pronto)
+    return pronto
+
+def salvar_assinatura_tracos(cur, assinatura):
+    dados = codificar_tracos(assinatura)
+    hash_midia = hashlib.sha256(dados).hexdigest()
+    MIDIA_STORE.salvar(cur, hash_midia, MIMETYPE_TRACOS, dados)
+    return hash_midia
+
+@app.cli.command('normalizar-fotos')
+@click.option('--lote', default=50, help='Fotos por transação.')
+def normalizar_fotos_comando(lote):
+    """Passa pela ingestão as fotos gravadas antes dela (pode ser interrompido e rodado de novo)."""
+    if Image is None:
+        raise click.ClickException("Pillow não instalado.")
+    conn = psycopg2.connect(DATABASE_URL)
+    ultimo_hash, total = '', 0
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute("""SELECT DISTINCT a.foto_cliente_hash FROM atendimentos a
+                                JOIN midias m ON m.hash = a.foto_cliente_hash
+                               WHERE m.miniatura_hash IS NULL AND a.foto_cliente_hash > %s
+                               ORDER BY 1 LIMIT %s""", (ultimo_hash, lote))
+                hashes = [r[0] for r in cur.fetchall()]
+                if not hashes:
+                    break
+                for antigo in hashes:
+                    midia = MIDIA_STORE.carregar(cur, antigo)
+                    try:
+                        mimetype, dados, miniatura = normalizar_foto(midia[1]) if midia else (None, None, None)
+                    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+                        logger.warning(f"Foto {antigo} ignorada: {e}")
+                        continue
+                    if dados is None:
+                        continue
+                    miniatura_hash = hashlib.sha256(miniatura).hexdigest()
+                    novo = hashlib.sha256(dados).hexdigest()
+                    MIDIA_STORE.salvar(cur, miniatura_hash, mimetype, miniatura)
+                    MIDIA_STORE.salvar(cur, novo, mimetype, dados, miniatura_hash)
+                    cur.execute("UPDATE atendimentos SET foto_cliente_hash = %s WHERE foto_cliente_hash = %s", (novo, antigo))
+                    total += 1
+            conn.commit()
+            ultimo_hash = hashes[-1]
+            print(f"{total} fotos normalizadas")
+    finally:
+        conn.close()
+
+def responder_midia(hash_midia):
+    """Serve foto, miniatura ou assinatura pelo hash do conteúdo. Ao contrário do id sequencial da ficha, a URL
+    não dá para adivinhar nem percorrer; e o conteúdo de uma URL nunca muda, então vai para cache longo."""
+    if not _RE_HASH.match(hash_midia):
+        return jsonify({}), 404
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    try:
+        # Assinatura vetorial: formato/cor/escala entram no ETag (cada variante tem o seu)
+        variante = variante_assinatura(request.args)
+        etag = f"{hash_midia}.{'.'.join(map(str, variante))}"
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            midia = _cache_assinaturas.get((hash_midia,) + variante)
+            if not midia:
+                with db_conexao() as conn:
+                    with conn.cursor() as cur:
+                        midia = MIDIA_STORE.carregar(cur, hash_midia)
+                if midia is None:
+                    return jsonify({}), 404
+                if midia[0] == MIMETYPE_TRACOS:
+                    midia = renderizar_assinatura(hash_midia, midia[1], variante)
+                elif midia[0] not in MIDIA_TIPOS and midia[0] != 'image/webp':
+                    # gravada antes da lista de tipos aceitos (webp é a saída da ingestão de fotos):
+                    # vai como download, nunca interpretada pelo navegador
+                    midia = ('application/octet-stream', midia[1])
+            resp = Response(midia[1], mimetype=midia[0])
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+        resp.headers['X-Content-Type-Options'] = 'nosniff'
+        return resp
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erro mídia: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- WEBHOOK N8N (OUTBOX) ---
+# O evento é gravado em webhook_outbox na mesma transação da ficha; uma única thread (no worker que tem o
+# advisory lock DESPACHANTE_LOCK_ID) entrega em segundo plano, com retentativa exponencial e estado "morto"
+# após N8N_MAX_TENTATIVAS.
+DESPACHANTE_LOCK_ID = 73_002_002  # pg_advisory_lock do worker que entrega o webhook
+
+def enfileirar_webhook(cur, evento, payload):
+    """Grava o evento na outbox usando o cursor (e a transação) de quem chamou."""
+    if not N8N_WEBHOOK_URL:
+        return
+    cur.execute("INSERT INTO webhook_outbox (evento, payload) VALUES (%s, %s)",
+                (evento, json.dumps(payload, default=str)))
+    cur.execute("NOTIFY webhook_outbox")  # entregue no commit; vários na mesma transação viram um só
+
+def calcular_backoff(tentativas):
+    espera = min(N8N_BACKOFF_MAX, N8N_BACKOFF_BASE * (2 ** max(tentativas - 1, 0)))
+    return espera * random.uniform(0.8, 1.2)
+
+class DespachanteWebhook:
+    """Drena a webhook_outbox para o n8n com um requests.Session (keep-alive).
+
+    Todo worker cria o seu, mas só entrega o que conseguir o advisory lock numa conexão própria (fora do pool):
+    ele faz LISTEN webhook_outbox e acorda com o NOTIFY de enfileirar_webhook. Os outros tentam o lock a cada
+    N8N_LIDER_ESPERA segundos, sem conexão aberta entre as tentativas; se o worker líder morrer, o lock cai
+    junto com a conexão dele e outro assume."""
+
+    LEASE_FOLGA_SEGUNDOS = 60  # além do pior caso dos POSTs, antes de outro worker poder pegar o evento
+
+    def __init__(self, url, lote=20):
+        self.url = url
+        self.lote = lote
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.session.headers['Content-Type'] = 'application/json'
+        self._parar = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.lider = False
+        self.stats = {'enviados': 0, 'falhas': 0, 'mortos': 0, 'lag_ultimo_s': 0.0, 'lag_max_s': 0.0}
+
+    def iniciar(self):
+        self._thread = threading.Thread(target=self._loop, name='despachante-n8n', daemon=True)
+        self._thread.start()
+        logger.info(f"📮 Despachante do webhook iniciado (pid {os.getpid()})")
+
+    def parar(self):
+        self._parar.set()
+
+    def _loop(self):
+        while not self._parar.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("SELECT pg_try_advisory_lock(%s)", (DESPACHANTE_LOCK_ID,))
+                    self.lider = cur.fetchone()[0]
+                    if self.lider:
+                        cur.execute("LISTEN webhook_outbox")
+                if self.lider:
+                    logger.info(f"📮 Worker {os.getpid()} assumiu a entrega do webhook")
+                    self._entregar(conn)
+            except Exception as e:
+                logger.error(f"Erro despachante n8n: {e}")
+            finally:
+                self.lider = False
+                if conn is not None:
+                    conn.close()
+            self._parar.wait(N8N_LIDER_ESPERA)
+
+    def _entregar(self, conn):
+        """Loop do líder: entrega o que venceu e dorme até a próxima rodada ou um NOTIFY.
+        Sai (e solta o lock) se a conexão do LISTEN cair."""
+        while not self._parar.is_set():
+            try:
+                espera = self.ciclo()
+            except Exception as e:
+                logger.error(f"Erro despachante n8n: {e}")
+                espera = N8N_POLL_INTERVALO
+            if espera > 0 and select.select([conn], [], [], espera)[0]:
+                conn.poll()
+                conn.notifies.clear()
+
+    def ciclo(self):
+        """Entrega o que estiver vencido e devolve quantos segundos dormir até a próxima rodada."""
+        processados = self.processar_lote()
+        return 0 if processados >= self.lote else N8N_POLL_INTERVALO
+
+    _FILTROS_TENTATIVAS = {None: '', True: 'AND tentativas = 0', False: 'AND tentativas > 0'}
+
+    def lease(self, envios):
+        """Segundos que os eventos reservados ficam invisíveis para os outros workers. Cobre `envios` POSTs
+        seguidos esgotando o timeout (que vale para conectar e de novo para a resposta): se o lease vencesse
+        no meio do lote, outro worker reservaria o mesmo evento e o n8n o receberia duas vezes."""
+        return envios * 2 * N8N_TIMEOUT + self.LEASE_FOLGA_SEGUNDOS
+
+    def reservar(self, limite=None, novos=None, envios=None):
+        """Reserva eventos vencidos (SKIP LOCKED: vários workers drenam sem conflito).
+        novos=True só eventos nunca tentados; novos=False só retentativas.
+        envios: quantos POSTs vão entregar a reserva (padrão: um por evento)."""
+        limite = limite or self.lote
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    UPDATE webhook_outbox SET proxima_tentativa = now() + make_interval(secs => %s)
+                     WHERE id IN (SELECT id FROM webhook_outbox
+                                   WHERE status = 'pendente' AND proxima_tentativa <= now() {self._FILTROS_TENTATIVAS[novos]}
+                                   ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+                 RETURNING id, evento, payload, tentativas, criado_em
+                """, (self.lease(envios or limite), limite))
+                return sorted(cur.fetchall())
+
+    def enviar(self, id_evento, evento, payload):
+        """POST de um evento. Devolve None em caso de sucesso ou a mensagem de erro."""
+        try:
+            r = self.session.post(self.url, data=json.dumps(payload), timeout=N8N_TIMEOUT,
+                                  headers={'X-Evento': evento, 'X-Idempotency-Key': str(id_evento)})
+            if r.status_code < 300:
+                return None
+            return f"HTTP {r.status_code}: {r.text[:200]}"
+        except requests.RequestException as e:
+            return str(e)[:500]
+
+    def registrar_resultado(self, cur, id_evento, tentativas, criado_em, erro):
+        if erro is None:
+            cur.execute("UPDATE webhook_outbox SET status = 'enviado', enviado_em = now(), tentativas = %s, ultimo_erro = NULL WHERE id = %s",
+                        (tentativas, id_evento))
+            lag = (datetime.datetime.now(datetime.timezone.utc) - criado_em).total_seconds()
+            with self._lock:
+                self.stats['enviados'] += 1
+                self.stats['lag_ultimo_s'] = round(lag, 3)
+                self.stats['lag_max_s'] = round(max(self.stats['lag_max_s'], lag), 3)
+        elif tentativas >= N8N_MAX_TENTATIVAS:
+            cur.execute("UPDATE webhook_outbox SET status = 'morto', tentativas = %s, ultimo_erro = %s WHERE id = %s",
+                        (tentativas, erro, id_evento))
+            logger.error(f"☠️ Evento {id_evento} descartado após {tentativas} tentativas: {erro}")
+            with self._lock:
+                self.stats['falhas'] += 1
+                self.stats['mortos'] += 1
+        else:
+            cur.execute("UPDATE webhook_outbox SET tentativas = %s, ultimo_erro = %s, proxima_tentativa = now() + make_interval(secs => %s) WHERE id = %s",
+                        (tentativas, erro, calcular_backoff(tentativas), id_evento))
+            logger.warning(f"⚠️ Falha no webhook (evento {id_evento}, tentativa {tentativas}): {erro}")
+            with self._lock:
+                self.stats['falhas'] += 1
+
+    def gravar_resultados(self, resultados):
+        if resultados:
+            with db_conexao() as conn:
+                with conn.cursor() as cur:
+                    for resultado in resultados:
+                        self.registrar_resultado(cur, *resultado)
+
+    def processar_lote(self, novos=None):
+        eventos = self.reservar(novos=novos)
+        self.gravar_resultados([(id_evento, tentativas + 1, criado_em, self.enviar(id_evento, evento, payload))
+                                for id_evento, evento, payload, tentativas, criado_em in eventos])
+        return len(eventos)
+
+    def snapshot(self):
+        with self._lock:
+            dados = dict(self.stats, lider=self.lider)
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT count(*) FILTER (WHERE status = 'pendente'),
+                           count(*) FILTER (WHERE status = 'morto'),
+                           coalesce(extract(epoch FROM now() - min(criado_em) FILTER (WHERE status = 'pendente')), 0)
+                      FROM webhook_outbox WHERE status <> 'enviado'
+                """)
+                pendentes, mortos, idade = cur.fetchone()
+        dados.update({'fila_pendentes': pendentes, 'fila_mortos': mortos, 'pendente_mais_antigo_s': round(float(idade), 3)})
+        return dados
+
+class DespachanteWebhookLote(DespachanteWebhook):
+    """Modo lote: junta até N8N_LOTE_MAX eventos novos (ou o que houver após N8N_LOTE_ESPERA_MS)
+    num único POST gzip com um array JSON. A confirmação continua sendo por evento: se o n8n
+    responder {"resultados": [{"id": ..., "ok": true|false, "erro": "..."}]}, só os que falharam
+    voltam para a fila, e retentativas saem sempre individualmente."""
+
+    def __init__(self, url, lote_max, espera_ms):
+        super().__init__(url, lote=lote_max)
+        self.espera = espera_ms / 1000
+        self.stats['lotes'] = 0
+
+    def ciclo(self):
+        # Retentativas vão uma a uma, para um evento problemático não derrubar o lote inteiro
+        retentados = self.processar_lote(novos=False)
+
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT count(*), coalesce(extract(epoch FROM now() - min(criado_em)), 0)
+                      FROM webhook_outbox
+                     WHERE status = 'pendente' AND proxima_tentativa <= now() AND tentativas = 0
+                """)
+                prontos, idade = cur.fetchone()
+        idade = float(idade)
+        if prontos and (prontos >= self.lote or idade >= self.espera):
+            eventos = self.reservar(novos=True, envios=1)
+            if eventos:
+                self.gravar_resultados(self.enviar_lote(eventos))
+            return 0
+        if prontos:
+            return self.espera - idade
+        return 0 if retentados >= self.lote else N8N_POLL_INTERVALO
+
+    def enviar_lote(self, eventos):
+        corpo = json.dumps([{'id_evento': id_evento, 'evento': evento, 'dados': payload}
+                            for id_evento, evento, payload, _, _ in eventos]).encode('utf-8')
+        confirmacoes = {}
+        try:
+            r = self.session.post(self.url, data=gzip.compress(corpo, 6), timeout=N8N_TIMEOUT,
+                                  headers={'Content-Encoding': 'gzip', 'X-Evento': 'lote', 'X-Lote': str(len(eventos))})
+            if r.status_code >= 300:
+                erro_geral = f"HTTP {r.status_code}: {r.text[:200]}"
+            else:
+                erro_geral = None
+                try:
+                    resposta = r.json()
+                except ValueError:
+                    resposta = None
+                if isinstance(resposta, dict) and isinstance(resposta.get('resultados'), list):
+                    confirmacoes = {str(item.get('id')): item for item in resposta['resultados'] if isinstance(item, dict)}
+                    erro_geral = 'não confirmado no lote'  # vale para quem não aparecer em resultados
+        except requests.RequestException as e:
+            erro_geral = str(e)[:500]
+
+        with self._lock:
+            self.stats['lotes'] += 1
+        resultados = []
+        for id_evento, _, _, tentativas, criado_em in eventos:
+            item = confirmacoes.get(str(id_evento))
+            if item is not None:
+                erro = None if item.get('ok') else str(item.get('erro') or 'recusado pelo n8n')[:500]
+            else:
+                erro = erro_geral
+            resultados.append((id_evento, tentativas + 1, criado_em, erro))
+        return resultados
+
+_despachante = None
+_despachante_pid = None
+_despachante_lock = threading.Lock()
+
+def obter_despachante():
+    """Despachante do processo atual; a thread é criada no worker (threads não sobrevivem ao fork).
+    Sem N8N_WEBHOOK_URL não há despachante nem thread."""
+    global _despachante, _despachante_pid
+    if not (N8N_WEBHOOK_URL and DATABASE_URL):
+        return None
+    if _despachante is not None and _despachante_pid == os.getpid():
+        return _despachante
+    with _despachante_lock:
+        if _despachante is None or _despachante_pid != os.getpid():
+            if N8N_LOTE_MAX > 1:
+                _despachante = DespachanteWebhookLote(N8N_WEBHOOK_URL, N8N_LOTE_MAX, N8N_LOTE_ESPERA_MS)
+            else:
+                _despachante = DespachanteWebhook(N8N_WEBHOOK_URL)
+            _despachante_pid = os.getpid()
+            _despachante.iniciar()
+    return _despachante
+
+# --- CONTEÚDO PRÉ-COMPRIMIDO (ETag / 304 / gzip / brotli) ---
+def modificado_em(*caminhos):
+    """Modificação mais recente entre os arquivos de origem de um conteúdo, para o Last-Modified. Vem do disco,
+    então é a mesma em todos os workers do deploy (a hora da subida de cada worker não seria)."""
+    return datetime.datetime.fromtimestamp(int(max(os.path.getmtime(c) for c in caminhos)), datetime.timezone.utc)
+
+def preparar_conteudo(corpo, mimetype, modificado, comprimir=True):
+    """Calcula uma única vez as variantes comprimidas e o ETag de um conteúdo fixo."""
+    if isinstance(corpo, str):
+        corpo = corpo.encode('utf-8')
+    variantes = {'identity': corpo}
+    if comprimir:
+        variantes['gzip'] = gzip.compress(corpo, 9, mtime=0)
+    if comprimir and brotli is not None:
+        variantes['br'] = brotli.compress(corpo, quality=11)
+    return {
+        'mimetype': mimetype,
+        'variantes': variantes,
+        'hash': hashlib.sha256(corpo).hexdigest()[:20],
+        'last_modified': modificado,
+    }
+
+def escolher_encoding(conteudo):
+    """Escolhe br > gzip > identity conforme o Accept-Encoding do cliente."""
+    aceitos = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in conteudo['variantes'] and aceitos[encoding]:
+            return encoding
+    return 'identity'
+
+def responder_conteudo(conteudo, cache_control='no-cache'):
+    encoding = escolher_encoding(conteudo)
+    # ETag forte por variante: o mesmo corpo comprimido de formas diferentes não é byte-a-byte igual
+    etag = conteudo['hash'] if encoding == 'identity' else f"{conteudo['hash']}-{encoding}"
+    resp = Response(mimetype=conteudo['mimetype'])
+    resp.set_etag(etag)
+    resp.last_modified = conteudo['last_modified']
+    resp.headers['Cache-Control'] = cache_control
+    resp.vary.add('Accept-Encoding')
+
+    nao_modificado = (etag in request.if_none_match) if request.if_none_match else (
+        request.if_modified_since is not None and request.if_modified_since >= conteudo['last_modified'])
+    if nao_modificado:
+        resp.status_code = 304
+        return resp
+
+    resp.set_data(conteudo['variantes'][encoding])
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+    return resp
+
+# --- ARQUIVOS ESTÁTICOS ---
+# CSS (Tailwind pré-compilado), bibliotecas JS e fontes servidos pelo próprio app em /estatico/<hash>/<arquivo>:
+# o hash do conteúdo na URL permite cache imutável de 1 ano. `flask estaticos` baixa as versões fixadas
+# abaixo e compila o CSS; enquanto um arquivo não existe em static/, a página usa o endereço original (CDN).
+ESTATICOS_DIR = os.path.join(app.root_path, 'static')
+BIBLIOTECAS = {
+    'vendor/jquery.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/jquery/3.6.0/jquery.min.js',
+    'vendor/jquery.inputmask.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/jquery.inputmask/5.0.8/jquery.inputmask.min.js',
+    'vendor/sweetalert2.all.min.js': 'https://cdn.jsdelivr.net/npm/sweetalert2@11.10.5/dist/sweetalert2.all.min.js',
+    'vendor/html2pdf.bundle.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/html2pdf.js/0.10.1/html2pdf.bundle.min.js',
+    **{f'fontes/montserrat-{peso}.woff2': f'https://cdn.jsdelivr.net/npm/@fontsource/montserrat@5.0.8/files/montserrat-latin-{peso}-normal.woff2'
+       for peso in (400, 600, 800)},
+}
+TAILWIND_CDN = 'https://cdn.tailwindcss.com'
+GOOGLE_FONTS_CSS = 'https://fonts.googleapis.com/css2?family=Montserrat:wght@400;600;800&display=swap'
+_JA_COMPRIMIDOS = ('.woff2', '.woff', '.png', '.jpg', '.webp')
+
+def indexar_estaticos():
+    """{arquivo relativo: hash} de tudo em static/ (menos as fontes do build em static/src)."""
+    indice = {}
+    for raiz, pastas, arquivos in os.walk(ESTATICOS_DIR):
+        pastas[:] = [p for p in pastas if not (raiz == ESTATICOS_DIR and p == 'src')]
+        for arquivo in arquivos:
+            caminho = os.path.join(raiz, arquivo)
+            nome = os.path.relpath(caminho, ESTATICOS_DIR).replace(os.sep, '/')
+            with open(caminho, 'rb') as f:
+                indice[nome] = hashlib.sha256(f.read()).hexdigest()[:20]
+    return indice
+
+ESTATICOS = indexar_estaticos()
+_estaticos_preparados = {}
+_estaticos_lock = threading.Lock()
+
+def estatico(nome):
+    """URL com impressão digital do arquivo em static/, ou None se ele ainda não foi gerado."""
+    return f"/estatico/{ESTATICOS[nome]}/{nome}" if nome in ESTATICOS else None
+
+def biblioteca(nome):
+    """Cópia local da biblioteca quando existe; senão o endereço original."""
+    return estatico(nome) or BIBLIOTECAS[nome]
+
+app.jinja_env.globals.update(estatico=estatico, biblioteca=biblioteca, TAILWIND_CDN=TAILWIND_CDN, GOOGLE_FONTS_CSS=GOOGLE_FONTS_CSS)
+
+@app.route('/estatico/<versao>/<path:nome>', methods=['GET'])
+def servir_estatico(versao, nome):
+    if nome not in ESTATICOS:
+        return jsonify({}), 404
+    conteudo = _estaticos_preparados.get(nome)
+    if conteudo is None:
+        # Compressão (br/gzip) feita no primeiro pedido de cada arquivo, não na subida do worker
+        with _estaticos_lock:
+            conteudo = _estaticos_preparados.get(nome)
+            if conteudo is None:
+                caminho = os.path.join(ESTATICOS_DIR, nome)
+                with open(caminho, 'rb') as f:
+                    corpo = f.read()
+                mimetype = mimetypes.guess_type(nome)[0] or 'application/octet-stream'
+                conteudo = preparar_conteudo(corpo, mimetype, modificado_em(caminho), comprimir=not nome.endswith(_JA_COMPRIMIDOS))
+                _estaticos_preparados[nome] = conteudo
+    # Hash antigo na URL (página velha em cache): serve o atual, mas sem cache longo
+    cache_control = 'public, max-age=31536000, immutable' if versao == ESTATICOS[nome] else 'no-cache'
+    return responder_conteudo(conteudo, cache_control)
+
+@app.cli.command('estaticos')
+@click.option('--sem-css', is_flag=True, help='Só baixa as bibliotecas, sem compilar o Tailwind.')
+def estaticos_comando(sem_css):
+    """Baixa as bibliotecas/fontes fixadas para static/ e compila o CSS do Tailwind (só as classes usadas).
+
+    Nenhuma falha aqui derruba o build: o arquivo que não for gerado continua vindo da CDN."""
+    for nome, url in BIBLIOTECAS.items():
+        destino = os.path.join(ESTATICOS_DIR, nome)
+        if os.path.exists(destino):
+            continue
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        try:
+            resp = requests.get(url, timeout=60)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️  {nome} não baixado ({e}); a página usa a CDN")
+            continue
+        with open(destino, 'wb') as f:
+            f.write(resp.content)
+        print(f"⬇️  {nome} ({len(resp.content) // 1024} KB)")
+    if sem_css:
+        return
+    # CLI standalone do Tailwind (binário) ou, na falta dele, via npx (Node)
+    tailwind = [shutil.which('tailwindcss')] if shutil.which('tailwindcss') else ['npx', '--yes', 'tailwindcss@3']
+    try:
+        subprocess.run(tailwind + [
+            '-i', os.path.join(ESTATICOS_DIR, 'src', 'app.css'),
+            '-o', os.path.join(ESTATICOS_DIR, 'app.css'),
+            '--content', os.path.abspath(__file__),
+            '--minify',
+        ], check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:  # sem Node/npx no build (ex.: Render só Python)
+        print(f"⚠️  CSS do Tailwind não compilado ({e}); a página usa o Tailwind da CDN")
+        return
+    print("🎨 static/app.css gerado")
+
+# A página só tem listas fixas como parte dinâmica: compila e renderiza uma vez na subida do worker.
+# Ela sai deste arquivo e aponta para os de static/ (hash na URL): muda quando algum deles muda.
+PAGINA_MODIFICADA = modificado_em(__file__, *(os.path.join(ESTATICOS_DIR, nome) for nome in ESTATICOS))
+with app.app_context():
+    PAGINA_INDEX = preparar_conteudo(
+        render_template_string(HTML_TEMPLATE, empreendimentos=OPCOES_EMPREENDIMENTOS, corretores=OPCOES_CORRETORES,
+                               json_max_bytes=JSON_MAX_BYTES),
+        'text/html', PAGINA_MODIFICADA)
+
+# --- GRAVAÇÃO DA FICHA ---
+def montar_campos(data, data_hora=None):
+    """Valida e normaliza o JSON do formulário no dicionário de colunas de atendimentos."""
+    nome = data.get('nome')
+    cidade = data.get('cidade')
+    telefone = formatar_telefone_n8n(data.get('telefone'))
+    
+    if not telefone or not nome:
+        raise ValueError('Dados obrigatórios faltando.')
+
+    # Dicionário de Campos (Incluindo os novos campos de Lotes Extras)
+    campos = {
+        'data_hora': data_hora or datetime.datetime.now(datetime.timezone.utc),
+        'nome': nome, 
+        'telefone': telefone, 
+        'rede_social': data.get('rede_social'),
+        'abordagem_inicial': limpar_texto(data.get('abordagem_inicial')), 
+        'esteve_plantao': to_bool_flag(data.get('esteve_plantao')),
+        'foi_atendido': to_bool_flag(data.get('foi_atendido')),
+        'nome_corretor': data.get('nome_corretor'), # Salva corretor sempre
+        'autoriza_transmissao': to_bool_flag(data.get('autoriza_transmissao')),
+        'cidade': cidade, 
+        'loteamento': data.get('loteamento'),
+        'comprou_1o_lote': data.get('comprou_1o_lote'),
+        'nivel_interesse': data.get('nivel_interesse'),
+        'empreendimento_pc': data.get('empreendimento_pc'),
+        'quadra_pc': data.get('quadra_pc'), 
+        'lote_pc': data.get('lote_pc'),
+        'm2_pc': data.get('m2_pc'), 
+        'vl_m2_pc': data.get('vl_m2_pc'), 
+        'vl_total_pc': data.get('vl_total_pc'),
+        'venda_realizada_pc': data.get('venda_realizada_pc'),
+        'forma_pagamento_pc': data.get('forma_pagamento_pc'),
+        'entrada_forma_pagamento_pc': data.get('entrada_forma_pagamento_pc'),
+        'numero_parcelas_pc': data.get('numero_parcelas_pc'),
+        'vl_parcelas_pc': data.get('vl_parcelas_pc'),
+        'vencimento_parcelas_pc': data.get('vencimento_parcelas_pc'),
+        'nome_proponente_pc': data.get('nome_proponente_pc'),
+        'rg_proponente_pc': data.get('rg_proponente_pc'),
+        'orgao_emissor_proponente_pc': data.get('orgao_emissor_proponente_pc'),
+        'cpf_proponente_pc': data.get('cpf_proponente_pc'),
+        'estado_civil_pc': data.get('estado_civil_pc'),
+        'filhos_pc': data.get('filhos_pc'),
+        'cep_pc': data.get('cep_pc'),
+        'endereco_pc': data.get('endereco_pc'),
+        'tel_residencial_pc': data.get('tel_residencial_pc'),
+        'celular_pc': data.get('celular_pc'), 
+        'email_pc': data.get('email_pc'),
+        'possui_residencia_pc': data.get('possui_residencia_pc'),
+        'valor_aluguel_pc': data.get('valor_aluguel_pc'),
+        'possui_financiamento_pc': data.get('possui_financiamento_pc'),
+        'valor_financiamento_pc': data.get('valor_financiamento_pc'),
+        'empresa_trabalha_pc': data.get('empresa_trabalha_pc'),
+        'profissao_pc': data.get('profissao_pc'), 
+        'tel_empresa_pc': data.get('tel_empresa_pc'),
+        'renda_mensal_pc': data.get('renda_mensal_pc'),
+        'nome_conjuge_pc': data.get('nome_conjuge_pc'),
+        'rg_conjuge_pc': data.get('rg_conjuge_pc'),
+        'orgao_emissor_conjuge_pc': data.get('orgao_emissor_conjuge_pc'),
+        'cpf_conjuge_pc': data.get('cpf_conjuge_pc'),
+        'tel_conjuge_pc': data.get('tel_conjuge_pc'), 
+        'email_conjuge_pc': data.get('email_conjuge_pc'),
+        'empresa_trabalha_conjuge_pc': data.get('empresa_trabalha_conjuge_pc'),
+        'profissao_conjuge_pc': data.get('profissao_conjuge_pc'),
+        'tel_empresa_conjuge_pc': data.get('tel_empresa_conjuge_pc'),
+        'renda_mensal_conjuge_pc': data.get('renda_mensal_conjuge_pc'),
+        'referencias_pc': limpar_texto(data.get('referencias_pc')), 
+        'fonte_midia_pc': data.get('fonte_midia_pc'),
+        'outros_lotes_pc': data.get('outros_lotes_pc'),   # Novo Campo
+        'possui_outro_lote': data.get('possui_outro_lote') # Novo Campo
+    }
+    # Valores/áreas já convertidos para número (somatórios de VGV sem parsear texto)
+    campos.update(campos_numericos(campos))
+    return campos
+
+LOTES_MAX = 20  # lotes adicionais aceitos numa mesma ficha
+
+def montar_lotes(data):
+    """Lotes adicionais (2º em diante) do JSON em 'lotes'. None quando a lista não veio (ficha não mexe neles)."""
+    lotes = data.get('lotes')
+    if lotes is None:
+        return None
+    if not isinstance(lotes, list) or len(lotes) > LOTES_MAX or not all(isinstance(l, dict) for l in lotes):
+        raise ValueError('Lotes em formato inválido.')
+    montados = []
+    for lote in lotes:
+        campos = {campo: lote.get(campo) or None for campo in CAMPOS_LOTE}
+        if not any(campos.values()):
+            continue  # linha deixada em branco na tela
+        campos.update({k: v for k, v in campos_numericos(campos).items() if k in COLUNAS_LOTE})
+        montados.append(campos)
+    return montados
+
+def gravar_lotes(cur, atendimento_id, lotes, substituir=False):
+    """Grava todos os lotes adicionais num único INSERT (execute_values)."""
+    if substituir:
+        cur.execute("DELETE FROM lotes_pc WHERE atendimento_id = %s", (atendimento_id,))
+    if lotes:
+        psycopg2.extras.execute_values(
+            cur, f"INSERT INTO lotes_pc (atendimento_id, ordem, {', '.join(COLUNAS_LOTE)}) VALUES %s",
+            [(atendimento_id, ordem) + tuple(lote[c] for c in COLUNAS_LOTE) for ordem, lote in enumerate(lotes, 2)])
+
+def vincular_cliente(cur, telefone, nome):
+    """Id do cliente (um por telefone), criando-o na primeira ficha."""
+    cur.execute("""
+        INSERT INTO clientes (telefone, nome) VALUES (%s, %s)
+        ON CONFLICT (telefone) DO UPDATE SET atualizado_em = now()
+        RETURNING id
+    """, (telefone, nome))
+    return cur.fetchone()[0]
+
+def ficha_por_chave(cur, chave):
+    cur.execute("SELECT id FROM atendimentos WHERE chave_idempotencia = %s", (chave,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def salvar_ficha(cur, data, data_hora=None):
+    """Insere ou atualiza (se vier 'id') uma ficha no cursor/transação de quem chamou. Devolve o ticket_id."""
+    # --- VERIFICA SE É EDIÇÃO OU NOVO ---
+    record_id = data.get('id')  # Pega o ID do campo hidden se existir
+
+    # Chave gerada pelo tablet para cada ficha nova: uma retentativa devolve o mesmo ID sem gravar de novo
+    chave = str(data.get('chave_idempotencia') or '').strip() or None
+    if chave and len(chave) > 100:
+        raise ValueError('Chave de idempotência inválida.')
+    if chave and not record_id:
+        existente = ficha_por_chave(cur, chave)
+        if existente:
+            logger.info(f"♻️ Reenvio da ficha {existente} ignorado (chave {chave})")
+            return existente
+
+    campos = montar_campos(data, data_hora)
+    lotes = montar_lotes(data)
+    if lotes is not None:
+        campos['vl_total_lotes_num'] = ajustar_ao_tipo(
+            sum(l['vl_total_pc_num'] for l in lotes if l['vl_total_pc_num'] is not None) or None, CAMPOS_NUMERICOS['vl_total_pc'])
+    campos['cliente_id'] = vincular_cliente(cur, campos['telefone'], campos['nome'])
+    ticket_id = None
+
+    # Foto e assinatura vão para a tabela de mídias; a ficha guarda só o hash
+    campos['foto_cliente_hash'] = resolver_midia(cur, data.get('foto_cliente_base64'), foto=True)
+    if data.get('assinatura_tracos'):
+        campos['assinatura_hash'] = salvar_assinatura_tracos(cur, data['assinatura_tracos'])
+    else:
+        campos['assinatura_hash'] = resolver_midia(cur, data.get('assinatura_base64'))
+
+    campos_alterados = None
+    if record_id:
+        # --- LÓGICA DE UPDATE ---
+        # Removemos data_hora do update para não alterar a data de criação original
+        campos_update = campos.copy()
+        del campos_update['data_hora'] 
+
+        # --- SEGURANÇA BACKEND ---
+        # Removemos nome e corretor para impedir alteração via POST após criação (opcional, mas seguro)
+        if 'nome' in campos_update: 
+            del campos_update['nome']
+        if 'nome_corretor' in campos_update: 
+            del campos_update['nome_corretor']
+        # -----------------------------
+
+        # Compara com o que está gravado e só reescreve as colunas que mudaram
+        # (mídias inalteradas chegam como o mesmo hash e nunca são regravadas)
+        cur.execute(f"SELECT {', '.join(campos_update)} FROM atendimentos WHERE id = %s FOR UPDATE", (record_id,))
+        atual = cur.fetchone()
+        if atual is None:
+            raise LookupError("Ficha não encontrada.")
+        campos_alterados = {k: v for (k, v), antigo in zip(campos_update.items(), atual) if v != antigo}
+
+        if campos_alterados:
+            colunas = sorted(campos_alterados)
+            set_clause = ", ".join([f"{key} = ${i}" for i, key in enumerate(colunas, 1)])
+            query = f"UPDATE atendimentos SET {set_clause} WHERE id = ${len(colunas) + 1}"
+            executar_preparado(cur, query, tuple(campos_alterados[k] for k in colunas) + (record_id,))
+            logger.info(f"🔄 Ficha Atualizada! ID: {record_id} ({', '.join(colunas)})")
+        else:
+            logger.info(f"🔄 Ficha sem alterações. ID: {record_id}")
+
+        if lotes is not None:
+            cur.execute(f"SELECT {', '.join(CAMPOS_LOTE)} FROM lotes_pc WHERE atendimento_id = %s ORDER BY ordem", (record_id,))
+            if cur.fetchall() != [tuple(l[c] for c in CAMPOS_LOTE) for l in lotes]:
+                gravar_lotes(cur, record_id, lotes, substituir=True)
+                campos_alterados['lotes'] = lotes
+                logger.info(f"🔄 Lotes adicionais da ficha {record_id} regravados ({len(lotes)})")
+        ticket_id = record_id 
+
+    else:
+        # --- LÓGICA DE INSERT ---
+        cols = list(campos.keys()) + ['chave_idempotencia']
+        vals = list(campos.values()) + [chave]
+        query = (f"INSERT INTO atendimentos ({', '.join(cols)}) VALUES ({', '.join(['%s']*len(cols))}) "
+                 "ON CONFLICT (chave_idempotencia) WHERE chave_idempotencia IS NOT NULL DO NOTHING RETURNING id")
+        cur.execute(query, tuple(vals))
+        row = cur.fetchone()
+        if row is None:
+            # Duas tentativas com a mesma chave chegaram juntas e a outra gravou primeiro
+            return ficha_por_chave(cur, chave)
+        ticket_id = row[0]
+        gravar_lotes(cur, ticket_id, lotes)
+        logger.info(f"✅ Nova Ficha criada! ID: {ticket_id}" + (f" (+{len(lotes)} lotes)" if lotes else ""))
+
+    # Evento para o n8n na mesma transação: só existe se a ficha foi gravada
+    payload = {**campos, 'id': ticket_id}
+    if lotes is not None:
+        payload['lotes'] = lotes
+    if not record_id:
+        enfileirar_webhook(cur, 'ficha_criada', payload)
+    elif campos_alterados:
+        enfileirar_webhook(cur, 'ficha_atualizada', {**payload, 'campos_alterados': sorted(campos_alterados)})
+
+    return ticket_id
+
+# --- ENVIO MULTIPART ---
+# Além do JSON, POST / aceita multipart/form-data: os campos da ficha em JSON na parte "dados" e a foto
+# (e a assinatura antiga em PNG) como arquivos. O werkzeug copia cada arquivo para um temporário enquanto
+# lê o corpo (em memória só até 500 KB), então a mídia nunca vira str base64 nem é copiada para o dict
+# da ficha; o Pillow e o MIDIA_DIR leem direto do temporário. Funciona também com corpo chunked.
+PARTES_MIDIA = {'foto_cliente': 'foto_cliente_base64', 'assinatura': 'assinatura_base64'}
+
+def ler_ficha_multipart():
+    """Monta o mesmo dict do JSON a partir do multipart; as mídias ficam como FileStorage."""
+    try:
+        data = json.loads(request.form.get('dados') or '{}')
+    except ValueError:
+        raise ValueError('Campo "dados" inválido.')
+    if not isinstance(data, dict):
+        raise ValueError('Campo "dados" inválido.')
+    for parte, campo in PARTES_MIDIA.items():
+        arquivo = request.files.get(parte)
+        if arquivo is not None and arquivo.filename is not None:
+            data[campo] = arquivo
+    return data
+
+def ler_json(silent=False):
+    """request.get_json limitado a JSON_MAX_BYTES; corpo chunked maior que o limite vira 413 (o werkzeug só
+    corta a leitura)."""
+    request.max_content_length = min(JSON_MAX_BYTES, REQUISICAO_MAX_BYTES)
+    corpo = request.get_data()
+    if request.content_length is None and request.max_content_length and len(corpo) >= request.max_content_length:
+        raise RequestEntityTooLarge()
+    return request.get_json(silent=silent)
+
 # --- ROTAS ---
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -1028,154 +3283,928 @@ def index():
             return jsonify({'success': False, 'message': 'Banco de dados não configurado.'}), 500
 
         try:
-            data = request.json
-            
-            # --- VERIFICA SE É EDIÇÃO OU NOVO ---
-            record_id = data.get('id')  # Pega o ID do campo hidden se existir
-            
-            nome = data.get('nome')
-            cidade = data.get('cidade')
-            telefone = formatar_telefone_n8n(data.get('telefone'))
-            
-            if not telefone or not nome:
-                return jsonify({'success': False, 'message': 'Dados obrigatórios faltando.'}), 400
-
-            # Dicionário de Campos (Incluindo os novos campos de Lotes Extras)
-            campos = {
-                'data_hora': datetime.datetime.now(datetime.timezone.utc),
-                'nome': nome, 
-                'telefone': telefone, 
-                'rede_social': data.get('rede_social'),
-                'abordagem_inicial': limpar_texto(data.get('abordagem_inicial')), 
-                'esteve_plantao': to_bool_flag(data.get('esteve_plantao')),
-                'foi_atendido': to_bool_flag(data.get('foi_atendido')),
-                'nome_corretor': data.get('nome_corretor'), # Salva corretor sempre
-                'autoriza_transmissao': to_bool_flag(data.get('autoriza_transmissao')),
-                'foto_cliente': data.get('foto_cliente_base64'),
-                'assinatura': data.get('assinatura_base64'),
-                'cidade': cidade, 
-                'loteamento': data.get('loteamento'),
-                'comprou_1o_lote': data.get('comprou_1o_lote'),
-                'nivel_interesse': data.get('nivel_interesse'),
-                'empreendimento_pc': data.get('empreendimento_pc'),
-                'quadra_pc': data.get('quadra_pc'), 
-                'lote_pc': data.get('lote_pc'),
-                'm2_pc': data.get('m2_pc'), 
-                'vl_m2_pc': data.get('vl_m2_pc'), 
-                'vl_total_pc': data.get('vl_total_pc'),
-                'venda_realizada_pc': data.get('venda_realizada_pc'),
-                'forma_pagamento_pc': data.get('forma_pagamento_pc'),
-                'entrada_forma_pagamento_pc': data.get('entrada_forma_pagamento_pc'),
-                'numero_parcelas_pc': data.get('numero_parcelas_pc'),
-                'vl_parcelas_pc': data.get('vl_parcelas_pc'),
-                'vencimento_parcelas_pc': data.get('vencimento_parcelas_pc'),
-                'nome_proponente_pc': data.get('nome_proponente_pc'),
-                'rg_proponente_pc': data.get('rg_proponente_pc'),
-                'orgao_emissor_proponente_pc': data.get('orgao_emissor_proponente_pc'),
-                'cpf_proponente_pc': data.get('cpf_proponente_pc'),
-                'estado_civil_pc': data.get('estado_civil_pc'),
-                'filhos_pc': data.get('filhos_pc'),
-                'cep_pc': data.get('cep_pc'),
-                'endereco_pc': data.get('endereco_pc'),
-                'tel_residencial_pc': data.get('tel_residencial_pc'),
-                'celular_pc': data.get('celular_pc'), 
-                'email_pc': data.get('email_pc'),
-                'possui_residencia_pc': data.get('possui_residencia_pc'),
-                'valor_aluguel_pc': data.get('valor_aluguel_pc'),
-                'possui_financiamento_pc': data.get('possui_financiamento_pc'),
-                'valor_financiamento_pc': data.get('valor_financiamento_pc'),
-                'empresa_trabalha_pc': data.get('empresa_trabalha_pc'),
-                'profissao_pc': data.get('profissao_pc'), 
-                'tel_empresa_pc': data.get('tel_empresa_pc'),
-                'renda_mensal_pc': data.get('renda_mensal_pc'),
-                'nome_conjuge_pc': data.get('nome_conjuge_pc'),
-                'rg_conjuge_pc': data.get('rg_conjuge_pc'),
-                'orgao_emissor_conjuge_pc': data.get('orgao_emissor_conjuge_pc'),
-                'cpf_conjuge_pc': data.get('cpf_conjuge_pc'),
-                'tel_conjuge_pc': data.get('tel_conjuge_pc'), 
-                'email_conjuge_pc': data.get('email_conjuge_pc'),
-                'empresa_trabalha_conjuge_pc': data.get('empresa_trabalha_conjuge_pc'),
-                'profissao_conjuge_pc': data.get('profissao_conjuge_pc'),
-                'tel_empresa_conjuge_pc': data.get('tel_empresa_conjuge_pc'),
-                'renda_mensal_conjuge_pc': data.get('renda_mensal_conjuge_pc'),
-                'referencias_pc': limpar_texto(data.get('referencias_pc')), 
-                'fonte_midia_pc': data.get('fonte_midia_pc'),
-                'outros_lotes_pc': data.get('outros_lotes_pc'),   # Novo Campo
-                'possui_outro_lote': data.get('possui_outro_lote') # Novo Campo
-            }
+            data = ler_ficha_multipart() if request.mimetype == 'multipart/form-data' else ler_json()
+            if request.headers.get('Idempotency-Key'):
+                data['chave_idempotencia'] = request.headers['Idempotency-Key']
+            preparar_midias(data)
 
-            ticket_id = None
-            
-            with psycopg2.connect(DATABASE_URL) as conn:
+            with db_conexao() as conn:
                 with conn.cursor() as cur:
-                    
-                    if record_id:
-                        # --- LÓGICA DE UPDATE ---
-                        # Removemos data_hora do update para não alterar a data de criação original
-                        campos_update = campos.copy()
-                        del campos_update['data_hora'] 
-                        
-                        # --- SEGURANÇA BACKEND ---
-                        # Removemos nome e corretor para impedir alteração via POST após criação (opcional, mas seguro)
-                        if 'nome' in campos_update: 
-                            del campos_update['nome']
-                        if 'nome_corretor' in campos_update: 
-                            del campos_update['nome_corretor']
-                        # -----------------------------
-                        
-                        set_clause = ", ".join([f"{key} = %s" for key in campos_update.keys()])
-                        vals = list(campos_update.values())
-                        vals.append(record_id) # Adiciona o ID no final para o WHERE
-                        
-                        query = f"UPDATE atendimentos SET {set_clause} WHERE id = %s RETURNING id"
-                        cur.execute(query, tuple(vals))
-                        ticket_id = record_id 
-                        logger.info(f"🔄 Ficha Atualizada! ID: {ticket_id}")
-                        
-                    else:
-                        # --- LÓGICA DE INSERT ---
-                        cols = list(campos.keys())
-                        vals = list(campos.values())
-                        query = f"INSERT INTO atendimentos ({', '.join(cols)}) VALUES ({', '.join(['%s']*len(cols))}) RETURNING id"
-                        cur.execute(query, tuple(vals))
-                        ticket_id = cur.fetchone()[0]
-                        logger.info(f"✅ Nova Ficha criada! ID: {ticket_id}")
-
-            if N8N_WEBHOOK_URL:
-                 # Se houver webhook configurado, envia os dados (opcional)
-                 # requests.post(N8N_WEBHOOK_URL, json={**campos, 'id': ticket_id})
-                 pass
+                    ticket_id = salvar_ficha(cur, data)
 
             return jsonify({'success': True, 'ticket_id': ticket_id})
 
+        except RequestEntityTooLarge:
+            raise  # 413 de envio_grande_demais
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        except LookupError as e:
+            return jsonify({'success': False, 'message': str(e)}), 404
         except Exception as e:
             logger.error(f"Erro POST: {e}")
             return jsonify({'success': False, 'message': str(e)}), 500
 
-    return render_template_string(HTML_TEMPLATE, empreendimentos=OPCOES_EMPREENDIMENTOS, corretores=OPCOES_CORRETORES)
+    return responder_conteudo(PAGINA_INDEX)
+
+# --- SINCRONIZAÇÃO OFFLINE ---
+# O front guarda no IndexedDB as fichas feitas sem sinal e envia todas de uma vez quando volta a rede.
+SYNC_MAX_FICHAS = int(os.environ.get("SYNC_MAX_FICHAS", "50"))
+
+def data_captura(valor):
+    """Horário em que a ficha foi preenchida no aparelho (ISO 8601); ignora valores inválidos ou no futuro."""
+    try:
+        capturado = datetime.datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if capturado.tzinfo is None:
+        return None
+    agora = datetime.datetime.now(datetime.timezone.utc)
+    return capturado if capturado <= agora else None
+
+@app.route('/sincronizar', methods=['POST'])
+def sincronizar_fichas():
+    """Grava várias fichas numa transação só, com resultado individual (SAVEPOINT por ficha)."""
+    if not DATABASE_URL:
+        return jsonify({'success': False, 'message': 'Banco de dados não configurado.'}), 500
+    data = ler_json(silent=True) or {}
+    fichas = data.get('fichas')
+    if not isinstance(fichas, list) or not fichas:
+        return jsonify({'success': False, 'message': 'Nenhuma ficha enviada.'}), 400
+    if len(fichas) > SYNC_MAX_FICHAS:
+        return jsonify({'success': False, 'message': f'Máximo de {SYNC_MAX_FICHAS} fichas por envio.'}), 413
+
+    # Fotos tratadas antes de pegar a conexão; mídia inválida reprova só a própria ficha
+    erros_midia = {}
+    for i, item in enumerate(fichas):
+        if isinstance(item, dict):
+            try:
+                preparar_midias(item)
+            except ValueError as e:
+                erros_midia[i] = str(e)
+
+    resultados = []
+    try:
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                for i, item in enumerate(fichas):
+                    resultado = {'uuid': item.get('uuid') if isinstance(item, dict) else None}
+                    cur.execute("SAVEPOINT ficha")
+                    try:
+                        if not isinstance(item, dict):
+                            raise ValueError('Ficha em formato inválido.')
+                        if i in erros_midia:
+                            raise ValueError(erros_midia[i])
+                        # O uuid da fila do aparelho serve de chave de idempotência (reenvio não duplica)
+                        item.setdefault('chave_idempotencia', item.get('uuid'))
+                        resultado['ticket_id'] = salvar_ficha(cur, item, data_captura(item.get('capturado_em')))
+                        resultado.update(success=True, status=200)
+                        cur.execute("RELEASE SAVEPOINT ficha")
+                    except (ValueError, LookupError, psycopg2.DataError, psycopg2.IntegrityError) as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT ficha")
+                        status = 404 if isinstance(e, LookupError) else 400
+                        resultado.update(success=False, status=status, message=str(e))
+                    resultados.append(resultado)
+    except Exception as e:
+        logger.error(f"Erro sincronizar: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+    gravadas = sum(1 for r in resultados if r['success'])
+    logger.info(f"📲 Sincronização: {gravadas}/{len(resultados)} fichas gravadas")
+    return jsonify({'success': True, 'resultados': resultados})
+
+SERVICE_WORKER_JS = """
+// Service worker da Ficha Digital: guarda a página e as bibliotecas para abrir sem sinal.
+const CACHE = 'araguaia-__VERSAO__';
+const ARQUIVOS = __ARQUIVOS__;
+
+self.addEventListener('install', (e) => {
+    e.waitUntil(caches.open(CACHE).then(async (cache) => {
+        await cache.add('/');
+        await Promise.all(ARQUIVOS.map(url => fetch(url, {mode: 'no-cors'}).then(r => cache.put(url, r)).catch(() => null)));
+    }).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', (e) => {
+    e.waitUntil(caches.keys().then(nomes => Promise.all(nomes.filter(n => n !== CACHE).map(n => caches.delete(n))))
+        .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', (e) => {
+    const req = e.request;
+    if (req.method !== 'GET') return;
+    const url = new URL(req.url);
+    if (req.mode === 'navigate' && url.origin === location.origin && url.pathname === '/') {
+        // Página: rede primeiro (versão nova), cache se estiver sem sinal
+        e.respondWith(fetch(req).then(r => {
+            const copia = r.clone();
+            caches.open(CACHE).then(c => c.put('/', copia));
+            return r;
+        }).catch(() => caches.match('/')));
+    } else if (url.origin !== location.origin || url.pathname.startsWith('/estatico/')) {
+        // Bibliotecas, CSS e fontes (locais com hash na URL ou externas): cache primeiro
+        e.respondWith(caches.match(req).then(r => r || fetch(req).then(resp => {
+            const copia = resp.clone();
+            caches.open(CACHE).then(c => c.put(req, copia));
+            return resp;
+        })));
+    }
+});
+"""
+
+MANIFESTO = {
+    'name': 'Araguaia Imóveis - Ficha Digital',
+    'short_name': 'Ficha Araguaia',
+    'start_url': '/',
+    'display': 'standalone',
+    'background_color': '#263318',
+    'theme_color': '#263318',
+    'lang': 'pt-BR',
+}
+
+# Arquivos que o service worker guarda na instalação: os mesmos endereços (locais ou CDN) que a página usa
+ARQUIVOS_SW = [estatico('app.css') or TAILWIND_CDN] + [
+    estatico(f'fontes/montserrat-{peso}.woff2') for peso in (400, 600, 800) if estatico(f'fontes/montserrat-{peso}.woff2')
+] + ([] if estatico('fontes/montserrat-400.woff2') else [GOOGLE_FONTS_CSS]) + [
+    biblioteca(nome) for nome in BIBLIOTECAS if nome.startswith('vendor/')
+]
+
+# O cache do service worker muda junto com a página (versão = hash do HTML)
+CONTEUDO_SW = preparar_conteudo(
+    SERVICE_WORKER_JS.replace('__VERSAO__', PAGINA_INDEX['hash']).replace('__ARQUIVOS__', json.dumps(ARQUIVOS_SW)),
+    'application/javascript', PAGINA_MODIFICADA)
+CONTEUDO_MANIFESTO = preparar_conteudo(json.dumps(MANIFESTO, ensure_ascii=False), 'application/manifest+json', PAGINA_MODIFICADA)
+
+@app.route('/sw.js', methods=['GET'])
+def service_worker():
+    return responder_conteudo(CONTEUDO_SW)
+
+@app.route('/manifest.webmanifest', methods=['GET'])
+def manifesto():
+    return responder_conteudo(CONTEUDO_MANIFESTO, 'public, max-age=86400')
 
 # --- ROTA DE BUSCA DE FICHA ---
+# Projeção padrão do /buscar: só campos escalares. Foto/assinatura saem como URL (/midia/<hash>) + hash.
+COLUNAS_FICHA = [
+    'id', 'data_hora', 'nome', 'telefone', 'rede_social', 'abordagem_inicial', 'esteve_plantao', 'foi_atendido',
+    'nome_corretor', 'autoriza_transmissao', 'cidade', 'loteamento', 'comprou_1o_lote', 'nivel_interesse',
+    'nota_atendimento', 'empreendimento_pc', 'quadra_pc', 'lote_pc', 'm2_pc', 'vl_m2_pc', 'vl_total_pc',
+    'venda_realizada_pc', 'forma_pagamento_pc', 'entrada_forma_pagamento_pc', 'numero_parcelas_pc', 'vl_parcelas_pc',
+    'vencimento_parcelas_pc', 'nome_proponente_pc', 'rg_proponente_pc', 'orgao_emissor_proponente_pc',
+    'cpf_proponente_pc', 'estado_civil_pc', 'filhos_pc', 'cep_pc', 'endereco_pc', 'tel_residencial_pc', 'celular_pc',
+    'email_pc', 'possui_residencia_pc', 'valor_aluguel_pc', 'possui_financiamento_pc', 'valor_financiamento_pc',
+    'empresa_trabalha_pc', 'profissao_pc', 'tel_empresa_pc', 'renda_mensal_pc', 'nome_conjuge_pc', 'rg_conjuge_pc',
+    'orgao_emissor_conjuge_pc', 'cpf_conjuge_pc', 'tel_conjuge_pc', 'email_conjuge_pc', 'empresa_trabalha_conjuge_pc',
+    'profissao_conjuge_pc', 'tel_empresa_conjuge_pc', 'renda_mensal_conjuge_pc', 'referencias_pc', 'fonte_midia_pc',
+    'outros_lotes_pc', 'possui_outro_lote', 'foto_cliente_hash', 'assinatura_hash', 'cliente_id', 'vl_total_lotes_num',
+] + [f"{campo}_num" for campo in CAMPOS_NUMERICOS]
+# coluna de hash -> chave do data URL no ?include=media (e da URL: <chave>_url)
+MIDIAS_FICHA = {'foto_cliente_hash': 'foto_cliente', 'assinatura_hash': 'assinatura'}
+
+def linha_para_json(columns, row):
+    """Monta o dict da linha convertendo datas para string, para o JSON não quebrar."""
+    data = dict(zip(columns, row))
+    for k, v in data.items():
+        if isinstance(v, (datetime.datetime, datetime.date)): data[k] = v.isoformat()
+    return data
+
+def colunas_solicitadas(param_fields, permitidas):
+    """Interpreta ?fields=a,b,c (sempre inclui id). Levanta ValueError para coluna desconhecida."""
+    if not param_fields:
+        return list(permitidas)
+    pedidas = [c.strip() for c in param_fields.split(',') if c.strip()]
+    invalidas = [c for c in pedidas if c not in permitidas]
+    if invalidas:
+        raise ValueError(f"Campos desconhecidos: {', '.join(invalidas)}")
+    return ['id'] + [c for c in pedidas if c != 'id']
+
 @app.route('/buscar/<int:id_ficha>', methods=['GET'])
 def buscar_ficha(id_ficha):
     if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
     try:
-        with psycopg2.connect(DATABASE_URL) as conn:
+        columns = colunas_solicitadas(request.args.get('fields'), COLUNAS_FICHA)
+        incluir_midia = 'media' in request.args.get('include', '').split(',')
+        # Os hashes são sempre lidos (são curtos) para montar as URLs das mídias
+        consulta = columns + [c for c in MIDIAS_FICHA if c not in columns]
+        with db_conexao() as conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT * FROM atendimentos WHERE id = %s", (id_ficha,))
-                if cur.description:
-                    columns = [desc[0] for desc in cur.description]
-                    row = cur.fetchone()
-                    if not row: return jsonify({}), 404
-                    data = dict(zip(columns, row))
-                    # Converte datas para string para o JSON não quebrar
-                    for k, v in data.items():
-                        if isinstance(v, datetime.datetime): data[k] = v.isoformat()
-                    return jsonify(data)
-        return jsonify({}), 404
+                cur.execute(f"SELECT {', '.join(consulta)} FROM atendimentos WHERE id = %s", (id_ficha,))
+                row = cur.fetchone()
+                if not row: return jsonify({}), 404
+                data = linha_para_json(consulta, row)
+                if not request.args.get('fields'):
+                    # Ficha completa: inclui os lotes adicionais para a edição
+                    cur.execute(f"SELECT {', '.join(CAMPOS_LOTE)} FROM lotes_pc WHERE atendimento_id = %s ORDER BY ordem", (id_ficha,))
+                    data['lotes'] = [dict(zip(CAMPOS_LOTE, r)) for r in cur.fetchall()]
+
+                for coluna_hash, chave in MIDIAS_FICHA.items():
+                    hash_midia = data[coluna_hash] if coluna_hash in columns else data.pop(coluna_hash)
+                    data[f"{chave}_url"] = f"/midia/{hash_midia}" if hash_midia else None
+                    if incluir_midia and hash_midia:
+                        # Opt-in: embute o binário como data URL (formato antigo do /buscar)
+                        midia = MIDIA_STORE.carregar(cur, hash_midia)
+                        if midia:
+                            data[chave] = f"data:{midia[0]};base64,{base64.b64encode(midia[1]).decode('ascii')}"
+        return jsonify(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         logger.error(f"Erro Busca: {e}")
         return jsonify({'error': str(e)}), 500
 
+# --- ROTA DE LISTAGEM DE FICHAS ---
+# Projeção enxuta da listagem; ?fields= aceita qualquer coluna de COLUNAS_FICHA
+COLUNAS_LISTAGEM = ['id', 'data_hora', 'nome', 'telefone', 'cidade', 'loteamento', 'nome_corretor',
+                    'nivel_interesse', 'venda_realizada_pc', 'nota_atendimento']
+FILTROS_EXATOS = ['nome_corretor', 'loteamento', 'cidade', 'nivel_interesse', 'venda_realizada_pc']
+LISTAGEM_LIMITE_MAX = 200
+
+def filtros_fichas(args):
+    """Monta o WHERE (com parâmetros) a partir dos filtros da query string. Datas em YYYY-MM-DD, dias de Cuiabá."""
+    condicoes, params = [], []
+    for campo in FILTROS_EXATOS:
+        valor = args.get(campo)
+        if valor:
+            condicoes.append(f"{campo} = %s")
+            params.append(valor)
+    # Meia-noite de Cuiabá como TIMESTAMPTZ: a comparação continua direto em data_hora e usa os índices
+    try:
+        if args.get('de'):
+            condicoes.append("data_hora >= %s::timestamp AT TIME ZONE 'America/Cuiaba'")
+            params.append(datetime.date.fromisoformat(args['de']))
+        if args.get('ate'):
+            condicoes.append("data_hora < %s::timestamp AT TIME ZONE 'America/Cuiaba'")
+            params.append(datetime.date.fromisoformat(args['ate']) + datetime.timedelta(days=1))
+    except ValueError:
+        raise ValueError("Data inválida (use AAAA-MM-DD).")
+    termo = (args.get('q') or '').strip()
+    if termo:
+        # Nome parcial ou pedaço do telefone (índices trigram)
+        digitos = ''.join(filter(str.isdigit, termo))
+        if digitos:
+            condicoes.append("(nome ILIKE %s OR telefone LIKE %s)")
+            params.extend([f"%{termo}%", f"%{digitos}%"])
+        else:
+            condicoes.append("nome ILIKE %s")
+            params.append(f"%{termo}%")
+    return condicoes, params
+
+def codificar_cursor(data_hora, id_ficha):
+    return base64.urlsafe_b64encode(f"{data_hora.isoformat()}|{id_ficha}".encode()).decode().rstrip('=')
+
+def decodificar_cursor(cursor):
+    try:
+        bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        data_hora, id_ficha = bruto.rsplit('|', 1)
+        return datetime.datetime.fromisoformat(data_hora), int(id_ficha)
+    except (ValueError, binascii.Error):
+        raise ValueError("Cursor inválido.")
+
+@app.route('/fichas', methods=['GET'])
+def listar_fichas():
+    """Lista fichas da mais recente para a mais antiga, paginando por (data_hora, id)."""
+    erro = exigir_admin()
+    if erro:
+        return erro
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    try:
+        columns = colunas_solicitadas(request.args.get('fields'), COLUNAS_FICHA) if request.args.get('fields') else COLUNAS_LISTAGEM
+        limite = min(max(int(request.args.get('limite', 50)), 1), LISTAGEM_LIMITE_MAX)
+        condicoes, params = filtros_fichas(request.args)
+        if request.args.get('cursor'):
+            condicoes.append("(data_hora, id) < (%s, %s)")
+            params.extend(decodificar_cursor(request.args['cursor']))
+        # data_hora entra na consulta mesmo fora da projeção, para montar o próximo cursor
+        consulta = columns + ['data_hora'] if 'data_hora' not in columns else columns
+        selecao = list(consulta)
+        incluir_miniatura = 'miniatura' in request.args.get('include', '').split(',')
+        if incluir_miniatura:
+            selecao.append("(SELECT miniatura_hash FROM midias WHERE hash = foto_cliente_hash)")
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT {', '.join(selecao)} FROM atendimentos {where} ORDER BY data_hora DESC, id DESC LIMIT %s",
+                            params + [limite + 1])
+                rows = cur.fetchall()
+        proximo = None
+        if len(rows) > limite:
+            rows = rows[:limite]
+            ultima = dict(zip(consulta, rows[-1]))
+            proximo = codificar_cursor(ultima['data_hora'], ultima['id'])
+        fichas = []
+        for row in rows:
+            data = linha_para_json(consulta, row)
+            if 'data_hora' not in columns: data.pop('data_hora')
+            if incluir_miniatura:
+                h = row[-1]
+                data['foto_miniatura_url'] = f"/midia/{h}" if h else None
+            fichas.append(data)
+        return jsonify({'fichas': fichas, 'proximo_cursor': proximo})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Erro Listagem: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- ROTA DE EXPORTAÇÃO ---
+# Lê com cursor nomeado (server-side) e envia em blocos: memória constante mesmo com centenas de milhares de fichas.
+EXPORT_ITERSIZE = 2000
+# O XLSX não sai em streaming de verdade: a planilha inteira é montada num temporário antes do 1º byte,
+# e a requisição precisa caber no GUNICORN_TIMEOUT. Acima disso, só CSV.
+EXPORT_XLSX_MAX = int(os.environ.get("EXPORT_XLSX_MAX", "20000"))
+COLUNAS_EXPORTACAO = [c for c in COLUNAS_FICHA if c not in MIDIAS_FICHA]
+
+def valor_exportacao(v):
+    if isinstance(v, bool):
+        return 'Sim' if v else 'Não'
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    if isinstance(v, str):
+        return limpar_texto(v)
+    return v
+
+def linhas_exportacao(columns, condicoes, params, incluir_midia):
+    """Gera as linhas (já tratadas) direto do cursor server-side, sem carregar tudo em memória."""
+    consulta = columns + [c for c in MIDIAS_FICHA if incluir_midia and c not in columns]
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+    with db_conexao() as conn:
+        with conn.cursor(name='exportacao_fichas') as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            cur.execute(f"SELECT {', '.join(consulta)} FROM atendimentos {where} ORDER BY data_hora, id", params)
+            for row in cur:
+                linha = [valor_exportacao(v) for v in row[:len(columns)]]
+                if incluir_midia:
+                    dados = dict(zip(consulta, row))
+                    for coluna_hash in MIDIAS_FICHA:
+                        h = dados[coluna_hash]
+                        linha.append(f"{request.host_url.rstrip('/')}/midia/{h}" if h else '')
+                yield linha
+
+def gerar_csv(cabecalho, linhas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer, delimiter=';')
+    buffer.write('\ufeff')  # BOM: o Excel em português abre acentos e ";" corretamente
+    escritor.writerow(cabecalho)
+    for i, linha in enumerate(linhas, 1):
+        escritor.writerow(linha)
+        if i % EXPORT_ITERSIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def gerar_xlsx(cabecalho, linhas):
+    # write_only grava as linhas em arquivos temporários; o .xlsx final é lido do disco em blocos.
+    # Nada é enviado até a planilha estar completa: o tamanho é limitado por EXPORT_XLSX_MAX.
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Fichas')
+    ws.append(cabecalho)
+    for linha in linhas:
+        ws.append(linha)
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            bloco = tmp.read(64 * 1024)
+            if not bloco:
+                break
+            yield bloco
+
+@app.route('/export', methods=['GET'])
+def exportar_fichas():
+    """Exporta as fichas filtradas (mesmos filtros do /fichas) em CSV (padrão) ou XLSX."""
+    erro = exigir_admin()
+    if erro:
+        return erro
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    formato = request.args.get('formato', 'csv').lower()
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({'error': 'Formato inválido (csv ou xlsx).'}), 400
+    if formato == 'xlsx' and openpyxl is None:
+        return jsonify({'error': 'Exportação XLSX indisponível (openpyxl não instalado).'}), 501
+    try:
+        columns = colunas_solicitadas(request.args.get('fields'), COLUNAS_EXPORTACAO)
+        condicoes, params = filtros_fichas(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if formato == 'xlsx':
+        where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT count(*) FROM (SELECT 1 FROM atendimentos {where} LIMIT %s) t",
+                            params + [EXPORT_XLSX_MAX + 1])
+                if cur.fetchone()[0] > EXPORT_XLSX_MAX:
+                    return jsonify({'error': f'Mais de {EXPORT_XLSX_MAX} fichas: a exportação XLSX é limitada. '
+                                             'Use ?formato=csv (sem limite) ou filtre o período.'}), 400
+    incluir_midia = 'media' in request.args.get('include', '').split(',')
+    cabecalho = columns + ([f"{chave}_url" for chave in MIDIAS_FICHA.values()] if incluir_midia else [])
+    linhas = linhas_exportacao(columns, condicoes, params, incluir_midia)
+
+    nome_arquivo = f"fichas_{datetime.date.today().isoformat()}.{formato}"
+    if formato == 'xlsx':
+        corpo, mimetype = gerar_xlsx(cabecalho, linhas), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        corpo, mimetype = gerar_csv(cabecalho, linhas), 'text/csv; charset=utf-8'
+    resp = Response(stream_with_context(corpo), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename="{nome_arquivo}"'
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+# --- PDF DA FICHA ---
+# PDF vetorial gerado no servidor a partir da linha gravada (texto selecionável, assinatura em traços, poucos KB),
+# em vez do html2canvas no tablet. Cache pelo hash do conteúdo: qualquer alteração na ficha gera outro hash.
+PDF_LAYOUT_VERSAO = 1  # incrementar ao mudar o layout (invalida o cache e os ETags)
+PDF_LOTE_MAX = int(os.environ.get("PDF_LOTE_MAX", "200"))
+PDF_FOTO_LADO = 600  # ~35 mm a 300 dpi no lado menor, com folga
+_cache_pdfs = CacheTTL(3600, max_itens=64)
+COLUNAS_PDF = [c for c in COLUNAS_FICHA if not c.endswith('_num') and c != 'cliente_id']
+
+SECOES_PDF = [
+    ('Dados do Cliente', [
+        ('Nome', 'nome'), ('Telefone', 'telefone'), ('Rede social', 'rede_social'), ('Cidade', 'cidade'),
+        ('Loteamento de interesse', 'loteamento'), ('Corretor', 'nome_corretor'), ('Esteve no plantão', 'esteve_plantao'),
+        ('Foi atendido', 'foi_atendido'), ('Nível de interesse', 'nivel_interesse'), ('Comprou o 1º lote', 'comprou_1o_lote'),
+        ('Autoriza transmissão', 'autoriza_transmissao'), ('Nota do atendimento', 'nota_atendimento'),
+        ('Abordagem inicial', 'abordagem_inicial'),
+    ]),
+    ('Dados do Imóvel', [
+        ('Empreendimento', 'empreendimento_pc'), ('QD', 'quadra_pc'), ('LT', 'lote_pc'), ('M²', 'm2_pc'),
+        ('VL. M²', 'vl_m2_pc'), ('VL. Total', 'vl_total_pc'), ('Outros lotes (obs.)', 'outros_lotes_pc'),
+    ]),
+    ('Forma de Pagamento', [
+        ('Venda realizada', 'venda_realizada_pc'), ('Forma de pagamento', 'forma_pagamento_pc'),
+        ('Entrada', 'entrada_forma_pagamento_pc'), ('Nº parcelas', 'numero_parcelas_pc'),
+        ('VL. parcelas', 'vl_parcelas_pc'), ('Vencimento (dia)', 'vencimento_parcelas_pc'),
+    ]),
+    ('Dados do Proponente', [
+        ('Nome', 'nome_proponente_pc'), ('CPF', 'cpf_proponente_pc'), ('RG', 'rg_proponente_pc'),
+        ('Órgão emissor', 'orgao_emissor_proponente_pc'), ('Estado civil', 'estado_civil_pc'), ('Filhos', 'filhos_pc'),
+        ('CEP', 'cep_pc'), ('Endereço', 'endereco_pc'), ('Tel. residencial', 'tel_residencial_pc'), ('Celular', 'celular_pc'),
+        ('E-mail', 'email_pc'), ('Possui residência', 'possui_residencia_pc'), ('Valor aluguel', 'valor_aluguel_pc'),
+        ('Possui financiamento', 'possui_financiamento_pc'), ('Valor financiamento', 'valor_financiamento_pc'),
+        ('Empresa', 'empresa_trabalha_pc'), ('Profissão', 'profissao_pc'), ('Tel. empresa', 'tel_empresa_pc'),
+        ('Renda mensal', 'renda_mensal_pc'),
+    ]),
+    ('Dados do Cônjuge', [
+        ('Nome', 'nome_conjuge_pc'), ('CPF', 'cpf_conjuge_pc'), ('RG', 'rg_conjuge_pc'),
+        ('Órgão emissor', 'orgao_emissor_conjuge_pc'), ('Telefone', 'tel_conjuge_pc'), ('E-mail', 'email_conjuge_pc'),
+        ('Empresa', 'empresa_trabalha_conjuge_pc'), ('Profissão', 'profissao_conjuge_pc'),
+        ('Tel. empresa', 'tel_empresa_conjuge_pc'), ('Renda mensal', 'renda_mensal_conjuge_pc'),
+    ]),
+    ('Referências e Mídia', [('Referências', 'referencias_pc'), ('Como conheceu', 'fonte_midia_pc')]),
+]
+_ROTULOS_LOTE = {'quadra_pc': 'QD', 'lote_pc': 'LT', 'm2_pc': 'M²', 'vl_m2_pc': 'VL. M²', 'vl_total_pc': 'VL. Total',
+                 'entrada_forma_pagamento_pc': 'Entrada', 'vl_parcelas_pc': 'VL. Parcelas'}
+
+def fichas_para_pdf(cur, condicoes, params, limite=None):
+    """Linhas (dicts) das fichas com os lotes adicionais e a data já no fuso de Sorriso/MT."""
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+    cur.execute(f"""SELECT {', '.join(COLUNAS_PDF)}, to_char(data_hora AT TIME ZONE 'America/Cuiaba', 'DD/MM/YYYY HH24:MI')
+                     FROM atendimentos {where} ORDER BY data_hora, id {'LIMIT %s' if limite else ''}""",
+                params + ([limite] if limite else []))
+    fichas = [dict(zip(COLUNAS_PDF, row), data_local=row[-1], lotes=[]) for row in cur.fetchall()]
+    if fichas:
+        por_id = {f['id']: f for f in fichas}
+        cur.execute(f"SELECT atendimento_id, {', '.join(CAMPOS_LOTE)} FROM lotes_pc WHERE atendimento_id = ANY(%s) ORDER BY atendimento_id, ordem",
+                    (list(por_id),))
+        for row in cur.fetchall():
+            por_id[row[0]]['lotes'].append(dict(zip(CAMPOS_LOTE, row[1:])))
+    return fichas
+
+def hash_conteudo_pdf(ficha):
+    # Inclui os hashes da foto e da assinatura: trocar uma delas também muda o PDF
+    return hashlib.sha256(json.dumps([PDF_LAYOUT_VERSAO, ficha], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _valor_pdf(v):
+    if v is None or v == '':
+        return '—'
+    if isinstance(v, bool):
+        return 'Sim' if v else 'Não'
+    return escapar_xml(str(v)).replace('\n', '<br/>')
+
+def _tabela_campos(pares, estilos):
+    """Campos em 4 colunas (rótulo, valor, rótulo, valor)."""
+    celulas = [[Paragraph(f"<b>{escapar_xml(rotulo)}</b>", estilos['rotulo']), Paragraph(valor, estilos['valor'])]
+               for rotulo, valor in pares]
+    if len(celulas) % 2:
+        celulas.append(['', ''])
+    linhas = [celulas[i] + celulas[i + 1] for i in range(0, len(celulas), 2)]
+    tabela = Table(linhas, colWidths=[32 * mm, 58 * mm, 32 * mm, 58 * mm])
+    tabela.setStyle(TableStyle([
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LINEBELOW', (0, 0), (-1, -1), 0.25, colors.lightgrey),
+        ('TOPPADDING', (0, 0), (-1, -1), 2), ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+    ]))
+    return tabela
+
+def _assinatura_pdf(midia, largura):
+    """Assinatura em traços vira desenho vetorial; PNG antigo entra como imagem."""
+    if midia[0] == MIMETYPE_TRACOS:
+        w, h, tracos = decodificar_tracos(midia[1])
+        escala = largura / w
+        desenho = Drawing(largura, h * escala)
+        for traco in tracos:
+            pontos = pontos_absolutos(traco)
+            if len(pontos) == 1:
+                pontos *= 2
+            # PDF tem origem embaixo; o canvas, em cima
+            coords = [c for x, y in pontos for c in (x * escala, (h - y) * escala)]
+            desenho.add(PolyLine(coords, strokeWidth=1.2, strokeColor=colors.black, strokeLineCap=1, strokeLineJoin=1))
+        return desenho
+    w, h = ImageReader(io.BytesIO(midia[1])).getSize()
+    return ImagemPDF(io.BytesIO(midia[1]), width=largura, height=largura * h / w)
+
+def _foto_pdf(dados):
+    """A foto sai com 35 mm de altura: reduzida e em JPEG, o reportlab a embute sem recomprimir (webp/PNG
+    grandes viravam bitmap cru comprimido com zlib, ~1,5 MB e quase 1 s por PDF)."""
+    if Image is None:
+        return dados
+    with Image.open(io.BytesIO(dados)) as img:
+        img = img.convert('RGB')
+        img.thumbnail((PDF_FOTO_LADO, PDF_FOTO_LADO), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+def gerar_pdf_ficha(ficha, foto, assinatura):
+    """PDF (bytes) de uma ficha; foto/assinatura são (mimetype, bytes) ou None."""
+    base = getSampleStyleSheet()
+    estilos = {
+        'titulo': base['Title'], 'secao': base['Heading3'],
+        'rotulo': base['BodyText'].clone('rotulo', fontSize=8, leading=10, textColor=colors.HexColor('#4b5a3a')),
+        'valor': base['BodyText'].clone('valor', fontSize=9, leading=11),
+    }
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=15 * mm, rightMargin=15 * mm, topMargin=12 * mm, bottomMargin=12 * mm,
+                            title=f"Ficha {ficha['id']} - {ficha['nome']}", author='Araguaia Imóveis')
+    partes = [Paragraph(f"Ficha de Atendimento nº {ficha['id']}", estilos['titulo']),
+              Paragraph(f"Araguaia Imóveis — {escapar_xml(ficha['data_local'] or '')}", estilos['valor']), Spacer(1, 4 * mm)]
+    if foto:
+        try:
+            dados = _foto_pdf(foto[1])
+            w, h = ImageReader(io.BytesIO(dados)).getSize()
+            partes += [ImagemPDF(io.BytesIO(dados), width=35 * mm * w / h, height=35 * mm), Spacer(1, 3 * mm)]
+        except Exception as e:  # mídia corrompida não impede o PDF
+            logger.warning(f"Foto da ficha {ficha['id']} fora do PDF: {e}")
+
+    for titulo, campos in SECOES_PDF:
+        pares = [(rotulo, _valor_pdf(ficha.get(coluna))) for rotulo, coluna in campos]
+        if titulo != 'Dados do Cliente' and all(valor == '—' for _, valor in pares):
+            continue  # seção do pré-contrato não preenchida
+        partes += [Paragraph(titulo, estilos['secao']), _tabela_campos(pares, estilos)]
+        if titulo == 'Dados do Imóvel' and ficha['lotes']:
+            linhas = [[_ROTULOS_LOTE[c] for c in CAMPOS_LOTE]] + [[l[c] or '' for c in CAMPOS_LOTE] for l in ficha['lotes']]
+            tabela = Table(linhas, repeatRows=1)
+            tabela.setStyle(TableStyle([
+                ('FONTSIZE', (0, 0), (-1, -1), 8),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+            ]))
+            partes += [Spacer(1, 2 * mm), Paragraph('Outros lotes desta compra', estilos['rotulo']), tabela]
+
+    if assinatura:
+        try:
+            partes += [Spacer(1, 8 * mm), _assinatura_pdf(assinatura, 80 * mm),
+                       Paragraph(f"Assinatura: {escapar_xml(ficha['nome'] or '')}", estilos['rotulo'])]
+        except Exception as e:
+            logger.warning(f"Assinatura da ficha {ficha['id']} fora do PDF: {e}")
+    doc.build(partes)
+    return buffer.getvalue()
+
+def midias_pdf(cur, ficha):
+    """(foto, assinatura) carregadas do MIDIA_STORE para o PDF."""
+    foto = MIDIA_STORE.carregar(cur, ficha['foto_cliente_hash']) if ficha['foto_cliente_hash'] else None
+    assinatura = MIDIA_STORE.carregar(cur, ficha['assinatura_hash']) if ficha['assinatura_hash'] else None
+    return foto, assinatura
+
+def pdf_da_ficha(cur, ficha, hash_conteudo):
+    """PDF da ficha, do cache quando o conteúdo não mudou."""
+    pdf = _cache_pdfs.get(hash_conteudo)
+    if pdf is None:
+        pdf = gerar_pdf_ficha(ficha, *midias_pdf(cur, ficha))
+        _cache_pdfs.set(hash_conteudo, pdf)
+    return pdf
+
+class SaidaZip(io.RawIOBase):
+    """Destino sem seek para o zipfile: guarda o que foi escrito até alguém retirar com blocos()."""
+
+    def __init__(self):
+        self._blocos = []
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self._blocos.append(bytes(dados))
+        return len(dados)
+
+    def blocos(self):
+        blocos, self._blocos = self._blocos, []
+        return blocos
+
+@app.route('/ficha/<int:id_ficha>/pdf', methods=['GET'])
+def pdf_ficha(id_ficha):
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    if SimpleDocTemplate is None:
+        return jsonify({'error': 'PDF indisponível (reportlab não instalado).'}), 501
+    try:
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                fichas = fichas_para_pdf(cur, ["id = %s"], [id_ficha])
+                if not fichas:
+                    return jsonify({}), 404
+                hash_conteudo = hash_conteudo_pdf(fichas[0])
+                if hash_conteudo in request.if_none_match:
+                    resp = Response(status=304)
+                else:
+                    resp = Response(pdf_da_ficha(cur, fichas[0], hash_conteudo), mimetype='application/pdf')
+                    resp.headers['Content-Disposition'] = f'inline; filename="ficha_{id_ficha}.pdf"'
+        resp.set_etag(hash_conteudo)
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+    except Exception as e:
+        logger.error(f"Erro PDF: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/fichas/pdf', methods=['GET'])
+def pdf_fichas_lote():
+    """Zip com o PDF de cada ficha do período (?de=&ate=, obrigatórios; aceita os filtros do /fichas)."""
+    erro = exigir_admin()  # contratos completos de até PDF_LOTE_MAX clientes, e CPU de sobra para desenhá-los
+    if erro:
+        return erro
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    if SimpleDocTemplate is None:
+        return jsonify({'error': 'PDF indisponível (reportlab não instalado).'}), 501
+    if not (request.args.get('de') and request.args.get('ate')):
+        return jsonify({'error': 'Informe o período em ?de=AAAA-MM-DD&ate=AAAA-MM-DD.'}), 400
+    try:
+        condicoes, params = filtros_fichas(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+    try:
+        with db_conexao() as conn:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT id FROM atendimentos {where} ORDER BY data_hora, id LIMIT %s", params + [PDF_LOTE_MAX + 1])
+                ids = [row[0] for row in cur.fetchall()]
+    except Exception as e:
+        logger.error(f"Erro PDF em lote: {e}")
+        return jsonify({'error': str(e)}), 500
+    if len(ids) > PDF_LOTE_MAX:
+        return jsonify({'error': f'Mais de {PDF_LOTE_MAX} fichas no período; reduza o intervalo.'}), 400
+
+    def blocos():
+        # Zip enviado ficha a ficha: cada uma é lida numa consulta curta e desenhada com a conexão já devolvida
+        # ao pool (o reportlab não prende conexão), e o primeiro byte sai antes do último PDF ficar pronto.
+        saida = SaidaZip()
+        with zipfile.ZipFile(saida, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for id_ficha in ids:
+                with db_conexao() as conn:
+                    with conn.cursor() as cur:
+                        fichas = fichas_para_pdf(cur, ["id = %s"], [id_ficha])
+                        if not fichas:  # apagada depois da listagem
+                            continue
+                        hash_conteudo = hash_conteudo_pdf(fichas[0])
+                        pdf = _cache_pdfs.get(hash_conteudo)
+                        midias = None if pdf else midias_pdf(cur, fichas[0])
+                if pdf is None:
+                    pdf = gerar_pdf_ficha(fichas[0], *midias)
+                    _cache_pdfs.set(hash_conteudo, pdf)
+                zf.writestr(f"ficha_{id_ficha}.pdf", pdf)
+                yield from saida.blocos()
+        yield from saida.blocos()
+        logger.info(f"📄 Zip com {len(ids)} PDFs enviado")
+
+    resp = Response(blocos(), mimetype='application/zip')
+    resp.headers['Content-Disposition'] = f'attachment; filename="fichas_{request.args["de"]}_{request.args["ate"]}.zip"'
+    return resp
+
+# --- CONSULTA DE CEP ---
+# Proxy da BrasilAPI: memória do worker (LRU + TTL) -> tabela cep_cache -> serviço externo.
+# Se o serviço cair ou demorar, um CEP já consultado continua respondendo (mesmo vencido).
+CEP_API_URL = os.environ.get("CEP_API_URL", "https://brasilapi.com.br/api/cep/v1/{cep}")
+CEP_TIMEOUT = float(os.environ.get("CEP_TIMEOUT", "4"))
+CEP_VALIDADE_DIAS = int(os.environ.get("CEP_VALIDADE_DIAS", "90"))  # depois disso tenta atualizar no serviço
+CEP_CACHE_TTL = float(os.environ.get("CEP_CACHE_TTL", "86400"))
+CEP_STUB_ARQUIVO = os.environ.get("CEP_STUB_ARQUIVO")  # JSON {cep: dados} no lugar do serviço (testes/dev)
+CAMPOS_CEP = ['cep', 'state', 'city', 'neighborhood', 'street']
+_cache_cep = CacheTTL(CEP_CACHE_TTL, max_itens=2048)
+_cache_cep_inexistente = CacheTTL(600, max_itens=512)
+
+class ClienteCepHttp:
+    """Consulta o serviço de CEP com keep-alive e timeout. consultar() -> dict, None (não existe) ou RequestException."""
+
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self._session = None
+        self._pid = None
+
+    def _sessao(self):
+        # Sessão por processo: conexões abertas não podem ser herdadas pelo fork dos workers
+        if self._session is None or self._pid != os.getpid():
+            self._session = requests.Session()
+            self._session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self._session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self._pid = os.getpid()
+        return self._session
+
+    def consultar(self, cep):
+        resp = self._sessao().get(self.url.format(cep=cep), timeout=self.timeout)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        dados = resp.json()
+        return {campo: dados.get(campo) for campo in CAMPOS_CEP}
+
+class ClienteCepFixo:
+    """Substituto local do serviço: responde a partir de um dict {cep: dados}."""
+
+    def __init__(self, ceps):
+        self.ceps = ceps
+
+    def consultar(self, cep):
+        dados = self.ceps.get(cep)
+        return {campo: dados.get(campo) for campo in CAMPOS_CEP} if dados else None
+
+if CEP_STUB_ARQUIVO:
+    with open(CEP_STUB_ARQUIVO, encoding='utf-8') as f:
+        CLIENTE_CEP = ClienteCepFixo(json.load(f))
+else:
+    CLIENTE_CEP = ClienteCepHttp(CEP_API_URL, CEP_TIMEOUT)
+
+def resposta_cep(dados):
+    resp = jsonify(dados)
+    resp.headers['Cache-Control'] = 'public, max-age=86400'
+    return resp
+
+@app.route('/cep/<cep>', methods=['GET'])
+def consultar_cep(cep):
+    cep = ''.join(filter(str.isdigit, cep))
+    if len(cep) != 8:
+        return jsonify({'error': 'CEP inválido'}), 400
+    dados = _cache_cep.get(cep)
+    if dados is not None:
+        return resposta_cep(dados)
+    if _cache_cep_inexistente.get(cep):
+        return jsonify({'error': 'CEP não encontrado'}), 404
+
+    gravado, vencido = None, True
+    if DATABASE_URL:
+        try:
+            with db_conexao() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT dados, atualizado_em < now() - make_interval(days => %s) FROM cep_cache WHERE cep = %s",
+                                (CEP_VALIDADE_DIAS, cep))
+                    row = cur.fetchone()
+            if row:
+                gravado, vencido = row
+        except Exception as e:  # sem banco a consulta ainda pode ir direto ao serviço
+            logger.error(f"Erro cache de CEP: {e}")
+    if gravado is not None and not vencido:
+        _cache_cep.set(cep, gravado)
+        return resposta_cep(gravado)
+
+    # Sem conexão do banco presa durante a chamada externa
+    try:
+        dados = CLIENTE_CEP.consultar(cep)
+    except (requests.RequestException, ValueError) as e:
+        if gravado is not None:
+            logger.warning(f"Serviço de CEP indisponível ({e}); usando cópia gravada de {cep}")
+            return resposta_cep(gravado)
+        logger.warning(f"Serviço de CEP indisponível: {e}")
+        return jsonify({'error': 'Serviço de CEP indisponível, tente novamente.'}), 502
+    if dados is None:
+        _cache_cep_inexistente.set(cep, True)
+        return jsonify({'error': 'CEP não encontrado'}), 404
+
+    if DATABASE_URL:
+        try:
+            with db_conexao() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        INSERT INTO cep_cache (cep, dados) VALUES (%s, %s)
+                        ON CONFLICT (cep) DO UPDATE SET dados = EXCLUDED.dados, atualizado_em = now()
+                    """, (cep, json.dumps(dados)))
+        except Exception as e:
+            logger.error(f"Erro cache de CEP: {e}")
+    _cache_cep.set(cep, dados)
+    return resposta_cep(dados)
+
+# --- ROTAS DE MÍDIA ---
+@app.route('/midia/<hash_midia>', methods=['GET'])
+def servir_midia(hash_midia):
+    return responder_midia(hash_midia)
+
+# --- DASHBOARD ---
+# Lê só a tabela resumo_atendimentos (mantida por trigger), com cache curto em memória por worker.
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "30"))
+
+_cache_dashboard = CacheTTL(DASHBOARD_CACHE_TTL, max_itens=16)
+
+def _taxa(parte, total):
+    return round(100.0 * parte / total, 1) if total else None
+
+def dados_dashboard(dias):
+    """Agrega o resumo dos últimos `dias` dias (custo proporcional ao resumo, não às fichas)."""
+    dados = _cache_dashboard.get(dias)
+    if dados is not None:
+        return dados
+    with db_conexao() as conn:
+        with conn.cursor() as cur:
+            # O "hoje" do fuso em que os triggers separam os dias (às 21h em Cuiabá já é amanhã em UTC)
+            cur.execute("SELECT (now() AT TIME ZONE 'America/Cuiaba')::date - %s", (dias - 1,))
+            desde = cur.fetchone()[0]
+            cur.execute("""
+                SELECT dia, sum(fichas), sum(vendas), sum(atendidos), sum(vendas_atendidos), sum(vgv)
+                  FROM resumo_atendimentos WHERE dia >= %s GROUP BY dia ORDER BY dia DESC
+            """, (desde,))
+            por_dia = [{'dia': dia.isoformat(), 'fichas': f, 'vendas': v, 'conversao_atendidos_pct': _taxa(va, at), 'vgv': float(vgv)}
+                       for dia, f, v, at, va, vgv in cur.fetchall()]
+            cur.execute("""
+                SELECT nome_corretor, sum(fichas), sum(atendidos), sum(vendas), sum(vendas_atendidos), sum(notas_soma), sum(notas_qtd), sum(vgv)
+                  FROM resumo_atendimentos WHERE dia >= %s GROUP BY nome_corretor ORDER BY sum(vgv) DESC, sum(fichas) DESC
+            """, (desde,))
+            por_corretor = [{'nome_corretor': nome or None, 'fichas': f, 'vendas': v, 'conversao_atendidos_pct': _taxa(va, at),
+                             'nota_media': round(ns / nq, 2) if nq else None, 'avaliacoes': nq, 'vgv': float(vgv)}
+                            for nome, f, at, v, va, ns, nq, vgv in cur.fetchall()]
+            cur.execute("""
+                SELECT loteamento, empreendimento_pc, sum(fichas), sum(vendas), sum(vgv)
+                  FROM resumo_atendimentos WHERE dia >= %s GROUP BY loteamento, empreendimento_pc
+                 HAVING sum(fichas) > 0 ORDER BY sum(vgv) DESC, sum(fichas) DESC
+            """, (desde,))
+            por_loteamento = [{'loteamento': lot or None, 'empreendimento_pc': emp or None, 'fichas': f, 'vendas': v, 'vgv': float(vgv)}
+                              for lot, emp, f, v, vgv in cur.fetchall()]
+    totais = {
+        'fichas': sum(d['fichas'] for d in por_dia),
+        'vendas': sum(d['vendas'] for d in por_dia),
+        'vgv': round(sum(d['vgv'] for d in por_dia), 2),
+    }
+    dados = {'dias': dias, 'desde': desde.isoformat(), 'totais': totais,
+             'por_dia': por_dia, 'por_corretor': por_corretor, 'por_loteamento': por_loteamento,
+             'gerado_em': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    _cache_dashboard.set(dias, dados)
+    return dados
+
+DASHBOARD_TEMPLATE = app.jinja_env.from_string("""
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Araguaia Imóveis - Dashboard</title>
+    <style>
+        body { background:#263318; color:#fff; font-family:'Montserrat',sans-serif; margin:0; padding:1.5rem; }
+        h1 { font-weight:800; margin:0 0 .25rem; } h2 { background:#8cc63f; color:#1a2610; font-size:.95rem; text-transform:uppercase; padding:.5rem 1rem; border-radius:.375rem; }
+        .cards { display:flex; gap:1rem; flex-wrap:wrap; } .card { background:#324221; border:1px solid #4a5e35; border-radius:.75rem; padding:1rem 1.5rem; }
+        .card b { display:block; font-size:1.6rem; color:#8cc63f; }
+        table { width:100%; border-collapse:collapse; background:#324221; font-size:.85rem; } th, td { padding:.4rem .6rem; border-bottom:1px solid #4a5e35; text-align:left; }
+        td.n { text-align:right; } small { color:#d1d5db; }
+    </style>
+</head>
+<body>
+    <h1>Dashboard de Atendimentos</h1>
+    <small>Últimos {{ d.dias }} dias (desde {{ d.desde }}) · atualizado em {{ d.gerado_em[:19] }} UTC</small>
+    <div class="cards" style="margin-top:1rem">
+        <div class="card">Fichas<b>{{ d.totais.fichas }}</b></div>
+        <div class="card">Vendas<b>{{ d.totais.vendas }}</b></div>
+        <div class="card">VGV<b>R$ {{ '{:,.2f}'.format(d.totais.vgv).replace(',', 'X').replace('.', ',').replace('X', '.') }}</b></div>
+    </div>
+    <h2>Por corretor</h2>
+    <table><tr><th>Corretor</th><th>Fichas</th><th>Vendas</th><th>Conversão (atendidos)</th><th>Nota média</th><th>VGV</th></tr>
+    {% for c in d.por_corretor %}<tr><td>{{ c.nome_corretor or '—' }}</td><td class="n">{{ c.fichas }}</td><td class="n">{{ c.vendas }}</td><td class="n">{{ c.conversao_atendidos_pct if c.conversao_atendidos_pct is not none else '—' }}%</td><td class="n">{{ c.nota_media or '—' }}</td><td class="n">{{ '%.2f'|format(c.vgv) }}</td></tr>{% endfor %}
+    </table>
+    <h2>Por loteamento / empreendimento</h2>
+    <table><tr><th>Loteamento</th><th>Empreendimento (pré-contrato)</th><th>Fichas</th><th>Vendas</th><th>VGV</th></tr>
+    {% for l in d.por_loteamento %}<tr><td>{{ l.loteamento or '—' }}</td><td>{{ l.empreendimento_pc or '—' }}</td><td class="n">{{ l.fichas }}</td><td class="n">{{ l.vendas }}</td><td class="n">{{ '%.2f'|format(l.vgv) }}</td></tr>{% endfor %}
+    </table>
+    <h2>Por dia</h2>
+    <table><tr><th>Dia</th><th>Fichas</th><th>Vendas</th><th>Conversão (atendidos)</th><th>VGV</th></tr>
+    {% for p in d.por_dia %}<tr><td>{{ p.dia }}</td><td class="n">{{ p.fichas }}</td><td class="n">{{ p.vendas }}</td><td class="n">{{ p.conversao_atendidos_pct if p.conversao_atendidos_pct is not none else '—' }}%</td><td class="n">{{ '%.2f'|format(p.vgv) }}</td></tr>{% endfor %}
+    </table>
+</body>
+</html>
+""")
+
+@app.route('/dashboard', methods=['GET'])
+@app.route('/dashboard.json', methods=['GET'])
+def dashboard():
+    erro = exigir_admin()  # conversão e VGV por corretor
+    if erro:
+        return erro
+    if not DATABASE_URL: return jsonify({'error': 'DB não configurado'}), 500
+    try:
+        dias = min(max(int(request.args.get('dias', 30)), 1), 366)
+        dados = dados_dashboard(dias)
+        if request.path.endswith('.json'):
+            return jsonify(dados)
+        return DASHBOARD_TEMPLATE.render(d=dados)
+    except ValueError:
+        return jsonify({'error': 'Parâmetro dias inválido.'}), 400
+    except Exception as e:
+        logger.error(f"Erro Dashboard: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # --- ROTA DE AVALIAÇÃO (Opcional, se usar estrelas) ---
 @app.route('/avaliar', methods=['POST'])
 def avaliar_atendimento():
@@ -1187,14 +4216,287 @@ def avaliar_atendimento():
         ticket_id = data.get('ticket_id')
         nota = int(str(data.get('nota')).strip())
         
-        with psycopg2.connect(DATABASE_URL) as conn:
+        with db_conexao() as conn:
             with conn.cursor() as cursor:
                 cursor.execute("UPDATE atendimentos SET nota_atendimento = %s WHERE id = %s", (nota, ticket_id))
+                enfileirar_webhook(cursor, 'ficha_avaliada', {'id': ticket_id, 'nota_atendimento': nota})
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Erro avaliar: {e}")
         return jsonify({'success': False}), 500
 
+# --- STATUS DO POOL ---
+def exigir_token_metricas():
+    """Como o /metrics: estado interno do worker só com o METRICAS_TOKEN (sem ele, 404)."""
+    if not METRICAS_TOKEN:
+        return jsonify({}), 404
+    if not token_confere(METRICAS_TOKEN):
+        return jsonify({}), 401
+    return None
+
+@app.route('/status/pool', methods=['GET'])
+def status_pool():
+    erro = exigir_token_metricas()
+    if erro:
+        return erro
+    if not DATABASE_URL or _pool is None or _pool_pid != os.getpid():
+        return jsonify({'pid': os.getpid(), 'ativo': False})
+    return jsonify({'pid': os.getpid(), 'ativo': True, **_pool.snapshot()})
+
+@app.route('/status/webhook', methods=['GET'])
+def status_webhook():
+    erro = exigir_token_metricas()
+    if erro:
+        return erro
+    despachante = obter_despachante()
+    if despachante is None:
+        return jsonify({'pid': os.getpid(), 'ativo': False})
+    try:
+        return jsonify({'pid': os.getpid(), 'ativo': True, **despachante.snapshot()})
+    except Exception as e:
+        logger.error(f"Erro status webhook: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- MÉTRICAS POR REQUISIÇÃO ---
+@app.before_request
+def iniciar_medicao():
+    g.inicio_requisicao = time.perf_counter()
+
+@app.after_request
+def registrar_metricas(resposta):
+    inicio = g.pop('inicio_requisicao', None)
+    if not METRICAS_ATIVAS or inicio is None:
+        return resposta
+    metricas = obter_metricas()
+    rota = request.url_rule.rule if request.url_rule is not None else 'sem_rota'  # 404 não vira série nova
+    metricas.observar('ficha_http_duracao_segundos', time.perf_counter() - inicio, (('rota', rota), ('metodo', request.method)))
+    metricas.contar('ficha_http_requisicoes_total', (('rota', rota), ('metodo', request.method), ('status', str(resposta.status_code))))
+    if resposta.status_code >= 500:
+        metricas.contar('ficha_http_erros_total', (('rota', rota),))
+    if request.content_length:
+        metricas.observar('ficha_http_requisicao_bytes', request.content_length, (('rota', rota),))
+    if resposta.content_length is not None:
+        metricas.observar('ficha_http_resposta_bytes', resposta.content_length, (('rota', rota),))
+    metricas.gravar()
+    return resposta
+
+def token_confere(token):
+    """Confere o token em tempo constante (o tempo da comparação não revela o token). Aceita
+    "Authorization: Bearer <token>" ou, para abrir no navegador, usuário/senha com o token como senha."""
+    auth = request.authorization
+    recebido = (auth.password if auth.type == 'basic' else auth.token) if auth else None
+    return hmac.compare_digest((recebido or '').encode('utf-8'), token.encode('utf-8'))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Latência e volume por rota não são públicos: sem METRICAS_TOKEN a rota não existe
+    if not (METRICAS_ATIVAS and METRICAS_TOKEN):
+        return jsonify({}), 404
+    if not token_confere(METRICAS_TOKEN):
+        return jsonify({}), 401
+    try:
+        corpo = formatar_prometheus(coletar_metricas())
+    except OSError as e:
+        logger.error(f"Erro métricas: {e}")
+        return jsonify({'error': str(e)}), 500
+    return Response(corpo, mimetype='text/plain; version=0.0.4', headers={'Cache-Control': 'no-store'})
+
+# --- PERFIL DE REQUISIÇÕES (AMOSTRAGEM) ---
+# Opt-in, para achar a causa de requisições lentas em produção sem novo deploy:
+# - PERFIL_AMOSTRA=N: 1 em cada N requisições das rotas em PERFIL_ROTAS roda sob cProfile;
+# - PERFIL_LIMIAR_MS=ms: as demais têm a pilha amostrada a cada PERFIL_INTERVALO_MS por uma thread (custo
+#   quase zero) e o resultado só é guardado se a requisição passar do limiar.
+# Os perfis (gzip) ficam em PERFIL_DIR, no máximo PERFIL_MAX arquivos (os mais antigos são apagados),
+# e são baixados em /admin/perfis (exige ADMIN_TOKEN).
+PERFIL_AMOSTRA = int(os.environ.get("PERFIL_AMOSTRA", "0"))
+PERFIL_LIMIAR_MS = float(os.environ.get("PERFIL_LIMIAR_MS", "0"))
+PERFIL_INTERVALO_MS = float(os.environ.get("PERFIL_INTERVALO_MS", "10"))
+PERFIL_ROTAS = {r.strip() for r in os.environ.get("PERFIL_ROTAS", "index,buscar_ficha,avaliar_atendimento,sincronizar_fichas").split(',') if r.strip()}
+PERFIL_DIR = os.environ.get("PERFIL_DIR") or os.path.join(tempfile.gettempdir(), 'ficha_perfis')
+PERFIL_MAX = int(os.environ.get("PERFIL_MAX", "50"))
+
+_perfil_cprofile_lock = threading.Lock()  # um cProfile por vez no processo
+
+def _pilha_dobrada(frame):
+    """Pilha no formato "dobrado" do flamegraph: raiz;...;folha, cada quadro como 'funcao (arquivo:linha)'."""
+    quadros = []
+    while frame is not None:
+        codigo = frame.f_code
+        quadros.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(quadros))
+
+class AmostradorPilhas:
+    """Thread que amostra a pilha das threads marcadas (sys._current_frames) em intervalos fixos.
+    A thread só sobe na primeira requisição marcada e pertence ao processo que a criou (pid)."""
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self.pid = os.getpid()
+        self._alvos = {}  # id da thread -> Counter de pilhas
+        self._lock = threading.Lock()
+        self._encerrar = threading.Event()
+        self._thread = None
+
+    def iniciar(self, thread_id):
+        with self._lock:
+            self._alvos[thread_id] = collections.Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._rodar, name='amostrador-perfil', daemon=True)
+                self._thread.start()
+
+    def parar(self, thread_id):
+        with self._lock:
+            return self._alvos.pop(thread_id, None)
+
+    def encerrar(self):
+        self._encerrar.set()
+
+    def _rodar(self):
+        # Threads não sobrevivem ao fork; o pid garante que o laço só amostra o processo que o criou
+        while not self._encerrar.wait(self.intervalo) and os.getpid() == self.pid:
+            with self._lock:
+                if not self._alvos:
+                    continue
+                quadros = sys._current_frames()
+                for thread_id, contagem in self._alvos.items():
+                    frame = quadros.get(thread_id)
+                    if frame is not None:
+                        contagem[_pilha_dobrada(frame)] += 1
+
+_amostrador = None
+_amostrador_lock = threading.Lock()
+
+def obter_amostrador():
+    """Amostrador do processo atual, criado no primeiro uso (thread não sobrevive ao fork)."""
+    global _amostrador
+    if _amostrador is None or _amostrador.pid != os.getpid():
+        with _amostrador_lock:
+            if _amostrador is None or _amostrador.pid != os.getpid():
+                if _amostrador is not None:
+                    _amostrador.encerrar()  # herdado do processo pai: a thread dele não veio no fork
+                _amostrador = AmostradorPilhas(PERFIL_INTERVALO_MS / 1000)
+                atexit.register(_amostrador.encerrar)
+    return _amostrador
+
+def gravar_perfil(tipo, duracao_ms, corpo):
+    """Grava um perfil comprimido no anel em PERFIL_DIR e apaga os mais antigos além de PERFIL_MAX."""
+    try:
+        os.makedirs(PERFIL_DIR, exist_ok=True)
+        nome = f"{int(time.time() * 1000)}-{os.getpid()}-{request.endpoint}-{int(duracao_ms)}ms.{tipo}.gz"
+        temporario = os.path.join(PERFIL_DIR, f'.{nome}.tmp')
+        with open(temporario, 'wb') as f:
+            f.write(gzip.compress(corpo, 6))
+        os.replace(temporario, os.path.join(PERFIL_DIR, nome))
+        for antigo in sorted(n for n in os.listdir(PERFIL_DIR) if n.endswith('.gz'))[:-PERFIL_MAX]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(PERFIL_DIR, antigo))
+        logger.info(f"🔬 Perfil gravado: {nome}")
+    except OSError as e:
+        logger.warning(f"⚠️ Não foi possível gravar perfil: {e}")
+
+@app.before_request
+def iniciar_perfil():
+    if not (PERFIL_AMOSTRA or PERFIL_LIMIAR_MS) or request.endpoint not in PERFIL_ROTAS:
+        return
+    g.perfil_inicio = time.perf_counter()
+    if PERFIL_AMOSTRA and random.randrange(PERFIL_AMOSTRA) == 0 and _perfil_cprofile_lock.acquire(blocking=False):
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:  # outro profiler ativo no processo (ex.: depurador)
+            _perfil_cprofile_lock.release()
+        else:
+            g.perfil_cprofile = perfil
+            return
+    if PERFIL_LIMIAR_MS and not GEVENT_ATIVO:  # sob gevent as requisições são greenlets, invisíveis a _current_frames
+        obter_amostrador().iniciar(threading.get_ident())
+        g.perfil_amostrado = True
+
+@app.teardown_request
+def finalizar_perfil(exc):
+    # teardown (e não after_request): roda também em exceções e depois do fim de respostas em streaming
+    inicio = g.pop('perfil_inicio', None)
+    if inicio is None:
+        return
+    duracao_ms = 1000 * (time.perf_counter() - inicio)
+    perfil = g.pop('perfil_cprofile', None)
+    if perfil is not None:
+        perfil.disable()
+        _perfil_cprofile_lock.release()
+        perfil.create_stats()
+        gravar_perfil('prof', duracao_ms, marshal.dumps(perfil.stats))
+    elif g.pop('perfil_amostrado', False):
+        contagem = obter_amostrador().parar(threading.get_ident())
+        if contagem and duracao_ms >= PERFIL_LIMIAR_MS:
+            linhas = [f"{pilha} {n}" for pilha, n in contagem.most_common()]
+            gravar_perfil('pilhas', duracao_ms, '\n'.join(linhas).encode('utf-8'))
+
+def exigir_admin():
+    """Resposta de erro se o pedido não traz o ADMIN_TOKEN; None se está autorizado."""
+    if not ADMIN_TOKEN:
+        return jsonify({}), 404
+    if not token_confere(ADMIN_TOKEN):
+        return jsonify({}), 401, {'WWW-Authenticate': 'Basic realm="Fichas"'}  # o navegador pede a senha
+    return None
+
+_RE_NOME_PERFIL = re.compile(r'^\d+-\d+-[\w.]+-\d+ms\.(prof|pilhas)\.gz$')
+
+@app.route('/admin/perfis', methods=['GET'])
+def listar_perfis():
+    erro = exigir_admin()
+    if erro:
+        return erro
+    perfis = []
+    nomes = sorted(os.listdir(PERFIL_DIR), reverse=True) if os.path.isdir(PERFIL_DIR) else []
+    for nome in nomes:
+        if not _RE_NOME_PERFIL.match(nome):
+            continue
+        criado, pid, rota, duracao = nome.split('.')[0].split('-', 3)
+        perfis.append({
+            'nome': nome,
+            'url': f'/admin/perfis/{nome}',
+            'tipo': nome.split('.')[-2],
+            'rota': rota,
+            'pid': int(pid),
+            'duracao_ms': int(duracao[:-2]),
+            'criado_em': datetime.datetime.fromtimestamp(int(criado) / 1000).isoformat(timespec='seconds'),
+            'bytes': os.path.getsize(os.path.join(PERFIL_DIR, nome)),
+        })
+    return jsonify({'perfis': perfis, 'amostra': PERFIL_AMOSTRA, 'limiar_ms': PERFIL_LIMIAR_MS, 'rotas': sorted(PERFIL_ROTAS)})
+
+@app.route('/admin/perfis/<nome>', methods=['GET'])
+def baixar_perfil(nome):
+    """O .gz original (pstats / flamegraph.pl) ou, com ?formato=texto, um resumo legível."""
+    erro = exigir_admin()
+    if erro:
+        return erro
+    caminho = os.path.join(PERFIL_DIR, nome)
+    if not _RE_NOME_PERFIL.match(nome) or not os.path.exists(caminho):
+        return jsonify({}), 404
+    with open(caminho, 'rb') as f:
+        dados = f.read()
+    if request.args.get('formato') != 'texto':
+        return Response(dados, mimetype='application/gzip',
+                        headers={'Content-Disposition': f'attachment; filename="{nome}"', 'Cache-Control': 'no-store'})
+    corpo = gzip.decompress(dados)
+    if nome.endswith('.pilhas.gz'):
+        return Response(corpo, mimetype='text/plain; charset=utf-8')
+    saida = io.StringIO()
+    with tempfile.NamedTemporaryFile(suffix='.prof') as tmp:
+        tmp.write(corpo)
+        tmp.flush()
+        estatisticas = pstats.Stats(tmp.name, stream=saida)
+        ordem = request.args.get('ordem') if request.args.get('ordem') in ('cumulative', 'tottime', 'ncalls') else 'cumulative'
+        estatisticas.sort_stats(ordem).print_stats(request.args.get('linhas', 60, type=int))
+    return Response(saida.getvalue(), mimetype='text/plain; charset=utf-8')
+
+@app.before_request
+def garantir_despachante():
+    # Sobe a thread de entrega no primeiro request do worker (eventos pendentes de antes do restart também)
+    if _despachante_pid != os.getpid():
+        obter_despachante()
+
 if __name__ == '__main__':
     # Roda a aplicação
     app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
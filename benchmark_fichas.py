@@ -0,0 +1,401 @@
+"""Benchmark das rotas da ficha (POST /, GET /buscar/<id>, POST /avaliar e GET /cep) contra um servidor local.
+
+Gera fichas realistas (foto de câmera de tablet, assinatura em traços, compradores de vários lotes),
+sempre iguais para a mesma --semente, dispara as requisições com --concorrencia threads e mede
+p50/p95/p99, vazão e o tamanho das linhas gravadas no Postgres. O resultado sai em JSON; com
+--baseline, piora além da --tolerancia em qualquer fase faz o comando sair com código 1.
+
+    gunicorn App_Ficha_Atendimento_n8n_Final:app -w 2 -b 127.0.0.1:5000 &
+    python benchmark_fichas.py --fichas 200 --concorrencia 8 --saida atual.json --baseline baseline.json
+
+Com --ceps, mede também GET /cep contra um serviço de CEP falso (--cep-stub-porta) que demora
+--cep-stub-latencia-ms; o servidor precisa usar CEP_API_URL=http://127.0.0.1:<porta>/{cep}.
+"""
+import click
+import psycopg2
+import requests
+import base64
+import concurrent.futures
+import datetime
+import http.server
+import io
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+import urllib3
+
+try:
+    from PIL import Image, ImageDraw, ImageFilter  # fotos JPEG de verdade (o servidor recusa imagem inválida)
+except ImportError:
+    Image = None
+
+NOMES = ["Maria", "João", "Ana", "Pedro", "Francisca", "Antônio", "Luzia", "Carlos", "Juliana", "Marcos"]
+SOBRENOMES = ["da Silva", "dos Santos", "Oliveira", "Souza", "Pereira", "Lima", "Ferreira", "Almeida"]
+CIDADES = ["Sinop", "Sorriso", "Lucas do Rio Verde", "Vera", "Cláudia", "Colíder"]
+EMPREENDIMENTOS = ["Jardim dos Ipês", "Jardim Amazônia ET. 4", "Santa Felicidade", "Amazon Park", "Colina Verde"]
+CORRETORES = ["4083 - NEURA.T.PAVAN SINIGAGLIA", "2796 - PEDRO LAERTE RABECINI", "4704 - MAYCON JEAN CAMPOS"]
+
+# --- GERAÇÃO DAS FICHAS ---
+def moeda(valor):
+    inteiro, centavos = f"{valor:.2f}".split('.')
+    return f"R$ {int(inteiro):,}".replace(',', '.') + f",{centavos}"
+
+def gerar_foto(rng, largura, altura, qualidade):
+    """JPEG com formas e textura (comprime como uma foto, não como ruído puro nem como cor lisa)."""
+    imagem = Image.new('RGB', (largura, altura), tuple(rng.randrange(256) for _ in range(3)))
+    desenho = ImageDraw.Draw(imagem)
+    for _ in range(60):
+        x, y = rng.randrange(largura), rng.randrange(altura)
+        r = rng.randrange(20, max(21, largura // 5))
+        desenho.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    textura = Image.frombytes('RGB', (largura // 8, altura // 8), rng.randbytes(3 * (largura // 8) * (altura // 8)))
+    imagem = Image.blend(imagem.filter(ImageFilter.GaussianBlur(3)), textura.resize((largura, altura), Image.BICUBIC), 0.25)
+    saida = io.BytesIO()
+    imagem.save(saida, 'JPEG', quality=qualidade)
+    return 'data:image/jpeg;base64,' + base64.b64encode(saida.getvalue()).decode('ascii')
+
+def gerar_assinatura(rng, largura=700, altura=200):
+    """Traços no formato do front ({w, h, t}: 1º ponto absoluto, demais em delta), ~3 traços de 80-200 pontos."""
+    tracos = []
+    for i in range(rng.randint(2, 4)):
+        x, y = 60 + i * 180 + rng.randrange(40), altura // 2 + rng.randrange(-40, 40)
+        traco = [x, y]
+        fase = rng.random() * math.pi
+        for p in range(rng.randint(80, 200)):
+            traco += [rng.randint(1, 4), round(6 * math.sin(fase + p / 4)) + rng.randint(-1, 1)]
+        tracos.append(traco)
+    return {'w': largura, 'h': altura, 't': tracos}
+
+def gerar_lote(rng):
+    m2 = rng.choice([250, 300, 360, 420, 500])
+    vl_m2 = rng.choice([180, 220, 260, 310])
+    return {
+        'quadra_pc': str(rng.randint(1, 40)), 'lote_pc': str(rng.randint(1, 30)),
+        'm2_pc': str(m2), 'vl_m2_pc': moeda(vl_m2), 'vl_total_pc': moeda(m2 * vl_m2),
+        'entrada_forma_pagamento_pc': rng.choice(['PIX', 'Boleto', 'Cartão']),
+        'vl_parcelas_pc': moeda(m2 * vl_m2 / 120),
+    }
+
+def gerar_ficha(rng, indice, opcoes):
+    """Uma ficha como a página envia. ~35% compram; desses, opcoes['multilotes'] levam 2 a 4 lotes."""
+    nome = f"{rng.choice(NOMES)} {rng.choice(SOBRENOMES)} Bench{indice}"
+    ficha = {
+        'nome': nome,
+        'telefone': f"669{rng.randrange(10**8):08d}",
+        'cidade': rng.choice(CIDADES),
+        'rede_social': f"@{nome.split()[0].lower()}{indice}",
+        'abordagem_inicial': rng.choice(['Plantão', 'Indicação', 'Instagram', 'Panfleto']),
+        'esteve_plantao': rng.choice(['sim', 'não']),
+        'foi_atendido': 'sim',
+        'nome_corretor': rng.choice(CORRETORES),
+        'autoriza_transmissao': 'sim',
+        'loteamento': rng.choice(EMPREENDIMENTOS),
+        'nivel_interesse': rng.choice(['Alto', 'Médio', 'Baixo']),
+        'comprou_1o_lote': 'Não',
+        'chave_idempotencia': f"bench-{opcoes['semente']}-{indice}-{rng.randrange(10**9)}",
+    }
+    if rng.random() < 0.35:
+        lote = gerar_lote(rng)
+        ficha.update(lote)
+        ficha.update({
+            'comprou_1o_lote': 'Sim', 'venda_realizada_pc': 'Sim', 'empreendimento_pc': ficha['loteamento'],
+            'forma_pagamento_pc': 'Parcelado', 'numero_parcelas_pc': '120', 'vencimento_parcelas_pc': '10',
+            'nome_proponente_pc': nome, 'cpf_proponente_pc': f"{rng.randrange(10**11):011d}",
+            'estado_civil_pc': rng.choice(['Solteiro(a)', 'Casado(a)']), 'renda_mensal_pc': moeda(rng.randint(2, 15) * 1000),
+            'endereco_pc': f"Rua {rng.randint(1, 99)}, {rng.randint(1, 2000)} - {ficha['cidade']}/MT",
+            'referencias_pc': '\n'.join(f"{rng.choice(NOMES)} - 66 9{rng.randrange(10**8):08d}" for _ in range(2)),
+        })
+        if rng.random() < opcoes['multilotes']:
+            ficha['lotes'] = [gerar_lote(rng) for _ in range(rng.randint(1, 3))]
+    if opcoes['foto']:
+        ficha['foto_cliente_base64'] = gerar_foto(rng, *opcoes['foto'], opcoes['foto_qualidade'])
+    ficha['assinatura_tracos'] = gerar_assinatura(rng)
+    return ficha
+
+# --- SERVIÇO DE CEP FALSO ---
+def iniciar_stub_cep(porta, latencia):
+    """Serviço de CEP local (formato da BrasilAPI) que responde qualquer CEP depois de `latencia` segundos."""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latencia)
+            cep = self.path.rstrip('/').rsplit('/', 1)[-1]
+            corpo = json.dumps({'cep': cep, 'state': 'MT', 'city': 'Sinop', 'neighborhood': 'Centro',
+                                'street': f'Rua {cep[-3:]}'}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = http.server.ThreadingHTTPServer(('127.0.0.1', porta), Handler)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+def ceps_da_execucao(quantidade):
+    """CEPs que nenhuma execução anterior consultou: a memória do worker e a tabela cep_cache não ajudam,
+    e toda requisição vai ao serviço de CEP (é a espera que a fase quer medir)."""
+    return [f"{n:08d}" for n in random.Random(time.time_ns()).sample(range(10 ** 8), quantidade)]
+
+# --- EXECUÇÃO ---
+_sessoes = threading.local()
+
+def sessao():
+    if not hasattr(_sessoes, 's'):
+        _sessoes.s = requests.Session()
+    return _sessoes.s
+
+def percentil(ordenados, p):
+    """Percentil com interpolação linear (mesmo método do numpy.percentile padrão)."""
+    if not ordenados:
+        return None
+    pos = (len(ordenados) - 1) * p / 100
+    baixo = math.floor(pos)
+    alto = min(baixo + 1, len(ordenados) - 1)
+    return ordenados[baixo] + (ordenados[alto] - ordenados[baixo]) * (pos - baixo)
+
+def corpo_lento(dados, kbps, pedaco=16384):
+    """Envia o corpo em pedaços no ritmo de um tablet com sinal fraco (chunked; o gunicorn aceita)."""
+    for i in range(0, len(dados), pedaco):
+        parte = dados[i:i + pedaco]
+        time.sleep(len(parte) * 8 / (kbps * 1000))
+        yield parte
+
+def codificar_multipart(ficha):
+    """Ficha no formato multipart da página: campos em JSON na parte "dados", mídias como arquivos."""
+    dados, partes = dict(ficha), {}
+    for parte, campo in (('foto_cliente', 'foto_cliente_base64'), ('assinatura', 'assinatura_base64')):
+        valor = dados.pop(campo, None)
+        if valor:
+            mimetype, b64 = valor[5:].split(';base64,', 1)
+            partes[parte] = (f"{parte}.{mimetype.split('/')[1]}", base64.b64decode(b64), mimetype)
+    return urllib3.encode_multipart_formdata({'dados': json.dumps(dados), **partes})
+
+def rodar_fase(nome, tarefas, concorrencia, timeout, upload_kbps=None, multipart=False):
+    """Executa [(método, url, json)] com N threads. Devolve (estatísticas, respostas JSON na ordem das tarefas)."""
+    def executar(tarefa):
+        metodo, url, corpo = tarefa
+        dados = b''
+        if corpo is not None:
+            if multipart:
+                dados, tipo = codificar_multipart(corpo)
+            else:
+                dados, tipo = json.dumps(corpo).encode('utf-8'), 'application/json'
+        inicio = time.perf_counter()
+        try:
+            if corpo is not None:
+                resp = sessao().request(metodo, url, data=corpo_lento(dados, upload_kbps) if upload_kbps else dados,
+                                        headers={'Content-Type': tipo}, timeout=timeout)
+            else:
+                resp = sessao().request(metodo, url, timeout=timeout)
+            duracao = time.perf_counter() - inicio
+            ok = resp.status_code < 400
+            return duracao, ok, len(resp.content), (resp.json() if ok else None), len(dados)
+        except (requests.RequestException, ValueError):
+            return time.perf_counter() - inicio, False, 0, None, len(dados)
+
+    inicio = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concorrencia) as executor:
+        resultados = list(executor.map(executar, tarefas))
+    total = time.perf_counter() - inicio
+
+    latencias = sorted(1000 * r[0] for r in resultados)
+    erros = sum(1 for r in resultados if not r[1])
+    estatisticas = {
+        'requisicoes': len(resultados),
+        'erros': erros,
+        'duracao_s': round(total, 3),
+        'vazao_rps': round(len(resultados) / total, 2) if total else None,
+        'p50_ms': round(percentil(latencias, 50), 2),
+        'p95_ms': round(percentil(latencias, 95), 2),
+        'p99_ms': round(percentil(latencias, 99), 2),
+        'media_ms': round(sum(latencias) / len(latencias), 2),
+        'max_ms': round(latencias[-1], 2),
+        'resposta_bytes_media': round(sum(r[2] for r in resultados) / len(resultados)),
+    }
+    if tarefas and tarefas[0][2] is not None:
+        estatisticas['requisicao_bytes_media'] = round(sum(r[4] for r in resultados) / len(resultados))
+    click.echo(f"  {nome:<8} {estatisticas['requisicoes']:>5} req  {estatisticas['vazao_rps']:>8} req/s  "
+               f"p50 {estatisticas['p50_ms']:>8} ms  p95 {estatisticas['p95_ms']:>8} ms  p99 {estatisticas['p99_ms']:>8} ms  "
+               f"erros {erros}")
+    return estatisticas, [r[3] for r in resultados]
+
+def tamanhos_no_banco(database_url, ids):
+    """Tamanho médio/máximo (bytes, pg_column_size) das linhas gravadas pelas fichas do benchmark."""
+    conn = psycopg2.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""SELECT count(*), avg(pg_column_size(a.*)), max(pg_column_size(a.*))
+                             FROM atendimentos a WHERE id = ANY(%s)""", (ids,))
+            fichas = cur.fetchone()
+            cur.execute("""SELECT count(*), avg(pg_column_size(l.*)), max(pg_column_size(l.*))
+                             FROM lotes_pc l WHERE atendimento_id = ANY(%s)""", (ids,))
+            lotes = cur.fetchone()
+            cur.execute("""SELECT m.mimetype, count(*), avg(pg_column_size(m.*)), max(pg_column_size(m.*))
+                             FROM midias m
+                            WHERE m.hash IN (SELECT foto_cliente_hash FROM atendimentos WHERE id = ANY(%(ids)s)
+                                             UNION SELECT assinatura_hash FROM atendimentos WHERE id = ANY(%(ids)s)
+                                             UNION SELECT m2.miniatura_hash FROM midias m2 JOIN atendimentos a
+                                                       ON m2.hash = a.foto_cliente_hash WHERE a.id = ANY(%(ids)s))
+                            GROUP BY 1 ORDER BY 1""", {'ids': ids})
+            midias = cur.fetchall()
+        conn.rollback()
+    finally:
+        conn.close()
+
+    def linha(qtd, media, maximo):
+        return {'linhas': qtd, 'media_bytes': round(float(media or 0)), 'max_bytes': maximo or 0}
+
+    return {
+        'atendimentos': linha(*fichas),
+        'lotes_pc': linha(*lotes),
+        'midias': {mimetype: linha(qtd, media, maximo) for mimetype, qtd, media, maximo in midias},
+    }
+
+# --- COMPARAÇÃO COM A BASELINE ---
+def comparar(atual, baseline, tolerancia, folga_ms):
+    """Lista de regressões: latência (p95/p99) ou tamanho de linha acima, ou vazão abaixo, da tolerância."""
+    regressoes = []
+    for fase, base in baseline.get('fases', {}).items():
+        agora = atual['fases'].get(fase)
+        if agora is None:
+            continue
+        for chave in ('p95_ms', 'p99_ms'):
+            # folga absoluta: em rotas de 2 ms, 1 ms a mais é ruído, não regressão
+            if agora[chave] > base[chave] * (1 + tolerancia) and agora[chave] - base[chave] > folga_ms:
+                regressoes.append(f"{fase}.{chave}: {base[chave]} -> {agora[chave]}")
+        if base.get('vazao_rps') and agora['vazao_rps'] < base['vazao_rps'] * (1 - tolerancia):
+            regressoes.append(f"{fase}.vazao_rps: {base['vazao_rps']} -> {agora['vazao_rps']}")
+    for tabela in ('atendimentos', 'lotes_pc'):
+        base = baseline.get('banco', {}).get(tabela)
+        agora = (atual.get('banco') or {}).get(tabela)
+        if base and agora and agora['media_bytes'] > base['media_bytes'] * (1 + tolerancia):
+            regressoes.append(f"banco.{tabela}.media_bytes: {base['media_bytes']} -> {agora['media_bytes']}")
+    return regressoes
+
+def medir_fichas(resultado, url, fichas, concorrencia, aquecimento, semente, opcoes, multipart, upload_kbps, timeout,
+                 database_url):
+    """Fases salvar, buscar e avaliar (e o tamanho das linhas no banco), gravadas em resultado."""
+    click.echo(f"🧪 Gerando {aquecimento + fichas} fichas (semente {semente})...")
+    rng = random.Random(semente)
+    geradas = [gerar_ficha(rng, i, opcoes) for i in range(aquecimento + fichas)]
+    # a chave de idempotência muda a cada execução, senão a 2ª rodada só mediria reenvios
+    execucao = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    for ficha in geradas:
+        ficha['chave_idempotencia'] += f"-{execucao}"
+
+    if aquecimento:
+        _, respostas = rodar_fase('aquecim.', [('POST', f"{url}/", f) for f in geradas[:aquecimento]],
+                                  concorrencia, timeout, multipart=multipart)
+        if not any(respostas):
+            raise click.ClickException(f'Nenhuma ficha gravada no aquecimento: o servidor em {url} está no ar e com banco?')
+
+    click.echo(f"🚀 {fichas} fichas, {concorrencia} simultâneas, contra {url}")
+    estatisticas, respostas = rodar_fase('salvar', [('POST', f"{url}/", f) for f in geradas[aquecimento:]],
+                                         concorrencia, timeout, upload_kbps, multipart)
+    resultado['fases']['salvar'] = estatisticas
+    ids = [r['ticket_id'] for r in respostas if r and r.get('ticket_id')]
+    if not ids:
+        raise click.ClickException('Nenhuma ficha gravada; veja o log do servidor.')
+
+    resultado['fases']['buscar'], _ = rodar_fase(
+        'buscar', [('GET', f"{url}/buscar/{i}", None) for i in ids], concorrencia, timeout)
+    resultado['fases']['avaliar'], _ = rodar_fase(
+        'avaliar', [('POST', f"{url}/avaliar", {'ticket_id': i, 'nota': rng.randint(1, 5)}) for i in ids], concorrencia, timeout)
+
+    if database_url:
+        resultado['banco'] = tamanhos_no_banco(database_url, ids)
+        banco = resultado['banco']
+        midias = ', '.join(f"{tipo} ~{m['media_bytes'] // 1024} KB" for tipo, m in banco['midias'].items())
+        click.echo(f"🗄️  atendimentos: média {banco['atendimentos']['media_bytes']} B/linha; "
+                   f"lotes_pc: {banco['lotes_pc']['linhas']} linhas; mídias: {midias}")
+
+def versao_git():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+@click.command()
+@click.option('--url', default='http://127.0.0.1:5000', show_default=True, help='Servidor já rodando.')
+@click.option('--fichas', default=200, show_default=True, help='Fichas gravadas (cada uma é buscada e avaliada uma vez).')
+@click.option('--concorrencia', default=8, show_default=True, help='Requisições simultâneas.')
+@click.option('--aquecimento', default=10, show_default=True, help='Fichas gravadas antes da medição (não entram no resultado).')
+@click.option('--semente', default=42, show_default=True, help='Mesma semente = mesmas fichas.')
+@click.option('--foto', default='1920x1080', show_default=True, help='Resolução da foto (LxA) ou "nenhuma".')
+@click.option('--foto-qualidade', default=70, show_default=True, help='Qualidade JPEG (a página usa 0.7).')
+@click.option('--multilotes', default=0.3, show_default=True, help='Fração das vendas com lotes adicionais.')
+@click.option('--multipart', is_flag=True, help='Envia as fichas como a página (multipart, mídia em arquivo) em vez de JSON.')
+@click.option('--upload-kbps', type=float, help='Limita o envio das fichas (kbit/s), simulando tablet no 3G/4G.')
+@click.option('--ceps', default=0, show_default=True, help='Consultas a GET /cep (CEPs novos a cada execução); 0 pula a fase.')
+@click.option('--cep-stub-porta', type=int, help='Sobe um serviço de CEP falso nessa porta (servidor com CEP_API_URL apontando para ele).')
+@click.option('--cep-stub-latencia-ms', default=500, show_default=True, help='Demora do serviço de CEP falso.')
+@click.option('--descricao', help='Texto livre gravado no resultado (ex.: modo do servidor, workers, máquina).')
+@click.option('--timeout', default=60.0, show_default=True, help='Timeout de cada requisição (s).')
+@click.option('--database-url', envvar='DATABASE_URL', help='Para medir o tamanho das linhas (padrão: $DATABASE_URL).')
+@click.option('--saida', type=click.Path(dir_okay=False), help='Grava o resultado em JSON.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Resultado anterior para comparar.')
+@click.option('--tolerancia', default=0.2, show_default=True, help='Piora aceita em relação à baseline (0.2 = 20%).')
+@click.option('--folga-ms', default=5.0, show_default=True, help='Diferença de latência ignorada, em ms.')
+def benchmark(url, fichas, concorrencia, aquecimento, semente, foto, foto_qualidade, multilotes, multipart, upload_kbps,
+              ceps, cep_stub_porta, cep_stub_latencia_ms, descricao, timeout, database_url, saida, baseline, tolerancia, folga_ms):
+    """Mede POST /, GET /buscar/<id>, POST /avaliar (e GET /cep com --ceps) e compara com uma baseline."""
+    url = url.rstrip('/')
+    resolucao = None
+    if foto != 'nenhuma':
+        if Image is None:
+            raise click.ClickException('Pillow não instalado: use --foto nenhuma ou instale o pacote.')
+        resolucao = tuple(int(n) for n in foto.lower().split('x'))
+    opcoes = {'semente': semente, 'foto': resolucao, 'foto_qualidade': foto_qualidade, 'multilotes': multilotes}
+
+    resultado = {
+        'meta': {
+            'data': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git': versao_git(),
+            'python': platform.python_version(),
+            'descricao': descricao,
+            'url': url, 'fichas': fichas, 'concorrencia': concorrencia, 'semente': semente,
+            'foto': foto, 'foto_qualidade': foto_qualidade, 'multilotes': multilotes, 'multipart': multipart,
+            'upload_kbps': upload_kbps, 'ceps': ceps,
+            'cep_stub_latencia_ms': cep_stub_latencia_ms if cep_stub_porta else None,
+        },
+        'fases': {},
+    }
+    if fichas:
+        medir_fichas(resultado, url, fichas, concorrencia, aquecimento, semente, opcoes, multipart, upload_kbps, timeout,
+                     database_url)
+    if ceps:
+        if cep_stub_porta:
+            iniciar_stub_cep(cep_stub_porta, cep_stub_latencia_ms / 1000)
+        click.echo(f"📮 {ceps} consultas de CEP, {concorrencia} simultâneas"
+                   + (f" (serviço falso com {cep_stub_latencia_ms} ms)" if cep_stub_porta else ''))
+        resultado['fases']['cep'], _ = rodar_fase(
+            'cep', [('GET', f"{url}/cep/{cep}", None) for cep in ceps_da_execucao(ceps)], concorrencia, timeout)
+
+    if saida:
+        with open(saida, 'w') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        click.echo(f"💾 Resultado em {saida}")
+
+    falhas = [f"{fase}: {e['erros']} erro(s)" for fase, e in resultado['fases'].items() if e['erros']]
+    if baseline:
+        with open(baseline) as f:
+            falhas += comparar(resultado, json.load(f), tolerancia, folga_ms)
+    if falhas:
+        click.echo("❌ Regressões:\n  " + "\n  ".join(falhas), err=True)
+        raise SystemExit(1)
+    click.echo("✅ Sem regressões" if baseline else "✅ Concluído")
+
+if __name__ == '__main__':
+    benchmark()
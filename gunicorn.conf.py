@@ -0,0 +1,33 @@
+"""Configuração do gunicorn (lida automaticamente quando ele é iniciado nesta pasta).
+
+SERVIDOR_MODO escolhe como cada worker atende as requisições:
+- sync (padrão): uma requisição por vez por worker;
+- gthread: GUNICORN_THREADS threads por worker;
+- gevent: centenas de requisições por worker (GEVENT_CONEXOES); enquanto uma espera o upload do tablet,
+  o Postgres ou o n8n, as outras andam. Requer o pacote gevent.
+"""
+import os
+
+SERVIDOR_MODO = os.environ.get("SERVIDOR_MODO", "sync").lower()
+
+# workers: WEB_CONCURRENCY (padrão 1 no gunicorn); bind: $PORT (Render) ou 127.0.0.1:8000
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))  # > 0 recicla o worker (vazamento de memória)
+max_requests_jitter = max_requests // 10
+
+if SERVIDOR_MODO == "gthread":
+    worker_class = "gthread"
+    threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+elif SERVIDOR_MODO == "gevent":
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("GEVENT_CONEXOES", "100"))
+elif SERVIDOR_MODO != "sync":
+    raise RuntimeError(f"SERVIDOR_MODO inválido: {SERVIDOR_MODO} (use sync, gthread ou gevent)")
+
+# DB_POOL_MAX não é mexido aqui: o tamanho do pool é só o que estiver no ambiente (ver README, Modo de Servidor).
+
+# O gevent troca socket/threading no worker antes de carregar o app; com preload o app seria carregado no
+# master, antes da troca, e o psycopg2/requests ficariam bloqueantes.
+preload_app = False
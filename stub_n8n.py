@@ -0,0 +1,100 @@
+"""Webhook falso do n8n para testar a entrega da outbox localmente.
+
+Recebe os POSTs do app (evento único ou lote gzip), imprime cada evento e marca os que chegarem
+repetidos (mesmo id da outbox). Com --atraso-ms e --falhas dá para simular um n8n lento ou instável
+e conferir as retentativas e o lease; ao parar (Ctrl+C ou kill) mostra o total e os repetidos.
+
+    python stub_n8n.py --porta 8765 --atraso-ms 3000 --falhas 0.2 &
+    N8N_WEBHOOK_URL=http://127.0.0.1:8765/ N8N_TIMEOUT=5 gunicorn App_Ficha_Atendimento_n8n_Final:app -w 2
+"""
+import click
+import collections
+import gzip
+import http.server
+import json
+import random
+import signal
+import threading
+import time
+
+
+class Recebidos:
+    """Contagem por id de evento, compartilhada entre as threads do servidor."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.por_id = collections.Counter()
+        self.posts = 0
+
+    def registrar(self, ids):
+        with self.lock:
+            self.posts += 1
+            for id_evento in ids:
+                self.por_id[id_evento] += 1
+            return [id_evento for id_evento in ids if self.por_id[id_evento] > 1]
+
+
+def criar_handler(recebidos, atraso, falhas, recusar, rng):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, como o requests.Session do app espera
+
+        def do_POST(self):
+            corpo = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                corpo = gzip.decompress(corpo)
+            if atraso:
+                time.sleep(atraso)
+            if rng.random() < falhas:
+                click.echo(f"{time.strftime('%H:%M:%S')} 500 {self.headers.get('X-Evento')} (falha simulada)")
+                return self.responder(500, b'falha simulada')
+
+            if self.headers.get('X-Evento') == 'lote':
+                itens = json.loads(corpo)
+                ids = [str(item['id_evento']) for item in itens]
+                resultados = [{'id': item['id_evento'], 'ok': rng.random() >= recusar} for item in itens]
+                resposta = json.dumps({'resultados': resultados}).encode('utf-8')
+                aceitos = [str(r['id']) for r in resultados if r['ok']]
+            else:
+                ids = aceitos = [self.headers.get('X-Idempotency-Key')]
+                resposta = b'{}'
+            repetidos = recebidos.registrar(aceitos)
+            click.echo(f"{time.strftime('%H:%M:%S')} 200 {self.headers.get('X-Evento')} ids={','.join(ids)}"
+                       + (f" REPETIDOS={','.join(repetidos)}" if repetidos else ''))
+            self.responder(200, resposta)
+
+        def responder(self, status, corpo):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@click.command()
+@click.option('--porta', default=8765, help='Porta local.')
+@click.option('--atraso-ms', default=0, help='Espera antes de responder (n8n lento; compare com N8N_TIMEOUT).')
+@click.option('--falhas', default=0.0, help='Fração dos POSTs respondidos com HTTP 500.')
+@click.option('--recusar', default=0.0, help='Modo lote: fração dos eventos devolvidos com ok=false.')
+@click.option('--semente', default=1, help='Semente das falhas/recusas simuladas.')
+def main(porta, atraso_ms, falhas, recusar, semente):
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # `kill` também mostra o resumo
+    recebidos = Recebidos()
+    handler = criar_handler(recebidos, atraso_ms / 1000, falhas, recusar, random.Random(semente))
+    servidor = http.server.ThreadingHTTPServer(('127.0.0.1', porta), handler)
+    click.echo(f"n8n falso em http://127.0.0.1:{porta}/ (Ctrl+C ou kill para parar)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    repetidos = {id_evento: n for id_evento, n in recebidos.por_id.items() if n > 1}
+    click.echo(f"{recebidos.posts} POSTs, {len(recebidos.por_id)} eventos confirmados, {len(repetidos)} repetidos"
+               + (f": {repetidos}" if repetidos else ''))
+
+
+if __name__ == '__main__':
+    main()
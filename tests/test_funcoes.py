@@ -0,0 +1,158 @@
+"""Funções puras do app: não precisam de banco (sem DATABASE_URL o import não conecta)."""
+import base64
+import datetime
+import decimal
+import zlib
+
+import pytest
+
+import App_Ficha_Atendimento_n8n_Final as app_ficha
+
+D = decimal.Decimal
+
+
+@pytest.mark.parametrize('texto, esperado', [
+    ('R$ 1.234,56', D('1234.56')),
+    ('R$1.234,56', D('1234.56')),
+    ('360,5', D('360.5')),
+    ('1.200', D('1200')),
+    ('1.200.000,00', D('1200000.00')),
+    ('  42  ', D('42')),
+    ('-15,75', D('-15.75')),
+    (7, D('7')),
+])
+def test_converter_numero_br(texto, esperado):
+    assert app_ficha.converter_numero_br(texto) == esperado
+
+
+@pytest.mark.parametrize('texto', [None, '', '450m2', '12x30', '1.20', '1,2,3', 'R$', 'abc', '1.2345'])
+def test_converter_numero_br_recusa_texto_que_nao_e_numero(texto):
+    assert app_ficha.converter_numero_br(texto) is None
+
+
+@pytest.mark.parametrize('valor, tipo, esperado', [
+    (D('42'), 'INTEGER', 42),
+    (D('42.5'), 'INTEGER', None),
+    (D(2 ** 31), 'INTEGER', None),
+    (D('1234.567'), 'NUMERIC(12,2)', D('1234.57')),
+    (D('0.005'), 'NUMERIC(12,2)', D('0.01')),
+    (D('9999.999'), 'NUMERIC(6,2)', None),
+    (D('10000'), 'NUMERIC(6,2)', None),
+    (None, 'NUMERIC(12,2)', None),
+])
+def test_ajustar_ao_tipo(valor, tipo, esperado):
+    assert app_ficha.ajustar_ao_tipo(valor, tipo) == esperado
+
+
+def test_tracos_ida_e_volta():
+    assinatura = {'w': 700, 'h': 200, 't': [[10, 20, 3, -4, -300, 5], [0, 0], [699, 199, -699, -199]]}
+    dados = app_ficha.codificar_tracos(assinatura)
+    assert zlib.decompress(dados)[:1] == b'\x01'
+    assert app_ficha.decodificar_tracos(dados) == (700, 200, assinatura['t'])
+
+
+@pytest.mark.parametrize('assinatura', [
+    None,
+    {'w': 700, 'h': 200},
+    {'w': 0, 'h': 200, 't': []},
+    {'w': 700, 'h': 200, 't': [[1, 2, 3]]},
+    {'w': 700, 'h': 200, 't': [[1]]},
+    {'w': 700, 'h': 200, 't': [[1, True]]},
+    {'w': 700, 'h': 200, 't': [[1, 2.5]]},
+    {'w': app_ficha.TRACOS_MAX_LADO + 1, 'h': 200, 't': []},
+    {'w': 700, 'h': 200, 't': [[1, 1] * (app_ficha.TRACOS_MAX_PONTOS + 1)]},
+])
+def test_codificar_tracos_recusa_formato_invalido(assinatura):
+    with pytest.raises(ValueError):
+        app_ficha.codificar_tracos(assinatura)
+
+
+def test_decodificar_tracos_recusa_versao_desconhecida():
+    with pytest.raises(ValueError):
+        app_ficha.decodificar_tracos(zlib.compress(b'\x02\x01\x01\x00'))
+
+
+def test_cursor_ida_e_volta():
+    data_hora = datetime.datetime(2024, 3, 5, 14, 30, 15, 123456, tzinfo=datetime.timezone.utc)
+    cursor = app_ficha.codificar_cursor(data_hora, 1234)
+    assert '=' not in cursor
+    assert app_ficha.decodificar_cursor(cursor) == (data_hora, 1234)
+
+
+@pytest.mark.parametrize('cursor', [
+    '',
+    '!!!',
+    base64.urlsafe_b64encode(b'sem-separador').decode(),
+    base64.urlsafe_b64encode(b'2024-03-05T14:30:15|abc').decode(),
+    base64.urlsafe_b64encode(b'ontem|12').decode(),
+    base64.urlsafe_b64encode(b'\xff\xfe|1').decode(),
+])
+def test_decodificar_cursor_invalido(cursor):
+    with pytest.raises(ValueError, match='Cursor inválido'):
+        app_ficha.decodificar_cursor(cursor)
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 16
+
+
+@pytest.mark.parametrize('mimetype, inicio', [('image/png', PNG), ('image/jpeg', JPEG)])
+def test_conferir_tipo_midia_aceita_png_e_jpeg(mimetype, inicio):
+    app_ficha.conferir_tipo_midia(mimetype, inicio)
+
+
+@pytest.mark.parametrize('mimetype, inicio', [
+    ('image/png', JPEG),
+    ('image/jpeg', PNG),
+    ('image/gif', b'GIF89a'),
+    ('image/svg+xml', b'<svg'),
+    ('image/png', b''),
+])
+def test_conferir_tipo_midia_recusa(mimetype, inicio):
+    with pytest.raises(ValueError):
+        app_ficha.conferir_tipo_midia(mimetype, inicio)
+
+
+def test_decodificar_data_url():
+    valor = 'data:IMAGE/PNG;base64,' + base64.b64encode(PNG).decode()
+    assert app_ficha.decodificar_data_url(valor) == ('image/png', PNG)
+
+
+@pytest.mark.parametrize('valor', [
+    'nao-e-data-url',
+    'data:image/png,' + base64.b64encode(PNG).decode(),
+    'data:image/png;base64,%%%',
+    'data:image/png;base64,' + base64.b64encode(JPEG).decode(),
+    'data:text/html;base64,' + base64.b64encode(b'<script>').decode(),
+])
+def test_decodificar_data_url_invalido(valor):
+    with pytest.raises(ValueError):
+        app_ficha.decodificar_data_url(valor)
+
+
+def test_filtros_fichas_sem_filtros():
+    assert app_ficha.filtros_fichas({}) == ([], [])
+
+
+def test_filtros_fichas_exatos_e_periodo_em_dias_de_cuiaba():
+    condicoes, params = app_ficha.filtros_fichas({
+        'nome_corretor': 'Ana', 'cidade': '', 'de': '2024-03-01', 'ate': '2024-03-31'})
+    assert condicoes == [
+        "nome_corretor = %s",
+        "data_hora >= %s::timestamp AT TIME ZONE 'America/Cuiaba'",
+        "data_hora < %s::timestamp AT TIME ZONE 'America/Cuiaba'",
+    ]
+    # 'ate' inclui o dia inteiro: o limite é a meia-noite seguinte
+    assert params == ['Ana', datetime.date(2024, 3, 1), datetime.date(2024, 4, 1)]
+
+
+def test_filtros_fichas_busca_por_nome_ou_telefone():
+    assert app_ficha.filtros_fichas({'q': ' Maria '}) == (["nome ILIKE %s"], ['%Maria%'])
+    assert app_ficha.filtros_fichas({'q': '(65) 9999'}) == (
+        ["(nome ILIKE %s OR telefone LIKE %s)"], ['%(65) 9999%', '%659999%'])
+
+
+@pytest.mark.parametrize('args', [{'de': '01/03/2024'}, {'ate': '2024-02-30'}])
+def test_filtros_fichas_data_invalida(args):
+    with pytest.raises(ValueError, match='Data inválida'):
+        app_ficha.filtros_fichas(args)
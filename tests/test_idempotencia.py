@@ -0,0 +1,87 @@
+"""Idempotência da gravação contra um Postgres de verdade (DATABASE_URL); sem ele os testes são pulados."""
+import os
+import threading
+import uuid
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='DATABASE_URL não configurada')
+
+if os.environ.get('DATABASE_URL'):
+    import psycopg2
+    import App_Ficha_Atendimento_n8n_Final as app_ficha
+
+
+@pytest.fixture
+def chave():
+    chave = f"teste-{uuid.uuid4()}"
+    yield chave
+    conn = psycopg2.connect(app_ficha.DATABASE_URL)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM atendimentos WHERE chave_idempotencia = %s", (chave,))
+    finally:
+        conn.close()
+
+
+def ficha(chave):
+    return {'nome': 'Teste Idempotência', 'telefone': '(65) 99999-0000', 'cidade': 'Cuiabá',
+            'chave_idempotencia': chave}
+
+
+def contar(chave):
+    conn = psycopg2.connect(app_ficha.DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM atendimentos WHERE chave_idempotencia = %s", (chave,))
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_reenvio_devolve_o_mesmo_ticket(chave):
+    cliente = app_ficha.app.test_client()
+    primeira = cliente.post('/', json=ficha(chave))
+    segunda = cliente.post('/', json=ficha(chave))
+    assert primeira.status_code == segunda.status_code == 200
+    assert primeira.get_json()['ticket_id'] == segunda.get_json()['ticket_id']
+    assert contar(chave) == 1
+
+
+def test_idempotency_key_no_cabecalho(chave):
+    cliente = app_ficha.app.test_client()
+    dados = {k: v for k, v in ficha(chave).items() if k != 'chave_idempotencia'}
+    ids = {cliente.post('/', json=dados, headers={'Idempotency-Key': chave}).get_json()['ticket_id']
+           for _ in range(2)}
+    assert len(ids) == 1
+    assert contar(chave) == 1
+
+
+def test_envios_simultaneos_caem_no_on_conflict(chave):
+    """A segunda transação não vê a ficha ainda não confirmada da primeira: passa pela consulta prévia,
+    espera no índice único e sai pelo ON CONFLICT DO NOTHING, devolvendo o ID gravado pela outra."""
+    primeira = psycopg2.connect(app_ficha.DATABASE_URL)
+    segunda = psycopg2.connect(app_ficha.DATABASE_URL)
+    resultado = {}
+    try:
+        with primeira.cursor() as cur:
+            id_primeira = app_ficha.salvar_ficha(cur, ficha(chave))
+
+        def gravar_segunda():
+            with segunda.cursor() as cur:
+                resultado['id'] = app_ficha.salvar_ficha(cur, ficha(chave))
+            segunda.commit()
+
+        thread = threading.Thread(target=gravar_segunda)
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive(), 'a segunda gravação deveria esperar pela primeira transação'
+        primeira.commit()
+        thread.join(10)
+        assert not thread.is_alive()
+    finally:
+        primeira.close()
+        segunda.close()
+
+    assert resultado['id'] == id_primeira
+    assert contar(chave) == 1